@@ -31,7 +31,7 @@ import webhelpers
 
 from   r2.config.routing import make_map
 import r2.lib.app_globals as app_globals
-from   r2.lib import  rpc
+from   r2.lib import  rpc, metrics
 import r2.lib.helpers
 import r2.config as reddit_config
 
@@ -76,5 +76,23 @@ def load_environment(global_conf={}, app_conf={}):
     g = config['pylons.g']
     reddit_config.cache = g.cache
 
+    # compiled templates are kept in cache_dir, and the templates are
+    # indexed and loaded now rather than on the first requests
+    cache_dir = config['app_conf'].get('cache_dir', root_path)
+    tmpl_options.setdefault('mako.directories', tmpl_dirs)
+    tmpl_options.setdefault('mako.module_directory',
+                            os.path.join(cache_dir, 'templates'))
+    from mako.ext.turbogears import TGPlugin
+    from r2.config.templates import tpm
+    tpm.loader = TGPlugin(options = tmpl_options)
+    tpm.load_registry(tmpl_dirs,
+                      os.path.join(cache_dir, 'template_registry.pickle'))
+    if not g.template_debug:
+        tpm.preload()
+
+    # each process publishes its metrics for the others on the host to
+    # read into cache_dir
+    metrics.metrics_dir = os.path.join(cache_dir, 'metrics')
+
     # Return our loaded config object
     #return config.Config(tmpl_options, map, paths)
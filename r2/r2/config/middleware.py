@@ -35,6 +35,7 @@ from r2.config.environment import load_environment
 from r2.config.rewrites import rewrites
 from r2.lib.utils import rstrips
 from r2.lib.jsontemplates import api_type
+from r2.lib.asset_manifest import PrecompressedStatic
 
 #middleware stuff
 from r2.lib.html_source import HTMLValidationParser
@@ -558,7 +559,12 @@ def make_app(global_conf, full_stack=True, **app_conf):
     # Static files
     javascripts_app = StaticJavascripts()
     static_app = StaticURLParser(config['pylons.paths']['static_files'])
-    app = Cascade([static_app, javascripts_app, app])
+    # gzipped copies from the asset manifest go out as they are, and
+    # the gzip middleware leaves them be
+    precompressed_app = PrecompressedStatic(
+        config['pylons.paths']['static_files'],
+        config['pylons.g'].static_manifest)
+    app = Cascade([precompressed_app, static_app, javascripts_app, app])
 
     app = make_gzip_middleware(app, app_conf)
 
@@ -136,6 +136,7 @@ def make_map(global_conf={}, app_conf={}):
 
     mc('/health', controller='health', action='health')
     mc('/shutdown', controller='health', action='shutdown')
+    mc('/metrics', controller='health', action='metrics')
 
     mc('/', controller='hot', action='listing')
     
@@ -43,13 +43,15 @@ from r2.lib.menus import CommentSortMenu
 from r2.lib.normalized_hot import expire_hot
 from r2.lib.captcha import get_iden
 from r2.lib.strings import strings
-from r2.lib.filters import _force_unicode, websafe_json, websafe, spaceCompress
+from r2.lib.filters import _force_unicode, websafe_json, websafe, spaceCompress, \
+     websafe_compress
 from r2.lib.db import queries
 from r2.lib import amqp, promote
 from r2.lib.media import force_thumbnail, thumbnail_url
-from r2.lib.comment_tree import add_comment, delete_comment
+from r2.lib.comment_tree import add_comment, delete_comment, \
+     update_comment_votes
 from r2.lib import tracking, sup, cssfilter, emailer
-from r2.lib.subreddit_search import search_reddits
+from r2.lib.subreddit_search import search_reddits, update_reddit
 
 from datetime import datetime, timedelta
 from md5 import md5
@@ -775,6 +777,9 @@ class ApiController(RedditController):
 
                 if g.write_query_queue:
                     queries.new_vote(v)
+            elif isinstance(thing, Comment):
+                #move the comment within its link's comment sort orders
+                update_comment_votes(thing)
 
             # flag search indexer that something has changed
             tc.changed(thing)
@@ -1038,6 +1043,7 @@ class ApiController(RedditController):
             # make sure this user is on the admin list of that site!
             if sr.add_subscriber(c.user):
                 sr._incr('_ups', 1)
+            update_reddit(sr)
             sr.add_moderator(c.user)
             sr.add_contributor(c.user)
             redir = sr.path + "about/edit/?created=true"
@@ -1065,6 +1071,7 @@ class ApiController(RedditController):
             for k, v in kw.iteritems():
                 setattr(sr, k, v)
             sr._commit()
+            update_reddit(sr)
 
             #update the domain cache if the domain changed
             if sr.domain != old_domain:
@@ -1315,6 +1322,7 @@ class ApiController(RedditController):
         else:
             if sr.remove_subscriber(c.user):
                 sr._incr('_ups', -1)
+        update_reddit(sr)
         tc.changed(sr)
 
 
@@ -1506,7 +1514,7 @@ class ApiController(RedditController):
 
         wrapped = wrap_links(link)
         wrapped = list(wrapped)[0]
-        return websafe(spaceCompress(wrapped.link_child.content()))
+        return websafe_compress(wrapped.link_child.content())
 
     @validatedForm(link = VByName('name', thing_cls = Link, multiple = False),
                    color = VOneOf('color', spreadshirt.ShirtPane.colors),
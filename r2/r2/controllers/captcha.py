@@ -20,14 +20,10 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 from reddit_base import RedditController
-import StringIO
 import r2.lib.captcha as captcha
 from pylons import c
 
 class CaptchaController(RedditController):
     def GET_captchaimg(self, iden):
-        image = captcha.get_image(iden)
-        f = StringIO.StringIO()
-        image.save(f, "PNG")
-        return self.sendpng(f.getvalue())
+        return self.sendpng(captcha.get_image(iden))
     
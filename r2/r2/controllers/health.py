@@ -3,10 +3,12 @@ import os
 import time
 
 from pylons.controllers.util import abort
-from pylons import c, g
+from pylons import c, g, request
 
 from reddit_base import RedditController
 from r2.lib.utils import worker
+from r2.lib import metrics
+import simplejson
 
 class HealthController(RedditController):
     def shutdown(self):
@@ -50,3 +52,18 @@ class HealthController(RedditController):
         c.response_content_type = 'text/plain'
         c.response.content = 'shutting down...'
         return c.response
+
+    def GET_metrics(self):
+        """the metrics of every process on this host, or only this
+        one's with ?local=1"""
+        if not g.allow_metrics:
+            self.abort404()
+
+        c.dontcache = True
+        if request.GET.get('local'):
+            snapshot = metrics.registry.snapshot()
+        else:
+            snapshot = metrics.host_snapshot()
+        c.response_content_type = 'application/json; charset=UTF-8'
+        c.response.content = simplejson.dumps(metrics.report(snapshot))
+        return c.response
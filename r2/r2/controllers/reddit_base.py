@@ -28,6 +28,7 @@ from r2.lib.base import BaseController, proxyurl
 from r2.lib import pages, utils, filters
 from r2.lib.utils import http_utils, UniqueIterator
 from r2.lib.cache import LocalCache
+from r2.lib import metrics
 import random as rand
 from r2.models.account import valid_cookie, FakeAccount
 from r2.models.subreddit import Subreddit
@@ -50,6 +51,9 @@ NEVER = 'Thu, 31 Dec 2037 23:59:59 GMT'
 
 cache_affecting_cookies = ('reddit_first','over18','_options')
 
+requests = metrics.counter('requests')
+request_time = metrics.histogram('request.time')
+
 r_subnet = re.compile("^(\d+\.\d+)\.\d+\.\d+$")
 
 class Cookies(dict):
@@ -408,8 +412,8 @@ def ratelimit_throttled():
 #anymore
 def base_listing(fn):
     @validate(num    = VLimit('limit'),
-              after  = VByName('after'),
-              before = VByName('before'),
+              after  = VCursor('after'),
+              before = VCursor('before'),
               count  = VCount('count'),
               target = VTarget("target"))
     def new_fn(self, before, **env):
@@ -591,6 +595,10 @@ class RedditController(BaseController):
                 c.response_wrappers = []
                 
     def post(self):
+        elapsed = datetime.now(g.tz) - c.start_time
+        request_time.observe(elapsed.seconds + elapsed.microseconds / 1e6)
+        requests.incr()
+
         response = c.response
         content = filter(None, response.content)
         if isinstance(content, (list, tuple)):
@@ -28,6 +28,7 @@ from r2.lib.db.operators import asc, desc
 from r2.lib.template_helpers import add_sr
 from r2.lib.jsonresponse import json_respond, JQueryResponse, JsonResponse
 from r2.lib.jsontemplates import api_type
+from r2.lib.pagination import Cursor, make_cursor
 
 from r2.models import *
 from r2.lib.authorize import Address, CreditCard
@@ -451,6 +452,22 @@ class VByName(Validator):
                 pass
         return self.set_error(self._error)
 
+class VCursor(Validator):
+    """A listing's after/before: either a pagination.Cursor token or,
+    from older links and api clients, a fullname. A cursor with bad
+    sort values is treated as no cursor."""
+    def run(self, token):
+        if token:
+            cursor = Cursor.decode(token)
+            if cursor:
+                return cursor if cursor.valid() else None
+            if fullname_regex().match(token):
+                try:
+                    return make_cursor(Thing._by_fullname(token,
+                                                          data = True))
+                except NotFound:
+                    pass
+
 class VByNameIfAuthor(VByName):
     def run(self, fullname):
         thing = VByName.run(self, fullname)
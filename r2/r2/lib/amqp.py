@@ -31,6 +31,7 @@ import socket
 from amqplib import client_0_8 as amqp
 
 from r2.lib.cache import LocalCache
+from r2.lib import metrics
 from pylons import g
 
 amqp_host = g.amqp_host
@@ -138,6 +139,15 @@ def init_queue():
 
     # new_comment (nothing here for now)
 
+    # comments whose votes changed, for their link's sort orders
+    chan.queue_declare(queue='commentsort_q',
+                       durable=True,
+                       exclusive=False,
+                       auto_delete=False)
+    chan.queue_bind(routing_key='commentsort_q',
+                    queue='commentsort_q',
+                    exchange=exchange)
+
     # while new items will be put here automatically, we also need a
     # way to specify that the item has changed by hand
     chan.queue_bind(routing_key='searchchanges_q',
@@ -180,6 +190,10 @@ def handle_items(queue, callback, ack = True, limit = 1, drain = False):
     # debuffer stdout so that logging comes through more real-time
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
+    handled = metrics.counter('amqp.%s.handled' % queue)
+    backlog = metrics.gauge('amqp.%s.backlog' % queue)
+    callback_time = metrics.histogram('amqp.%s.callback_time' % queue)
+
     chan = get_channel()
     while True:
         msg = chan.basic_get(queue)
@@ -199,7 +213,10 @@ def handle_items(queue, callback, ack = True, limit = 1, drain = False):
                 break # the innermost loop only
             msg = chan.basic_get(queue)
 
-        callback(items)
+        backlog.set(items[-1].delivery_info.get('message_count', 0))
+        with callback_time.timer():
+            callback(items)
+        handled.incr(len(items))
 
         if ack:
             for item in items:
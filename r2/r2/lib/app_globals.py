@@ -28,6 +28,7 @@ from r2.lib.db.stats import QueryStats
 from r2.lib.translation import get_active_langs
 from r2.lib.lock import make_lock_factory
 from r2.lib.manager import db_manager
+from r2.lib import asset_manifest
 
 class Globals(object):
 
@@ -66,7 +67,8 @@ class Globals(object):
                   'css_killswitch',
                   'db_create_tables',
                   'disallow_db_writes',
-                  'allow_shutdown']
+                  'allow_shutdown',
+                  'allow_metrics']
 
     tuple_props = ['memcaches',
                    'rec_cache',
@@ -158,10 +160,15 @@ class Globals(object):
         all_languages.sort()
         self.all_languages = all_languages
 
-        # load the md5 hashes of files under static
+        # load the md5 hashes of files under static, from the manifest
+        # if it has been built, otherwise from the .md5 files
         static_files = os.path.join(paths.get('static_files'), 'static')
+        self.static_manifest = asset_manifest.load_manifest(static_files)
         self.static_md5 = {}
-        if os.path.exists(static_files):
+        if self.static_manifest is not None:
+            for name, entry in self.static_manifest.iteritems():
+                self.static_md5[name] = entry['md5']
+        elif os.path.exists(static_files):
             for f in os.listdir(static_files):
                 if f.endswith('.md5'):
                     key = f.strip('.md5')
@@ -198,13 +205,12 @@ class Globals(object):
         if self.media_domain == self.domain:
             print "Warning: g.media_domain == g.domain. This may give untrusted content access to user cookies"
 
-        #read in our CSS so that it can become a default for subreddit
-        #stylesheets
-        stylesheet_path = os.path.join(paths.get('static_files'),
-                                       self.static_path.lstrip('/'),
-                                       self.stylesheet)
-        with open(stylesheet_path) as s:
-            self.default_stylesheet = s.read()
+        #our CSS is the default for subreddit stylesheets. it's read
+        #when first needed (see default_stylesheet)
+        self.stylesheet_path = os.path.join(paths.get('static_files'),
+                                            self.static_path.lstrip('/'),
+                                            self.stylesheet)
+        self._default_stylesheet = None
 
         self.reddit_host = socket.gethostname()
         self.reddit_pid  = os.getpid()
@@ -216,6 +222,13 @@ class Globals(object):
         if self.write_query_queue and not self.amqp_host:
             raise Exception("amqp_host must be defined to use the query queue")
 
+    @property
+    def default_stylesheet(self):
+        if self._default_stylesheet is None:
+            with open(self.stylesheet_path) as s:
+                self._default_stylesheet = s.read()
+        return self._default_stylesheet
+
     @staticmethod
     def to_bool(x):
         return (x.lower() == 'true') if x else None
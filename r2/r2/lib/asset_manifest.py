@@ -0,0 +1,183 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+A manifest of the files under public/static, built once per deploy
+(`make manifest`): each file's md5 fingerprint, and a gzipped copy
+next to it (foo.css.gz) of those worth compressing. App processes
+load the manifest rather than fingerprinting files at startup, and
+PrecompressedStatic serves the gzipped copies as they are.
+"""
+from __future__ import with_statement
+import os, sys, md5, gzip, mimetypes, cPickle as pickle
+from cgi import parse_qs
+
+manifest_name = 'manifest.pickle'
+compressible = ('.js', '.css', '.html', '.htm', '.txt', '.xml', '.svg',
+                '.json')
+#a gzipped copy is kept when it saves at least this much
+min_savings = .1
+
+def build_manifest(static_dir, compress = True):
+    """Fingerprints and gzips the files under static_dir, writing the
+    manifest into it. Returns the manifest, a dict of file name
+    (relative to static_dir) -> dict(md5, size, mtime, gz)"""
+    manifest = {}
+    for root, dirs, fnames in os.walk(static_dir):
+        for fname in fnames:
+            if (fname.startswith('.') or fname == manifest_name or
+                fname.endswith(('.md5', '.gz'))):
+                continue
+            path = os.path.join(root, fname)
+            name = path[len(static_dir):].lstrip(os.sep)
+            mtime = os.stat(path).st_mtime
+            with open(path, 'rb') as handle:
+                data = handle.read()
+
+            entry = dict(md5 = md5.new(data).hexdigest(),
+                         size = len(data),
+                         mtime = mtime,
+                         gz = False)
+            gz_path = path + '.gz'
+            if compress and fname.endswith(compressible):
+                gz_data = gzip_data(data)
+                if len(gz_data) <= len(data) * (1 - min_savings):
+                    write_file(gz_path, gz_data)
+                    entry['gz'] = True
+            if not entry['gz'] and os.path.exists(gz_path):
+                os.unlink(gz_path)
+            manifest[name] = entry
+
+    write_file(os.path.join(static_dir, manifest_name),
+               pickle.dumps(manifest, -1))
+    return manifest
+
+def gzip_data(data):
+    from StringIO import StringIO
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj = buf, mode = 'wb', compresslevel = 9)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def write_file(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as handle:
+        handle.write(data)
+    os.rename(tmp, path)
+
+def load_manifest(static_dir):
+    """The manifest built in static_dir, or None if there isn't one"""
+    try:
+        with open(os.path.join(static_dir, manifest_name), 'rb') as handle:
+            return pickle.load(handle)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+class PrecompressedStatic(object):
+    """
+    Serves the gzipped copy of a file in the manifest, when the client
+    accepts it, as a file in root (the parent of the static dir) at
+    prefix + its name. Everything else is a 404, to fall through to
+    the next app in a Cascade, as is a file that has changed since the
+    manifest was built (by its size and mtime), whose copy is stale.
+
+    Only urls with a v= query (the fingerprinted ones from
+    static()) are cached for max_age; others may change under them.
+    """
+    max_age = 86400 * 365
+    chunk_size = 65536
+
+    def __init__(self, root, manifest, prefix = '/static/'):
+        self.root = root
+        self.manifest = manifest or {}
+        self.prefix = prefix
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        entry = None
+        if (path.startswith(self.prefix) and
+            'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '') and
+            environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD')):
+            name = path[len(self.prefix):]
+            entry = self.manifest.get(name)
+        if not entry or not entry['gz']:
+            return self.not_found(start_response)
+
+        path = os.path.join(self.root, self.prefix.strip('/'), name)
+        try:
+            st = os.stat(path)
+            if (st.st_size != entry['size'] or
+                st.st_mtime != entry.get('mtime')):
+                return self.not_found(start_response)
+            f = open(path + '.gz', 'rb')
+        except (IOError, OSError):
+            return self.not_found(start_response)
+
+        etag = '"%s-gz"' % entry['md5']
+        headers = [('Content-Type', self.content_type(name)),
+                   ('Content-Encoding', 'gzip'),
+                   ('Vary', 'Accept-Encoding'),
+                   ('ETag', etag)]
+        if 'v' in parse_qs(environ.get('QUERY_STRING', '')):
+            headers.append(('Cache-Control', 'max-age=%d' % self.max_age))
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            f.close()
+            start_response('304 Not Modified', headers)
+            return []
+
+        headers.append(('Content-Length', str(os.fstat(f.fileno()).st_size)))
+        start_response('200 OK', headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            f.close()
+            return []
+        wrapper = environ.get('wsgi.file_wrapper')
+        if wrapper:
+            return wrapper(f, self.chunk_size)
+        return self.iter_file(f)
+
+    def iter_file(self, f):
+        try:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    @staticmethod
+    def content_type(name):
+        ctype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if ctype.startswith('text/') or ctype.endswith('javascript'):
+            ctype += '; charset=UTF-8'
+        return ctype
+
+    @staticmethod
+    def not_found(start_response):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['']
+
+if __name__ == '__main__':
+    manifest = build_manifest(sys.argv[1])
+    print "%d files, %d gzipped" % (len(manifest),
+                                    sum(1 for e in manifest.itervalues()
+                                        if e['gz']))
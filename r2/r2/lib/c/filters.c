@@ -38,104 +38,61 @@ PyObject *unicode_arg(PyObject *args) {
 
 
 
+/* writes c to buffer at ib, escaped for html if quote >= 0 (and '"'
+   too if quote is set), and returns the new end of the buffer */
+static Py_ssize_t
+put(Py_UNICODE *buffer, Py_ssize_t ib, Py_UNICODE c, int quote)
+{
+  const char *entity = NULL;
+  if (quote >= 0) {
+    if (c == '&') entity = "&amp;";
+    else if (c == '<') entity = "&lt;";
+    else if (c == '>') entity = "&gt;";
+    else if (c == '"' && quote) entity = "&quot;";
+  }
+  if (entity) {
+    while (*entity) buffer[ib++] = (Py_UNICODE)*entity++;
+  }
+  else {
+    buffer[ib++] = c;
+  }
+  return ib;
+}
+
 static PyObject *
-filters_uwebsafe(PyObject * self, PyObject *args) 
+escape_unicode(PyObject *com, int quote)
 {
-  PyObject * com;
-  Py_UNICODE * input_buffer;
+  Py_UNICODE *input_buffer = PyUnicode_AS_UNICODE(com);
+  Py_ssize_t len = PyUnicode_GET_SIZE(com);
+  Py_ssize_t ic, ib;
   Py_UNICODE *buffer;
-  PyObject * res;
-  int ic=0, ib=0;
-  int len;
-  Py_UNICODE c;
-  if (!(com = unicode_arg(args))) return NULL;
-  input_buffer = PyUnicode_AS_UNICODE(com);
-  len = PyUnicode_GetSize(com);
+  PyObject *res;
 
-  buffer = (Py_UNICODE*)malloc(6*len*sizeof(Py_UNICODE));
-  for(ic = 0, ib = 0; ic < len; ic++, ib++) {
-    c = input_buffer[ic];
-    if (c == '&') {
-      buffer[ib++] = (Py_UNICODE)'&';
-      buffer[ib++] = (Py_UNICODE)'a';
-      buffer[ib++] = (Py_UNICODE)'m';
-      buffer[ib++] = (Py_UNICODE)'p';
-      buffer[ib]   = (Py_UNICODE)';';
-    }
-    else if(c == (Py_UNICODE)'<') {
-      buffer[ib++] = (Py_UNICODE)'&';
-      buffer[ib++] = (Py_UNICODE)'l';
-      buffer[ib++] = (Py_UNICODE)'t';
-      buffer[ib]   = (Py_UNICODE)';';
-    }
-    else if(c == (Py_UNICODE)'>') {
-      buffer[ib++] = (Py_UNICODE)'&';
-      buffer[ib++] = (Py_UNICODE)'g';
-      buffer[ib++] = (Py_UNICODE)'t';
-      buffer[ib]   = (Py_UNICODE)';';
-    }
-    else if(c == (Py_UNICODE)'"') {
-      buffer[ib++] = (Py_UNICODE)'&';
-      buffer[ib++] = (Py_UNICODE)'q';
-      buffer[ib++] = (Py_UNICODE)'u';
-      buffer[ib++] = (Py_UNICODE)'o';
-      buffer[ib++] = (Py_UNICODE)'t';
-      buffer[ib]   = (Py_UNICODE)';';      
-    }
-    else {
-      buffer[ib] = input_buffer[ic];
-    }
+  if (len > PY_SSIZE_T_MAX / 6) return PyErr_NoMemory();
+  res = PyUnicode_FromUnicode(NULL, 6 * len);
+  if (!res) return NULL;
+  buffer = PyUnicode_AS_UNICODE(res);
+  for (ic = 0, ib = 0; ic < len; ic++) {
+    ib = put(buffer, ib, input_buffer[ic], quote);
   }
-  res = PyUnicode_FromUnicode(buffer, ib);
-  free(buffer);
+  if (PyUnicode_Resize(&res, ib) < 0) return NULL;
   return res;
+}
 
+static PyObject *
+filters_uwebsafe(PyObject * self, PyObject *args) 
+{
+  PyObject * com;
+  if (!(com = unicode_arg(args))) return NULL;
+  return escape_unicode(com, 1);
 }
 
 static PyObject *
 filters_uwebsafe_json(PyObject * self, PyObject *args) 
 {
   PyObject * com;
-  Py_UNICODE * input_buffer;
-  Py_UNICODE *buffer;
-  PyObject * res;
-  int ic=0, ib=0;
-  int len;
-  Py_UNICODE c;
   if (!(com = unicode_arg(args))) return NULL;
-  input_buffer = PyUnicode_AS_UNICODE(com);
-  len = PyUnicode_GetSize(com);
-
-  buffer = (Py_UNICODE*)malloc(5*len*sizeof(Py_UNICODE));
-  for(ic = 0, ib = 0; ic < len; ic++, ib++) {
-    c = input_buffer[ic];
-    if (c == '&') {
-      buffer[ib++] = (Py_UNICODE)'&';
-      buffer[ib++] = (Py_UNICODE)'a';
-      buffer[ib++] = (Py_UNICODE)'m';
-      buffer[ib++] = (Py_UNICODE)'p';
-      buffer[ib]   = (Py_UNICODE)';';
-    }
-    else if(c == (Py_UNICODE)'<') {
-      buffer[ib++] = (Py_UNICODE)'&';
-      buffer[ib++] = (Py_UNICODE)'l';
-      buffer[ib++] = (Py_UNICODE)'t';
-      buffer[ib]   = (Py_UNICODE)';';
-    }
-    else if(c == (Py_UNICODE)'>') {
-      buffer[ib++] = (Py_UNICODE)'&';
-      buffer[ib++] = (Py_UNICODE)'g';
-      buffer[ib++] = (Py_UNICODE)'t';
-      buffer[ib]   = (Py_UNICODE)';';
-    }
-    else {
-      buffer[ib] = input_buffer[ic];
-    }
-  }
-  res = PyUnicode_FromUnicode(buffer, ib);
-  free(buffer);
-  return res;
-
+  return escape_unicode(com, 0);
 }
 
 
@@ -201,85 +158,220 @@ void print_unicode(Py_UNICODE *c, int len) {
 
 const char *SC_OFF = "<!-- SC_OFF -->";
 const char *SC_ON  = "<!-- SC_ON -->";
-const Py_UNICODE *SC_OFF_U;
-const Py_UNICODE *SC_ON_U;
 int SC_OFF_LEN = 0;
 int SC_ON_LEN = 0;
 
+/* set from r2.lib.filters, so that unsafe() can return its _Unsafe */
+static PyObject *unsafe_type = NULL;
 
+/* the same whitespace as the [\s] in the python spaceCompress, which
+   doesn't use re.UNICODE */
+int whitespace(Py_UNICODE c) {
+  return (c == ' ' || c == '\t' || c == '\n' || c == '\r' ||
+          c == '\f' || c == '\v');
+}
 
-int whitespace(char c) {
-  return (c == '\n' || c == '\r' || c == '\t' || c == ' ');
+/* ascii-only case folding, as re.I does without re.UNICODE */
+Py_UNICODE lower(Py_UNICODE c) {
+  return (c >= 'A' && c <= 'Z') ? c - 'A' + 'a' : c;
 }
 
+#define NO_MARKER 0
+#define MARKER_OFF 1
+#define MARKER_ON 2
+#define MARKER_OTHER 3
 
+/* is there an SC_OFF or SC_ON comment at input[ic]? The python version
+   splits on them case insensitively, but only toggles compression for
+   an exact match, so any other case is just copied */
+int marker(Py_UNICODE *input, Py_ssize_t ic, Py_ssize_t len,
+           Py_ssize_t *mlen) {
+  const char *tags[2];
+  int lens[2], kinds[2], t, i, exact;
+  tags[0] = SC_OFF; lens[0] = SC_OFF_LEN; kinds[0] = MARKER_OFF;
+  tags[1] = SC_ON;  lens[1] = SC_ON_LEN;  kinds[1] = MARKER_ON;
+
+  for (t = 0; t < 2; t++) {
+    if (len - ic < lens[t]) continue;
+    exact = 1;
+    for (i = 0; i < lens[t]; i++) {
+      if (input[ic + i] != (Py_UNICODE)tags[t][i]) {
+        exact = 0;
+        if (lower(input[ic + i]) != lower((Py_UNICODE)tags[t][i])) break;
+      }
+    }
+    if (i == lens[t]) {
+      *mlen = lens[t];
+      return exact ? kinds[t] : MARKER_OTHER;
+    }
+  }
+  return NO_MARKER;
+}
+
+/* compresses runs of whitespace to a single space, removing them
+   entirely after a '>' or before a '<', except between SC_OFF and
+   SC_ON. Each part between the comments is compressed on its own. If
+   quote >= 0, the result is also escaped as by escape_unicode. */
 static PyObject *
-filters_uspace_compress(PyObject * self, PyObject *args) {
-  PyObject * com;
-  PyObject * res;
-  Py_ssize_t len;
-  Py_UNICODE *input_buffer;
+compress_unicode(PyObject *com, int quote)
+{
+  Py_UNICODE *input_buffer = PyUnicode_AS_UNICODE(com);
+  Py_ssize_t len = PyUnicode_GET_SIZE(com);
+  Py_ssize_t ic, ib, j, mlen, part = 0;
   Py_UNICODE *buffer;
-  Py_UNICODE c;
-  int ic, ib;
-  int gobble = 1;
-  com = unicode_arg(args);
-  if(!com) {
-    return NULL;
-  }
-  input_buffer = PyUnicode_AS_UNICODE(com);
-  len = PyUnicode_GetSize(com);
-  buffer = (Py_UNICODE*)malloc(len * sizeof(Py_UNICODE));
+  PyObject *res;
+  int gobble = 1, kind;
+
+  if (len > PY_SSIZE_T_MAX / 6) return PyErr_NoMemory();
+  res = PyUnicode_FromUnicode(NULL, quote >= 0 ? 6 * len : len);
+  if (!res) return NULL;
+  buffer = PyUnicode_AS_UNICODE(res);
 
   /* ic -> input buffer index, ib -> output buffer */
-  for(ic = 0, ib = 0; ic <= len; ic++) {
-    c = input_buffer[ic];
-    /* gobble -> we are space compressing */
-    if(gobble) {
-      /* remove spaces if encountered */
-      if(Py_UNICODE_ISSPACE(c)) {
-        /* after this loop, c will be a non-space */
-        while(Py_UNICODE_ISSPACE(c)) { c = input_buffer[++ic]; }
-        /* unless next char is a <, add a single space to account for
-           the multiple spaces that have been removed */
-        if(c != (Py_UNICODE)('<')) {
-          buffer[ib++] = (Py_UNICODE)(' ');
-        }
+  for (ic = 0, ib = 0; ic < len; ) {
+    Py_UNICODE c = input_buffer[ic];
+    if (c == '<' && (kind = marker(input_buffer, ic, len, &mlen))) {
+      if (kind == MARKER_OFF) {
+        gobble = 0;
       }
-      /* gobble all space after '>' */
-      if(c == (Py_UNICODE)('>')) {
-        buffer[ib++] = c;
-	c = input_buffer[++ic];
-        while(Py_UNICODE_ISSPACE(c)) { c = input_buffer[++ic]; }
+      else if (kind == MARKER_ON) {
+        gobble = 1;
       }
-      /* does the next part of the string match the SC_OFF label */
-      if (len - ic >= SC_OFF_LEN &&
-          memcmp(&input_buffer[ic], SC_OFF_U, 
-                 sizeof(Py_UNICODE)*SC_OFF_LEN) == 0) {
-        /* disable gobbling, and bypass that part of the string */
-        gobble = 0;
-        ic += SC_OFF_LEN;
-        c = input_buffer[ic];
+      else {
+        for (j = ic; j < ic + mlen; j++) {
+          ib = put(buffer, ib, input_buffer[j], quote);
+        }
       }
+      ic += mlen;
+      part = ic;
     }
-    /* not gobbling, but find the SC_ON tag */
-    else if (len - ic >= SC_ON_LEN &&
-          memcmp(&input_buffer[ic], SC_ON_U, 
-                 sizeof(Py_UNICODE)*SC_ON_LEN) == 0) {
-        gobble = 1;
-        ic += SC_ON_LEN;
-        c = input_buffer[ic];
+    else if (gobble && whitespace(c)) {
+      for (j = ic + 1; j < len && whitespace(input_buffer[j]); j++);
+      /* the ends of a part don't count as tags */
+      if (!(ic > part && input_buffer[ic - 1] == '>') &&
+          !(j < len && input_buffer[j] == '<' &&
+            !marker(input_buffer, j, len, &mlen))) {
+        buffer[ib++] = ' ';
+      }
+      ic = j;
     }
-    if(c) {
-      buffer[ib++] = c;
+    else {
+      ib = put(buffer, ib, c, quote);
+      ic++;
     }
-  }  
+  }
 
-  res = PyUnicode_FromUnicode(buffer, ib);
-  free(buffer);
+  if (PyUnicode_Resize(&res, ib) < 0) return NULL;
+  return res;
+}
+
+/* r2.lib.filters._force_unicode: utf-8, then latin1, then unicode() */
+static PyObject *
+force_unicode(PyObject *text)
+{
+  PyObject *res;
+  if (PyUnicode_CheckExact(text)) {
+    Py_INCREF(text);
+    return text;
+  }
+  res = PyUnicode_FromEncodedObject(text, "utf-8", "strict");
+  if (!res) {
+    if (PyErr_ExceptionMatches(PyExc_UnicodeDecodeError)) {
+      PyErr_Clear();
+      res = PyUnicode_FromEncodedObject(text, "latin1", "strict");
+    }
+    else if (PyErr_ExceptionMatches(PyExc_TypeError)) {
+      PyErr_Clear();
+      res = PyObject_Unicode(text);
+    }
+  }
+  return res;
+}
+
+/* the (optional) argument, passed through force_unicode */
+static PyObject *
+text_arg(PyObject *args)
+{
+  PyObject *text = NULL;
+  if (!PyArg_ParseTuple(args, "|O", &text))
+    return NULL;
+  if (!text) return PyUnicode_FromUnicode(NULL, 0);
+  return force_unicode(text);
+}
+
+static PyObject *
+make_unsafe(PyObject *text)
+{
+  PyObject *res;
+  if (!text) return NULL;
+  if (!unsafe_type) {
+    Py_DECREF(text);
+    PyErr_SetString(PyExc_RuntimeError, "set_unsafe_type has not been called");
+    return NULL;
+  }
+  res = PyObject_CallFunctionObjArgs(unsafe_type, text, NULL);
+  Py_DECREF(text);
   return res;
 }
 
+static PyObject *
+filters_uspace_compress(PyObject * self, PyObject *args) {
+  PyObject * com;
+  if (!(com = unicode_arg(args))) return NULL;
+  return compress_unicode(com, -1);
+}
+
+static PyObject *
+filters_space_compress(PyObject * self, PyObject *args) {
+  PyObject *text, *res;
+  if (!(text = text_arg(args))) return NULL;
+  res = compress_unicode(text, -1);
+  Py_DECREF(text);
+  return res;
+}
+
+static PyObject *
+filters_websafe_compress(PyObject * self, PyObject *args) {
+  PyObject *text, *res;
+  if (!(text = text_arg(args))) return NULL;
+  res = compress_unicode(text, 1);
+  Py_DECREF(text);
+  return make_unsafe(res);
+}
+
+static PyObject *
+filters_websafe_json(PyObject * self, PyObject *args) {
+  PyObject *text, *res;
+  if (!(text = text_arg(args))) return NULL;
+  res = escape_unicode(text, 0);
+  Py_DECREF(text);
+  return res;
+}
+
+static PyObject *
+filters_force_unicode(PyObject * self, PyObject *args) {
+  PyObject *text;
+  if (!PyArg_ParseTuple(args, "O", &text))
+    return NULL;
+  return force_unicode(text);
+}
+
+static PyObject *
+filters_unsafe(PyObject * self, PyObject *args) {
+  return make_unsafe(text_arg(args));
+}
+
+static PyObject *
+filters_set_unsafe_type(PyObject * self, PyObject *args) {
+  PyObject *type;
+  if (!PyArg_ParseTuple(args, "O", &type))
+    return NULL;
+  Py_INCREF(type);
+  Py_XDECREF(unsafe_type);
+  unsafe_type = type;
+  Py_RETURN_NONE;
+}
+
 static PyMethodDef FilterMethods[] = {
   {"websafe",  filters_websafe, METH_VARARGS,
    "make string web safe."},
@@ -289,27 +381,26 @@ static PyMethodDef FilterMethods[] = {
    "make string web safe, no &quot;."},
   {"uspace_compress",  filters_uspace_compress, METH_VARARGS,
    "removes spaces around angle brackets. Can be disabled with the use of SC_OFF and SC_ON comments from r2.lib.filters."},
+  {"space_compress",  filters_space_compress, METH_VARARGS,
+   "uspace_compress of any string, as by force_unicode."},
+  {"websafe_compress",  filters_websafe_compress, METH_VARARGS,
+   "space_compress and make web safe in one pass, as an _Unsafe."},
+  {"websafe_json",  filters_websafe_json, METH_VARARGS,
+   "uwebsafe_json of any string, as by force_unicode."},
+  {"force_unicode",  filters_force_unicode, METH_VARARGS,
+   "decode as utf-8, falling back to latin1, or call unicode()."},
+  {"unsafe",  filters_unsafe, METH_VARARGS,
+   "force_unicode as an _Unsafe."},
+  {"set_unsafe_type",  filters_set_unsafe_type, METH_VARARGS,
+   "set the type returned by unsafe and websafe_compress."},
   {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
-Py_UNICODE *to_unicode(const char *c, int len) {
-  Py_UNICODE *x = (Py_UNICODE *)malloc((len+1) * sizeof(Py_UNICODE));
-  int i;
-  for(i = 0; i < len; i++) {
-    x[i] = (Py_UNICODE)c[i];
-  }
-  x[len] = (Py_UNICODE)(0);
-  return x;
-}
-
-
 PyMODINIT_FUNC
 initCfilters(void)
 {
   SC_OFF_LEN = strlen(SC_OFF);
-  SC_OFF_U = to_unicode(SC_OFF, SC_OFF_LEN);
   SC_ON_LEN = strlen(SC_ON);
-  SC_ON_U = to_unicode(SC_ON, SC_ON_LEN);
 
   (void) Py_InitModule("Cfilters", FilterMethods);
 }
@@ -23,6 +23,10 @@ from threading import local
 
 from utils import lstrips
 from contrib import memcache
+import metrics
+
+cache_hits = metrics.counter('cache.hits')
+cache_misses = metrics.counter('cache.misses')
 
 class CacheUtils(object):
     def incr_multi(self, keys, amt=1, prefix=''):
@@ -173,8 +177,10 @@ class CacheChain(CacheUtils, local):
                     if c == d:
                         break;
                     d.set(key, val)
+                cache_hits.incr()
                 return val
         #didn't find anything
+        cache_misses.incr()
         return default
 
     def simple_get_multi(self, keys):
@@ -193,6 +199,8 @@ class CacheChain(CacheUtils, local):
                 r.update(out)
                 out = r
                 need = need - set(r.keys())
+        cache_hits.incr(len(out))
+        cache_misses.incr(len(keys) - len(out))
         return out
 
 #smart get multi
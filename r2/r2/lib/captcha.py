@@ -19,14 +19,32 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
-import random, string
+from __future__ import with_statement
+import random, string, StringIO
 from pylons import g
 from Captcha.Base import randomIdentifier
 from Captcha.Visual import Text, Backgrounds, Distortions, ImageCaptcha
+from r2.lib.lock import TimeoutExpired
 
 IDEN_LENGTH = 32
 SOL_LENGTH = 6
 
+#seconds an iden keeps its captcha
+IDEN_TIME = 300
+
+#the pool is a queue of pre-rendered (solution, png) in the
+#rendercache at captcha_pool_<n>. the producer, fill_pool, is run from
+#cron rather than by the app servers, and renders up to POOL_SIZE
+#ahead of captcha_pool_next, which consumers incr to claim an entry,
+#so each is handed out once. a consumer that finds the pool dry
+#renders its own captcha, as before the pool.
+POOL_SIZE = 1000
+POOL_TIME = 3600
+pool_prefix = 'captcha_pool_'
+pool_next_key = pool_prefix + 'next'
+pool_head_key = pool_prefix + 'head'
+img_prefix = 'captcha_img_'
+
 class RandCaptcha(ImageCaptcha):
     defaultSize = (120, 50)
     fontFactory = Text.FontFactory(18, "vera/VeraBd.ttf")
@@ -46,12 +64,73 @@ def get_iden():
 def make_solution():
     return randomIdentifier(alphabet=string.ascii_letters, length = SOL_LENGTH).upper()
 
+def render(solution):
+    f = StringIO.StringIO()
+    RandCaptcha(solution=solution).render().save(f, "PNG")
+    return f.getvalue()
+
+def fill_pool(num = POOL_SIZE):
+    """Run from cron (through paster run) every minute or so: renders
+    captchas into the pool until num are waiting in it. Only one
+    process fills it at a time; the rest return at once."""
+    try:
+        with g.make_lock(pool_prefix + 'fill', time = 600, timeout = 0):
+            g.rendercache.add(pool_next_key, 0)
+            g.rendercache.add(pool_head_key, 0)
+            head = g.rendercache.get(pool_head_key) or 0
+            next = g.rendercache.get(pool_next_key) or 0
+            #entries claimed before they were rendered were skipped
+            head = max(head, next)
+            #if the oldest entry has expired, the rest of the pool is
+            #about as old, so render it again
+            if (head > next and
+                g.rendercache.get(pool_prefix + str(next)) is None):
+                head = next
+            while head < next + num:
+                solution = make_solution()
+                g.rendercache.set(pool_prefix + str(head),
+                                  (solution, render(solution)),
+                                  time = POOL_TIME)
+                head += 1
+                g.rendercache.set(pool_head_key, head)
+                if head % 100 == 0:
+                    next = g.rendercache.get(pool_next_key) or 0
+    except TimeoutExpired:
+        pass
+
+def take_from_pool():
+    """Claims the next (solution, png) in the pool, or None if it has
+    run dry"""
+    n = g.rendercache.incr(pool_next_key)
+    if n is None:
+        return None
+    head = g.rendercache.get(pool_head_key) or 0
+    if n <= head:
+        entry = g.rendercache.get(pool_prefix + str(n - 1))
+        if entry is None:
+            #the entries have expired before being claimed: the
+            #rest of the pool is about as old, so the next fill_pool
+            #renders it again
+            g.rendercache.set(pool_head_key, n)
+        return entry
+
 def get_image(iden):
-    solution = g.rendercache.get(str(iden))
-    if not solution:
+    """The png for iden's captcha, which is bound to an entry from the
+    pool the first time it's asked for"""
+    iden = str(iden)
+    cached = g.rendercache.get_multi([iden, img_prefix + iden])
+    if iden in cached and img_prefix + iden in cached:
+        return cached[img_prefix + iden]
+
+    entry = take_from_pool()
+    if entry:
+        solution, png = entry
+    else:
         solution = make_solution()
-        g.rendercache.set(str(iden), solution, time = 300)
-    return RandCaptcha(solution=solution).render()
+        png = render(solution)
+    g.rendercache.set_multi({iden: solution, img_prefix + iden: png},
+                            time = IDEN_TIME)
+    return png
 
 def valid_solution(iden, solution):
     if (not iden
@@ -59,9 +138,9 @@ def valid_solution(iden, solution):
         or len(iden) != IDEN_LENGTH
         or len(solution) != SOL_LENGTH
         or solution.upper() != g.rendercache.get(str(iden))): 
-        solution = make_solution()
-        g.rendercache.set(str(iden), solution, time = 300)
+        #the next request for the image gets a new captcha
+        g.rendercache.delete_multi([str(iden), img_prefix + str(iden)])
         return False
     else:
-        g.rendercache.delete(str(iden))
+        g.rendercache.delete_multi([str(iden), img_prefix + str(iden)])
         return True
@@ -24,10 +24,21 @@ from __future__ import with_statement
 from pylons import g
 
 from r2.models import *
+from r2.lib.db.sorts import epoch_seconds
+from r2.lib.utils import worker
+from r2.lib import amqp
+
+import bisect
+
+# the Thing sort columns we keep comment orderings for
+COMMENT_SORTS = ('_confidence', '_score', '_hot', '_controversy', '_date')
 
 def comments_key(link_id):
     return 'comments_' + str(link_id)
 
+def sort_comments_key(link_id, sort):
+    return 'comments_sort_%s_%s' % (sort, link_id)
+
 def lock_key(link_id):
     return 'comment_lock_' + str(link_id)
 
@@ -82,6 +93,16 @@ def add_comment_nolock(comment):
     g.permacache.set(comments_key(link_id),
                      (cids, comment_tree, depth, num_children))
 
+    #add to the sort orders that have already been computed
+    sorts = cached_comment_sorts(link_id)
+    for sort, (values, order) in sorts.iteritems():
+        if cm_id not in values:
+            insert_sorted(values, order, p_id, cm_id,
+                          get_sort_value(comment, sort))
+    if sorts:
+        g.permacache.set_multi(dict((sort_comments_key(link_id, sort), r)
+                                    for sort, r in sorts.iteritems()))
+
 def delete_comment(comment):
     #nothing really to do here, atm
     pass
@@ -135,3 +156,116 @@ def load_link_comments(link_id):
         num_children[cm_id] = num
 
     return cids, comment_tree, depth, num_children
+
+
+def get_sort_value(comment, sort):
+    if sort == '_date':
+        return epoch_seconds(comment._date)
+    return getattr(comment, sort)
+
+def insert_sorted(values, order, p_id, cm_id, value):
+    values[cm_id] = value
+    bisect.insort(order.setdefault(p_id, []), (value, cm_id))
+
+def remove_sorted(values, order, p_id, cm_id):
+    value = values.pop(cm_id)
+    siblings = order.get(p_id, [])
+    i = bisect.bisect_left(siblings, (value, cm_id))
+    if i < len(siblings) and siblings[i] == (value, cm_id):
+        del siblings[i]
+
+def cached_comment_sorts(link_id, sorts = COMMENT_SORTS):
+    """Returns the sort orders for the link that are in the cache, as
+    a dict of sort -> (values, order)"""
+    keys = dict((sort_comments_key(link_id, sort), sort) for sort in sorts)
+    r = g.permacache.get_multi(keys.keys())
+    return dict((keys[k], v) for k, v in r.iteritems())
+
+def update_comment_votes(comment):
+    """Called after a vote on comment. Moving it in the sort orders
+    means rewriting the link's whole orders, so rather than doing that
+    (under the lock add_comment needs) on every vote, the comment is
+    queued and the moves are applied in batches by run_comment_sorts"""
+    if g.amqp_host:
+        fullname = comment._fullname
+        worker.do(lambda: amqp.add_item('commentsort_q', fullname))
+    else:
+        update_comment_sorts([comment])
+
+def update_comment_sorts(comments):
+    """Moves each comment to its place among its siblings in the
+    cached sort orders of its link, with one read and write of the
+    orders per link."""
+    by_link = {}
+    for comment in comments:
+        by_link.setdefault(comment.link_id, []).append(comment)
+
+    for link_id, link_comments in by_link.iteritems():
+        with g.make_lock(lock_key(link_id)):
+            #the date ordering doesn't change with votes
+            sorts = cached_comment_sorts(link_id,
+                                         [s for s in COMMENT_SORTS
+                                          if s != '_date'])
+            for sort, (values, order) in sorts.iteritems():
+                for comment in link_comments:
+                    p_id = getattr(comment, 'parent_id', None)
+                    if comment._id in values:
+                        remove_sorted(values, order, p_id, comment._id)
+                    insert_sorted(values, order, p_id, comment._id,
+                                  get_sort_value(comment, sort))
+            if sorts:
+                g.permacache.set_multi(dict((sort_comments_key(link_id, sort), r)
+                                            for sort, r in sorts.iteritems()))
+
+def run_comment_sorts(limit = 1000):
+    """Run (through paster run) as a long-running process to apply the
+    votes queued by update_comment_votes"""
+    def _run(msgs):
+        #the comments are loaded here rather than passed in the
+        #queue so that their scores are the latest
+        fullnames = set(msg.body for msg in msgs)
+        comments = Comment._by_fullname(fullnames, data = True,
+                                        return_dict = False)
+        update_comment_sorts(comments)
+
+    amqp.handle_items('commentsort_q', _run, limit = limit)
+
+def link_comment_sort(link_id, sort):
+    """Returns (values, order) for the comments of a link under the
+    `sort` column (e.g. '_confidence'). values maps each comment id
+    to its value of sort, and order maps each parent id (None for the
+    top level) to a list of (value, comment id) for its children,
+    ascending. The orders are kept up to date by add_comment and
+    update_comment_sorts, so reading them is just a lookup."""
+    key = sort_comments_key(link_id, sort)
+    r = g.permacache.get(key)
+    if r:
+        return r
+    else:
+        with g.make_lock(lock_key(link_id)):
+            #someone else may have built them while we waited
+            r = g.permacache.get(key)
+            if r:
+                return r
+            sorts = load_link_comment_sorts(link_id)
+            g.permacache.set_multi(dict((sort_comments_key(link_id, s), v)
+                                        for s, v in sorts.iteritems()))
+        return sorts[sort]
+
+def load_link_comment_sorts(link_id):
+    cids, comment_tree, depth, num_children = link_comments(link_id)
+    comments = Comment._byID(cids, return_dict = False) if cids else ()
+
+    sorts = {}
+    for sort in COMMENT_SORTS:
+        values = {}
+        order = {}
+        for cm in comments:
+            p_id = cm.parent_id if hasattr(cm, 'parent_id') else None
+            value = values[cm._id] = get_sort_value(cm, sort)
+            order.setdefault(p_id, []).append((value, cm._id))
+        for siblings in order.itervalues():
+            siblings.sort()
+        sorts[sort] = (values, order)
+
+    return sorts
@@ -297,7 +297,10 @@ class Solr(object):
         elif id is not None and q is not None:
             raise ValueError('You many only specify "id" OR "q", not both.')
         elif id is not None:
-            m = '<delete><id>%s</id></delete>' % id
+            # a list of ids is deleted in one request
+            if not isinstance(id, (list, tuple, set)):
+                id = [id]
+            m = '<delete>%s</delete>' % ''.join('<id>%s</id>' % i for i in id)
         elif q is not None:
             m = '<delete><query>%s</query></delete>' % q
         response = self._update(m)
@@ -19,10 +19,11 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
 from datetime import datetime
 import cPickle as pickle
 from copy import deepcopy
-import random
+import random, threading, sha
 
 import sqlalchemy as sa
 from sqlalchemy.databases import postgres
@@ -158,26 +159,27 @@ def get_rel_table(metadata, name):
                          sa.UniqueConstraint('thing1_id', 'thing2_id', 'name'))
     return rel_table
 
-#get/create the type tables
+#get/create the type tables. they're only needed to look up types
+#that aren't in the snapshot below
 def make_type_table():
     metadata = make_metadata(dbm.type_db)
     table = get_type_table(metadata)
     create_table(table)
     return table
-type_table = make_type_table()
 
 def make_rel_type_table():
     metadata = make_metadata(dbm.relation_type_db)
     table = get_rel_type_table(metadata)
     create_table(table)
     return table
-rel_type_table = make_rel_type_table()
 
-#lookup dicts
-types_id = {}
-types_name = {}
-rel_types_id = {}
-rel_types_name = {}
+type_table = None
+rel_type_table = None
+def load_type_tables():
+    global type_table, rel_type_table
+    if type_table is None:
+        type_table = make_type_table()
+        rel_type_table = make_rel_type_table()
 
 def check_type(table, selector, insert_vals):
     #check for type in type table, create if not existent
@@ -189,48 +191,97 @@ def check_type(table, selector, insert_vals):
         type_id = r.id
     return type_id
 
-#make the thing tables
-def build_thing_tables():
-    for name, engines in dbm.things.iteritems():
-        type_id = check_type(type_table,
-                             type_table.c.name == name,
-                             dict(name = name))
-
+#the ids of the types, as {'things': {name: type_id},
+#'rels': {name: (type_id, type1_id, type2_id)}, 'check': ...}, are kept
+#in the permacache so processes don't have to look each one up in the
+#type dbs. 'check' is type_tables_check() as of when they were, and a
+#snapshot whose check no longer matches is thrown out
+def snapshot_key():
+    dbs = "%s %s %s" % (g.db_app_name, dbm.type_db.url,
+                        dbm.relation_type_db.url)
+    return 'tdb_sql_types_' + sha.new(dbs).hexdigest()
+
+def type_tables_check():
+    """The row count and largest id of each type table, which change
+    when a type is added or the tables are remade, in one query each.
+    None if they can't be read, e.g. because they don't exist yet"""
+    res = []
+    for get_table, engine in ((get_type_table, dbm.type_db),
+                              (get_rel_type_table, dbm.relation_type_db)):
+        table = get_table(make_metadata(engine))
+        try:
+            row = sa.select([sa.func.count(table.c.id),
+                             sa.func.max(table.c.id)]).execute().fetchone()
+        except sa.exceptions.SQLError:
+            return None
+        res.append(tuple(row))
+    return tuple(res)
+
+def load_type_ids():
+    key = snapshot_key()
+    check = type_tables_check()
+    ids = g.permacache.get(key)
+    if not ids or check is None or ids.get('check') != check:
+        ids = dict(things = {}, rels = {}, check = None)
+
+    missing_things = set(dbm.things) - set(ids['things'])
+    missing_rels = set(dbm.relations) - set(ids['rels'])
+    if missing_things or missing_rels:
+        load_type_tables()
+        for name in missing_things:
+            ids['things'][name] = check_type(type_table,
+                                             type_table.c.name == name,
+                                             dict(name = name))
+        for name in missing_rels:
+            type1_name, type2_name, engines = dbm.relations[name]
+            type1_id = ids['things'][type1_name]
+            type2_id = ids['things'][type2_name]
+            type_id = check_type(rel_type_table,
+                                 rel_type_table.c.name == name,
+                                 dict(name = name,
+                                      type1_id = type1_id,
+                                      type2_id = type2_id))
+            ids['rels'][name] = (type_id, type1_id, type2_id)
+        ids['check'] = type_tables_check()
+        g.permacache.set(key, ids)
+    return ids
+
+#the tables of each type are made the first time they're used
+build_lock = threading.RLock()
+
+class TypeInfo(storage):
+    """A thing or relation type. Its tables are built (and created, if
+    g.db_create_tables) when first asked for."""
+    def __getattr__(self, key):
+        if key == 'tables' and key not in self:
+            with build_lock:
+                if key not in self:
+                    self[key] = self.build()
+        return storage.__getattr__(self, key)
+
+class ThingType(TypeInfo):
+    def build(self):
         tables = []
-        for engine in engines:
+        for engine in dbm.things[self.name]:
             metadata = make_metadata(engine)
 
             #make thing table
-            thing_table = get_thing_table(metadata, name)
+            thing_table = get_thing_table(metadata, self.name)
             create_table(thing_table,
                          index_commands(thing_table, 'thing'))
 
             #make data tables
-            data_table = get_data_table(metadata, name)
+            data_table = get_data_table(metadata, self.name)
             create_table(data_table,
                          index_commands(data_table, 'data'))
 
             tables.append((thing_table, data_table))
+        return tables
 
-        thing = storage(type_id = type_id,
-                        name = name,
-                        tables = tables)
-
-        types_id[type_id] = thing
-        types_name[name] = thing
-build_thing_tables()
-
-#make relation tables
-def build_rel_tables():
-    for name, (type1_name, type2_name, engines) in dbm.relations.iteritems():
-        type1_id = types_name[type1_name].type_id
-        type2_id = types_name[type2_name].type_id
-        type_id = check_type(rel_type_table,
-                             rel_type_table.c.name == name,
-                             dict(name = name,
-                                  type1_id = type1_id,
-                                  type2_id = type2_id))
-
+class RelType(TypeInfo):
+    def build(self):
+        name = self.name
+        type1_name, type2_name, engines = dbm.relations[name]
         tables = []
         for engine in engines:
             metadata = make_metadata(engine)
@@ -255,16 +306,69 @@ def build_rel_tables():
                            rel_t1_table,
                            rel_t2_table,
                            rel_data_table))
+        return tables
+
+class TypeDict(dict):
+    """The types by id or by name, filled in from load_type_ids the
+    first time one is looked up"""
+    loaded = False
+
+    def load(self):
+        with build_lock:
+            if not self.loaded:
+                build_types()
+
+    def make_loader(fn_name):
+        def fn(self, *a, **kw):
+            if not self.loaded:
+                self.load()
+            return getattr(dict, fn_name)(self, *a, **kw)
+        return fn
+
+    __getitem__ = make_loader('__getitem__')
+    __contains__ = make_loader('__contains__')
+    __iter__ = make_loader('__iter__')
+    __len__ = make_loader('__len__')
+    get = make_loader('get')
+    has_key = make_loader('has_key')
+    keys = make_loader('keys')
+    values = make_loader('values')
+    items = make_loader('items')
+    iterkeys = make_loader('iterkeys')
+    itervalues = make_loader('itervalues')
+    iteritems = make_loader('iteritems')
 
-        rel = storage(type_id = type_id,
-                      type1_id = type1_id,
-                      type2_id = type2_id,
-                      name = name,
-                      tables = tables)
-
-        rel_types_id[type_id] = rel
-        rel_types_name[name] = rel
-build_rel_tables()
+#lookup dicts
+types_id = TypeDict()
+types_name = TypeDict()
+rel_types_id = TypeDict()
+rel_types_name = TypeDict()
+
+def build_types():
+    ids = load_type_ids()
+    for name, type_id in ids['things'].iteritems():
+        if name in dbm.things:
+            thing = ThingType(type_id = type_id, name = name)
+            dict.__setitem__(types_id, type_id, thing)
+            dict.__setitem__(types_name, name, thing)
+
+    for name, (type_id, type1_id, type2_id) in ids['rels'].iteritems():
+        if name in dbm.relations:
+            rel = RelType(type_id = type_id,
+                          type1_id = type1_id,
+                          type2_id = type2_id,
+                          name = name)
+            dict.__setitem__(rel_types_id, type_id, rel)
+            dict.__setitem__(rel_types_name, name, rel)
+
+    for d in (types_id, types_name, rel_types_id, rel_types_name):
+        d.loaded = True
+
+def build_all_tables():
+    """Builds every type's tables now, as they all used to be at
+    import, e.g. to create them in a new db"""
+    for t in types_id.values() + rel_types_id.values():
+        t.tables
 
 def get_type_id(name):
     return types_name[name][0]
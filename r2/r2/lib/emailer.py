@@ -19,13 +19,16 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
+
 from email.MIMEText import MIMEText
 from pylons.i18n import _
 from pylons import c, g
 from r2.lib.utils import timeago, query_string
 from r2.models import passhash, Email, Default, has_opted_out, Account
-import os, random, datetime
-import traceback, sys, smtplib
+from Queue import Queue, Empty
+import os, random, datetime, time, heapq
+import traceback, sys, smtplib, socket, threading
 
 def _feedback_email(email, body, kind, name='', reply_to = ''):
     """Function for handling feedback and ad_inq emails.  Adds an
@@ -102,39 +105,249 @@ def share(link, emails, from_name = "", reply_to = "", body = ""):
                                body = body, reply_to = reply_to,
                                thing = link)
 
-def send_queued_mail(test = False):
+class SMTPPool(object):
+    """Up to `size` persistent connections to an SMTP server, shared
+    between the threads of a MailSender. Connections that have sat idle
+    for over `max_idle` seconds are checked with a NOOP before reuse"""
+    def __init__(self, server, size = 5, max_idle = 30):
+        self.server = server
+        self.max_idle = max_idle
+        self.idle = Queue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def get(self):
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    conn, last_used = self.idle.get_nowait()
+                except Empty:
+                    return smtplib.SMTP(self.server)
+                if time.time() - last_used < self.max_idle:
+                    return conn
+                try:
+                    if conn.noop()[0] == 250:
+                        return conn
+                except (smtplib.SMTPException, socket.error):
+                    pass
+                self.close(conn)
+        except:
+            self.slots.release()
+            raise
+
+    def put(self, conn, broken = False):
+        if broken:
+            self.close(conn)
+        else:
+            self.idle.put((conn, time.time()))
+        self.slots.release()
+
+    def close(self, conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, socket.error):
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                conn, last_used = self.idle.get_nowait()
+            except Empty:
+                return
+            self.close(conn)
+
+def temporary_failure(e):
+    """whether the delivery error e is worth retrying: the server said
+    4xx, or went away"""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, msg in e.recipients.values())
+    elif isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, (smtplib.SMTPServerDisconnected, socket.error))
+
+class MailSender(object):
+    """Delivers mail from `num_senders` threads over an SMTPPool. A
+    temporary failure backs off the recipient's domain, doubling from
+    backoff_min up to backoff_max seconds, and the message is retried
+    up to max_tries times. Each message's `done` callback is called
+    with 'sent', 'rejected' or 'failed' (out of tries)."""
+    global_env = g._current_obj()
+
+    def __init__(self, pool, num_senders = 5, max_tries = 4,
+                 backoff_min = 1, backoff_max = 60):
+        self.pool = pool
+        self.num_senders = num_senders
+        self.max_tries = max_tries
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+        self.q = Queue(num_senders * 10)
+        #(time due, sequence number, item) of the messages being held
+        #back, which the sender threads take once they're due
+        self.delayed = []
+        self.seq = 0
+        self.threads = []
+        #domain -> (seconds backed off, time of the next try)
+        self.backoff = {}
+        self.lock = threading.Lock()
+        #messages added but not yet done
+        self.pending = 0
+        self.finished = threading.Condition(self.lock)
+        self.counts = dict(sent = 0, rejected = 0, failed = 0)
+
+    def start(self):
+        for x in xrange(self.num_senders):
+            t = threading.Thread(target = self._init_thread)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def add(self, fr_addr, to_addr, msg, done = None):
+        domain = to_addr.rsplit('@', 1)[-1].lower()
+        with self.lock:
+            self.pending += 1
+        self.q.put([fr_addr, to_addr, msg, done, domain, 0])
+
+    def finish(self):
+        """Waits for every message to be sent or given up on, then
+        closes the connections"""
+        with self.lock:
+            while self.pending:
+                self.finished.wait()
+        for t in self.threads:
+            self.q.put(None)
+        for t in self.threads:
+            t.join()
+        self.pool.close_all()
+        return self.counts
+
+    def _init_thread(self):
+        #set_sent needs pylons.g
+        g._push_object(self.global_env)
+        try:
+            while True:
+                item = self._next()
+                if item is None:
+                    return
+                self._deliver(item)
+        finally:
+            g._pop_object()
+
+    def _next(self):
+        """The next message to deliver: a held back one that is due, or
+        else the next from the queue. A thread waits on the queue only
+        until the earliest held back message is due, and the thread
+        that holds a message back comes back here after, so there's
+        always a thread watching the earliest one"""
+        while True:
+            timeout = None
+            with self.lock:
+                if self.delayed:
+                    timeout = self.delayed[0][0] - time.time()
+                    if timeout <= 0:
+                        return heapq.heappop(self.delayed)[2]
+            try:
+                return self.q.get(timeout = timeout)
+            except Empty:
+                pass
+
+    def _later(self, item, delay):
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.delayed, (time.time() + delay, self.seq, item))
+
+    def _done(self, item, result):
+        try:
+            if item[3]:
+                item[3](result)
+        except:
+            traceback.print_exc(file = sys.stdout)
+        with self.lock:
+            self.counts[result] += 1
+            self.pending -= 1
+            if not self.pending:
+                self.finished.notifyAll()
+
+    def _deliver(self, item):
+        fr_addr, to_addr, msg, done, domain, tries = item
+
+        with self.lock:
+            seconds, next_try = self.backoff.get(domain, (0, 0))
+        wait = next_try - time.time()
+        if wait > 0:
+            return self._later(item, wait)
+
+        try:
+            conn = self.pool.get()
+        except (smtplib.SMTPException, socket.error), e:
+            return self._failed(item, e)
+
+        broken = False
+        try:
+            try:
+                conn.sendmail(fr_addr, to_addr, msg)
+            except (smtplib.SMTPException, socket.error), e:
+                if isinstance(e, (smtplib.SMTPServerDisconnected,
+                                  socket.error)):
+                    broken = True
+                else:
+                    #start a fresh transaction for the next message
+                    try:
+                        conn.rset()
+                    except (smtplib.SMTPException, socket.error):
+                        broken = True
+                return self._failed(item, e)
+        finally:
+            self.pool.put(conn, broken)
+
+        with self.lock:
+            self.backoff.pop(domain, None)
+        self._done(item, 'sent')
+
+    def _failed(self, item, e):
+        fr_addr, to_addr, msg, done, domain, tries = item
+        if not temporary_failure(e):
+            print "Rejected mail to %s: %r" % (to_addr, e)
+            return self._done(item, 'rejected')
+
+        item[5] = tries = tries + 1
+        if tries >= self.max_tries:
+            print "Giving up on mail to %s: %r" % (to_addr, e)
+            return self._done(item, 'failed')
+
+        with self.lock:
+            seconds, next_try = self.backoff.get(domain, (0, 0))
+            seconds = min(max(seconds * 2, self.backoff_min),
+                          self.backoff_max)
+            self.backoff[domain] = (seconds, time.time() + seconds)
+        self._later(item, seconds)
+
+def send_queued_mail(test = False, num_senders = 5):
     """sends mail from the mail queue to smtplib for delivery.  Also,
     on successes, empties the mail queue and adds all emails to the
-    sent_mail list."""
+    sent_mail list. Mail that can't be delivered after retrying is left
+    in the queue for the next run."""
     from r2.lib.pages import PasswordReset, Share, Mail_Opt, VerifyEmail, Promo_Email
     now = datetime.datetime.now(g.tz)
     if not c.site:
         c.site = Default
 
-    clear = False
-    if not test:
-        session = smtplib.SMTP(g.smtp_server)
-    def sendmail(email):
-        try:
-            if test:
-                print email.to_MIMEText().as_string()
-            else:
-                session.sendmail(email.fr_addr, email.to_addr,
-                                 email.to_MIMEText().as_string())
-                email.set_sent(rejected = False)
-        # exception happens only for local recipient that doesn't exist
-        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
-                UnicodeDecodeError):
-            # handle error and print, but don't stall the rest of the queue
-            print "Handled error sending mail (traceback to follow)"
-            traceback.print_exc(file = sys.stdout)
-            email.set_sent(rejected = True)
+    #msg_hashes of the mail that is done with (sent or rejected)
+    processed = []
+    def on_done(email):
+        def done(result):
+            if result != 'failed':
+                email.set_sent(rejected = result == 'rejected')
+                processed.append(email.msg_hash)
+        return done
 
+    if not test:
+        sender = MailSender(SMTPPool(g.smtp_server, size = num_senders),
+                            num_senders = num_senders)
+        sender.start()
 
     try:
-        for email in Email.get_unsent(now):
-            clear = True
-
+        for email in Email.get_unsent(now, batch_limit = 500):
             should_queue = email.should_queue()
             # check only on sharing that the mail is invalid 
             if email.kind == Email.Kind.SHARE and should_queue:
@@ -162,17 +375,33 @@ def send_queued_mail(test = False):
             # handle unknown types here
             elif email.kind not in Email.Kind:
                 email.set_sent(rejected = True)
+                processed.append(email.msg_hash)
                 continue
-            sendmail(email)
+
+            try:
+                msg = email.to_MIMEText()
+                msg = msg and msg.as_string()
+            except UnicodeDecodeError:
+                # handle error and print, but don't stall the rest of the queue
+                print "Handled error sending mail (traceback to follow)"
+                traceback.print_exc(file = sys.stdout)
+                msg = None
+            if not msg:
+                email.set_sent(rejected = True)
+                processed.append(email.msg_hash)
+            elif test:
+                print msg
+                processed.append(email.msg_hash)
+            else:
+                sender.add(email.fr_addr, email.to_addr, msg, on_done(email))
 
     finally:
         if not test:
-            session.quit()
-        
-    # clear is true if anything was found and processed above
-    if clear:
-        Email.handler.clear_queue(now)
-            
+            counts = sender.finish()
+            print "mail: %(sent)d sent, %(rejected)d rejected, %(failed)d failed" % counts
+
+    if processed:
+        Email.handler.clear_queue(now, msg_hashes = processed)
 
 
 def opt_out(msg_hash):
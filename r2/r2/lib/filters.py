@@ -31,66 +31,81 @@ SC_ON = "<!-- SC_ON -->"
 
 
 
+class _Unsafe(unicode): pass
+
+def python_force_unicode(text):
+    try:
+        text = unicode(text, 'utf-8')
+    except UnicodeDecodeError:
+        text = unicode(text, 'latin1')
+    except TypeError:
+        text = unicode(text)
+    return text
+
 def python_websafe(text):
     return text.replace('&', "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
 
 def python_websafe_json(text):
     return text.replace('&', "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
+_between_tags1 = re.compile('> +')
+_between_tags2 = re.compile(' +<')
+_spaces = re.compile('[\s]+')
+_ignore = re.compile('(' + SC_OFF + '|' + SC_ON + ')', re.S | re.I)
+def python_space_compress(content):
+    res = u''
+    sc = True
+    for p in _ignore.split(content):
+        if p == SC_ON:
+            sc = True
+        elif p == SC_OFF:
+            sc = False
+        elif sc:
+            p = _spaces.sub(' ', p)
+            p = _between_tags1.sub('>', p)
+            p = _between_tags2.sub('<', p)
+            res += p
+        else:
+            res += p
+
+    return res
+
+def python_unsafe(text=''):
+    return _Unsafe(python_force_unicode(text))
+
+def python_websafe_compress(text=''):
+    text = python_space_compress(python_force_unicode(text))
+    return _Unsafe(python_websafe(text))
+
 try:
-    from Cfilters import uwebsafe as c_websafe, uspace_compress, \
+    import Cfilters
+    from Cfilters import uwebsafe as c_websafe, \
         uwebsafe_json as c_websafe_json
-    def spaceCompress(text):
-        try:
-            text = unicode(text, 'utf-8')
-        except TypeError:
-            text = unicode(text)
-        return uspace_compress(text)
-except ImportError:
-    c_websafe      = python_websafe
-    c_websafe_json = python_websafe_json
-    _between_tags1 = re.compile('> +')
-    _between_tags2 = re.compile(' +<')
-    _spaces = re.compile('[\s]+')
-    _ignore = re.compile('(' + SC_OFF + '|' + SC_ON + ')', re.S | re.I)
-    def spaceCompress(content):
-        res = ''
-        sc = True
-        for p in _ignore.split(content):
-            if p == SC_ON:
-                sc = True
-            elif p == SC_OFF:
-                sc = False
-            elif sc:
-                p = _spaces.sub(' ', p)
-                p = _between_tags1.sub('>', p)
-                p = _between_tags2.sub('<', p)
-                res += p
-            else:
-                res += p
-
-        return res
+    #these take any string, and decode it as _force_unicode does
+    Cfilters.set_unsafe_type(_Unsafe)
+    _force_unicode   = Cfilters.force_unicode
+    unsafe           = Cfilters.unsafe
+    spaceCompress    = Cfilters.space_compress
+    websafe_json     = Cfilters.websafe_json
+    websafe_compress = Cfilters.websafe_compress
+except (ImportError, AttributeError):
+    #AttributeError: an old build of Cfilters
+    Cfilters = None
+    c_websafe        = python_websafe
+    c_websafe_json   = python_websafe_json
+    _force_unicode   = python_force_unicode
+    unsafe           = python_unsafe
+    websafe_compress = python_websafe_compress
 
-class _Unsafe(unicode): pass
+    def spaceCompress(text):
+        return python_space_compress(_force_unicode(text))
 
-def _force_unicode(text):
-    try:
-        text = unicode(text, 'utf-8')
-    except UnicodeDecodeError:
-        text = unicode(text, 'latin1')
-    except TypeError:
-        text = unicode(text)
-    return text
+    def websafe_json(text=""):
+        return c_websafe_json(_force_unicode(text))
 
 def _force_utf8(text):
     return str(_force_unicode(text).encode('utf8'))
 
-def unsafe(text=''):
-    return _Unsafe(_force_unicode(text))
-
-def websafe_json(text=""):
-    return c_websafe_json(_force_unicode(text))
-
 def mako_websafe(text = ''):
     if text.__class__ == _Unsafe:
         return text
@@ -180,3 +195,19 @@ def keep_space(text):
 
 def unkeep_space(text):
     return text.replace('&#32;', ' ').replace('&#10;', '\n').replace('&#09;', '\t')
+
+
+def _native_pairs():
+    """(name, python version, Cfilters version) of each filter"""
+    if not Cfilters:
+        raise ImportError("Cfilters isn't built")
+    return [('_force_unicode', python_force_unicode, Cfilters.force_unicode),
+            ('unsafe', python_unsafe, Cfilters.unsafe),
+            ('spaceCompress',
+             lambda t: python_space_compress(python_force_unicode(t)),
+             Cfilters.space_compress),
+            ('websafe_json',
+             lambda t: python_websafe_json(python_force_unicode(t)),
+             Cfilters.websafe_json),
+            ('websafe_compress', python_websafe_compress,
+             Cfilters.websafe_compress)]
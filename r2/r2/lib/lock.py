@@ -21,19 +21,115 @@
 ################################################################################
 
 from __future__ import with_statement
-from time import sleep
+from time import sleep, time as now
 from datetime import datetime
-from threading import local
+from threading import local, Lock
+import os, random, re, socket, thread
+
+from pylons import g
+from r2.lib import metrics
 
 # thread-local storage for detection of recursive locks
 locks = local()
 
 class TimeoutExpired(Exception): pass
 
+# backoff between attempts to grab a lock: starts at BACKOFF_MIN,
+# doubles on each attempt up to BACKOFF_MAX, and is jittered by
+# +/-50% so that waiters don't retry in lockstep
+BACKOFF_MIN = .01
+BACKOFF_MAX = .25
+
+# waiters take a ticket and only try for the lock when the tickets
+# ahead of them have been served. a waiter that has waited this long
+# tries regardless, so that a waiter that died can't stall the queue
+FAIR_TIMEOUT = 2
+
+class LockStats(object):
+    """Wait and hold times for the locks with a given prefix, in
+    seconds"""
+    def __init__(self):
+        self.acquired = 0
+        self.timeouts = 0
+        self.contended = 0
+        self.wait_total = 0.
+        self.wait_max = 0.
+        self.hold_total = 0.
+        self.hold_max = 0.
+
+    def add_wait(self, wait, contended):
+        self.acquired += 1
+        if contended:
+            self.contended += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def add_timeout(self):
+        self.timeouts += 1
+
+    def add_hold(self, hold):
+        self.hold_total += hold
+        self.hold_max = max(self.hold_max, hold)
+
+    def __repr__(self):
+        return ('<LockStats acquired=%d contended=%d timeouts=%d '
+                'wait_max=%.3f hold_max=%.3f>' %
+                (self.acquired, self.contended, self.timeouts,
+                 self.wait_max, self.hold_max))
+
+# prefix -> LockStats for this process
+_stats = {}
+_stats_lock = Lock()
+
+prefix_re = re.compile(r'^[a-z]+(?:_[a-z]+(?=[_(]|$))?', re.I)
+def lock_prefix(key):
+    """The part of the lock key that names the kind of lock, without
+    the thing it is locking ('commit_t3_1a' -> 'commit',
+    'vote_lock(1a,2b)' -> 'vote_lock')"""
+    m = prefix_re.match(key)
+    return m.group(0) if m else key
+
+def _record(key, fn):
+    prefix = lock_prefix(key)
+    with _stats_lock:
+        fn(_stats.setdefault(prefix, LockStats()))
+
+def lock_stats():
+    """Returns a copy of the lock metrics of this process, as a dict
+    of prefix -> LockStats"""
+    with _stats_lock:
+        res = {}
+        for prefix, s in _stats.iteritems():
+            res[prefix] = copy_stats = LockStats()
+            copy_stats.__dict__.update(s.__dict__)
+        return res
+
+def collect_lock_stats():
+    """sets the metrics gauges for each kind of lock from lock_stats"""
+    for prefix, s in lock_stats().iteritems():
+        for stat in ('acquired', 'contended', 'timeouts',
+                     'wait_max', 'hold_max'):
+            metrics.gauge('lock.%s.%s' % (prefix, stat)).set(getattr(s, stat))
+metrics.add_collector(collect_lock_stats)
+
+def lock_owner(cache, key):
+    """Who holds the lock: 'host:pid:thread:time acquired', or None"""
+    return cache.get(key)
+
 class MemcacheLock(object):
     """A simple global lock based on the memcache 'add' command. We
     attempt to grab a lock by 'adding' the lock name. If the response
-    is True, we have the lock. If it's False, someone else has it."""
+    is True, we have the lock. If it's False, someone else has it.
+
+    The value added is a token naming the owner, so that only the
+    owner releases the lock, and so that renew() can extend the lease
+    of a lock that is held for longer than `time`.
+
+    Our memcache client has no cas, so renew() and releasing check the
+    token and then set or delete it in two steps. If the lock expires
+    between the two, the set or delete hits the next owner's lock. That
+    needs a holder to overrun `time` to within a round trip, and
+    renewing well before then avoids it."""
 
     def __init__(self, key, cache, time = 30, timeout = 30):
         # get a thread-local set of locks that we own
@@ -44,33 +140,111 @@ class MemcacheLock(object):
         self.time = time
         self.timeout = timeout
         self.have_lock = False
+        self.token = None
+        self.acquired_at = None
+
+    def make_token(self):
+        return '%s:%d:%d:%s:%d' % (socket.gethostname(), os.getpid(),
+                                   thread.get_ident(),
+                                   datetime.now().isoformat(),
+                                   random.randint(0, 1 << 30))
+
+    def _ticket(self):
+        """Takes a place in the queue for the lock"""
+        queue_key = self.key + '_queue'
+        self.cache.add(queue_key, 0, time = self.timeout + self.time)
+        return self.cache.incr(queue_key)
+
+    def _served(self):
+        return int(self.cache.get(self.key + '_served') or 0)
+
+    def _serve(self, ticket):
+        """Marks our ticket as served so the next waiter can go"""
+        if ticket and ticket > self._served():
+            self.cache.set(self.key + '_served', ticket,
+                           time = self.timeout + self.time)
 
     def __enter__(self):
-        start = datetime.now()
+        start = now()
 
         #if this thread already has this lock, move on
         if self.key in self.locks:
             return
 
-        #try and fetch the lock, looping until it's available
-        while not self.cache.add(self.key, 1, time = self.time):
-            if (datetime.now() - start).seconds > self.timeout:
+        token = self.make_token()
+
+        #try once before queuing, which is all it takes when the lock
+        #isn't contended
+        got_lock = self.cache.add(self.key, token, time = self.time)
+        contended = not got_lock
+        ticket = None
+        attempt = 0
+        while not got_lock:
+            waited = now() - start
+            if waited > self.timeout:
+                #let the waiters behind us go
+                self._serve(ticket)
+                _record(self.key, LockStats.add_timeout)
                 raise TimeoutExpired
 
-            sleep(.1)
+            sleep(min(BACKOFF_MIN * 2 ** attempt, BACKOFF_MAX)
+                  * random.uniform(.5, 1.5))
+
+            if ticket is None:
+                ticket = self._ticket()
+
+            #only try when it's our turn, unless the queue has stalled.
+            #everyone keeps backing off, the head of the queue included,
+            #so a long hold doesn't turn into a stream of adds
+            if not ticket or waited > FAIR_TIMEOUT:
+                my_turn = True
+            else:
+                my_turn = ticket <= self._served() + 1
+            if my_turn:
+                got_lock = self.cache.add(self.key, token, time = self.time)
+            attempt += 1
+
+        self._serve(ticket)
+
+        self.token = token
+        self.acquired_at = now()
+        wait = self.acquired_at - start
+        _record(self.key, lambda s: s.add_wait(wait, contended))
 
         #tell this thread we have this lock so we can avoid deadlocks
         #of requests for the same lock in the same thread
         self.locks.add(self.key)
         self.have_lock = True
 
+    def renew(self, time = None):
+        """Extends the lock's lease for a holder that needs it for longer
+        than `time`. Returns whether we still held the lock."""
+        if not self.have_lock:
+            return False
+        if time is not None:
+            self.time = time
+        if self.cache.get(self.key) != self.token:
+            return False
+        self.cache.set(self.key, self.token, time = self.time)
+        return True
+
     def __exit__(self, type, value, tb):
         #only release the lock if we gained it in the first place
         if self.have_lock:
-            self.cache.delete(self.key)
+            hold = now() - self.acquired_at
+            _record(self.key, lambda s: s.add_hold(hold))
+
+            #don't release a lock that expired and was taken by
+            #someone else in the meantime
+            if self.cache.get(self.key) == self.token:
+                self.cache.delete(self.key)
+            else:
+                g.log.debug('lock %s expired after being held for %.2fs'
+                            % (self.key, hold))
             self.locks.remove(self.key)
+            self.have_lock = False
 
 def make_lock_factory(cache):
-    def factory(key):
-        return MemcacheLock(key, cache)
+    def factory(key, **kw):
+        return MemcacheLock(key, cache, **kw)
     return factory
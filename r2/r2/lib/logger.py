@@ -21,46 +21,231 @@
 ################################################################################
 from __future__ import with_statement
 import cPickle as pickle
-import os, shutil, time
+import os, shutil, time, struct, atexit, threading, weakref, fcntl
 from utils import Storage
 from datetime import datetime, timedelta
 
+#journal records are framed by their length so a torn write at the
+#end of the file can be told apart from a whole one
+record_header = struct.Struct('!I')
+
+def atomic_dump(fname, *objs):
+    """pickles objs into fname through a temporary file and a rename,
+    so the file is either the old one or the new one, whole"""
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp, 'wb') as handle:
+        for obj in objs:
+            pickle.dump(obj, handle, -1)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.rename(tmp, fname)
+
+class WithFileLock(object):
+    """Holds an exclusive lock, between processes, on file_name while
+    in the with block. It's taken with flock on a file next to it, as
+    file_name itself may be replaced by a rename."""
+    def __init__(self, file_name):
+        self.lock_file = file_name + ".lock"
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.lock_file, 'a')
+        fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, type, value, tb):
+        fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+        self.handle.close()
+        self.handle = None
+
+def file_id(fname):
+    "identifies the version of fname on disk, or None if there's none"
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+#LoggedSlots with updates waiting to be written, flushed at exit
+_unflushed = weakref.WeakKeyDictionary()
+
+def flush_all():
+    for slots in _unflushed.keys():
+        slots.flush()
+atexit.register(flush_all)
 
 class LoggedSlots(object):
+    """
+    Keeps the attributes named in __slots__ in logfile.
+
+    Assignments are coalesced and written at most every
+    flush_interval seconds (and at exit), as a record of the changed
+    slots appended to a journal next to logfile. Once the journal
+    passes max_journal bytes, the slots are snapshotted into logfile
+    (see dump_slots) and the journal is started over. Loading replays
+    the journal over the snapshot.
+
+    Several processes can write the same logfile: the journal and
+    snapshot are written under a WithFileLock, and a process picks up
+    the generation of a snapshot another has written before writing
+    itself. As when the whole file was rewritten on every assignment,
+    a snapshot holds its writer's values, so the last to snapshot wins.
+    """
+    flush_interval = 5
+    max_journal = 1 << 20
 
     def __init__(self, logfile, **kw):
         for k, v in kw.iteritems():
             super(LoggedSlots, self).__setattr__(k, v)
         self.__logfile = logfile
+        self.__lock = threading.RLock()
+        self.__changed = set()
+        self.__timer = None
+        self.__generation = 0
+        #the file_id of the snapshot __generation was read from
+        self.__snapshot = None
         self.load_slots()
         
     def __setattr__(self, k, v):
         super(LoggedSlots, self).__setattr__(k, v)
-        if k in self.__slots__:
-            self.dump_slots()
+        if k in self.__slots__ and self.__logfile:
+            with self.__lock:
+                self.__changed.add(k)
+                _unflushed[self] = True
+                if self.flush_interval <= 0:
+                    self.flush()
+                elif not self.__timer:
+                    self.__timer = threading.Timer(self.flush_interval,
+                                                   self.flush)
+                    self.__timer.setDaemon(True)
+                    self.__timer.start()
         
     def load_slots(self):
-        d = self._get_slots(self.__logfile)
+        d, self.__generation = self._read_slots(self.__logfile)
+        if self.__logfile:
+            self.__snapshot = file_id(self.__logfile)
         for k, v in d.iteritems():
             super(LoggedSlots, self).__setattr__(k, v)
+        #start a fresh journal, so nothing is appended after a record
+        #torn by a crash
+        if self.__logfile and os.path.exists(self.journal_file(self.__logfile)):
+            self.dump_slots()
+
+    def _slot_values(self, slots):
+        d = {}
+        for s in slots:
+            try:
+                d[s] = getattr(self, s)
+            except AttributeError:
+                continue
+        return d
+
+    def flush(self):
+        """Writes the slots changed since the last flush to the journal"""
+        with self.__lock:
+            if self.__timer:
+                self.__timer.cancel()
+                self.__timer = None
+            _unflushed.pop(self, None)
+            if not self.__changed:
+                return
+            changed, self.__changed = self.__changed, set()
+
+            journal = self.journal_file(self.__logfile)
+            with WithFileLock(self.__logfile):
+                if (not os.path.exists(self.__logfile) or
+                    (os.path.exists(journal) and
+                     os.path.getsize(journal) > self.max_journal)):
+                    return self._write_snapshot()
+
+                self._sync_generation()
+                record = pickle.dumps((self.__generation,
+                                       self._slot_values(changed)), -1)
+                with open(journal, 'ab') as handle:
+                    handle.write(record_header.pack(len(record)) + record)
+                    handle.flush()
+                    os.fsync(handle.fileno())
+
+    def _sync_generation(self):
+        """Takes the generation of the snapshot on disk if another
+        process has written it since this one last looked, so that the
+        records written next aren't skipped on replay. Called with the
+        file lock held"""
+        snapshot = file_id(self.__logfile)
+        if snapshot != self.__snapshot:
+            self.__generation = self._read_generation(self.__logfile)
+            self.__snapshot = snapshot
 
     def dump_slots(self):
+        """Snapshots every slot into logfile, replacing the journal"""
         if self.__logfile:
-            with WithWriteLock(self.__logfile) as handle:
-                d = {}
-                for s in self.__slots__:
-                    try:
-                        d[s] = getattr(self, s)
-                    except AttributeError:
-                        continue
-                pickle.dump(d, handle)
+            with self.__lock:
+                with WithFileLock(self.__logfile):
+                    self._write_snapshot()
+
+    def _write_snapshot(self):
+        "dump_slots, with both locks held"
+        self.__changed.clear()
+        #records left from before the snapshot are skipped on replay by
+        #their generation
+        self._sync_generation()
+        self.__generation += 1
+        atomic_dump(self.__logfile, self._slot_values(self.__slots__),
+                    self.__generation)
+        self.__snapshot = file_id(self.__logfile)
+        journal = self.journal_file(self.__logfile)
+        if os.path.exists(journal):
+            os.unlink(journal)
+
+    @staticmethod
+    def journal_file(file):
+        return file + ".journal"
 
     @classmethod
     def _get_slots(self, file):
+        return self._read_slots(file)[0]
+
+    @classmethod
+    def _read_generation(self, file):
+        "the generation of the snapshot in file"
         if os.path.exists(file):
-            with open(file) as handle:
-                return Storage(pickle.load(handle))
-        return Storage()
+            with open(file, 'rb') as handle:
+                pickle.load(handle)
+                try:
+                    return pickle.load(handle)
+                except EOFError:
+                    pass
+        return 0
+
+    @classmethod
+    def _read_slots(self, file):
+        """the slots in file, with the journal replayed, and the
+        generation of its snapshot"""
+        d = Storage()
+        generation = 0
+        if os.path.exists(file):
+            with open(file, 'rb') as handle:
+                d.update(pickle.load(handle))
+                try:
+                    generation = pickle.load(handle)
+                except EOFError:
+                    pass
+
+        journal = self.journal_file(file)
+        if os.path.exists(journal):
+            with open(journal, 'rb') as handle:
+                while True:
+                    head = handle.read(record_header.size)
+                    if len(head) < record_header.size:
+                        break
+                    length, = record_header.unpack(head)
+                    record = handle.read(length)
+                    if len(record) < length:
+                        break
+                    gen, changes = pickle.loads(record)
+                    if gen == generation:
+                        d.update(changes)
+        return d, generation
             
         
 
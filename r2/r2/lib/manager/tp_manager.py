@@ -19,6 +19,7 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
 import pylons, sha
 from mako.template import Template as mTemplate
 from mako.exceptions import TemplateLookupException
@@ -27,12 +28,20 @@ from r2.lib.filters import websafe, unsafe
 from r2.lib.utils import Storage
 
 import inspect, re, os
+import cPickle as pickle
 
 class tp_manager:
     def __init__(self, engine = 'mako', template_cls = mTemplate):
         self.templates = {}
         self.engine = engine
         self.Template = template_cls
+        # (class, style) -> template, once resolved
+        self.resolved = {}
+        # '/file' -> sha of every template file, from load_registry
+        self.files = None
+        # loads templates when there is no pylons.buffet to ask,
+        # e.g. at startup
+        self.loader = None
 
     def add(self, name, style, file = None):
         key = (name.lower(), style.lower())
@@ -46,11 +55,96 @@ class tp_manager:
         key = (name.lower(), style.lower())
         self.templates[key] = handler
 
+    def load_template(self, file, cache = True):
+        if self.loader:
+            _loader = self.loader
+        else:
+            _loader = pylons.buffet.engines[self.engine]['engine']
+        template = _loader.load_template(file)
+        # also store a hash for the template, unless it's being loaded
+        # fresh (template_debug), in which case Templated.cache_key
+        # must not find one
+        if cache and not hasattr(template, "hash"):
+            if self.files and file in self.files:
+                template.hash = self.files[file]
+            elif hasattr(template, "filename"):
+                with open(template.filename, 'r') as handle:
+                    template.hash = sha.new(handle.read()).hexdigest()
+        return template
+
+    def load_registry(self, dirs, path):
+        """
+        Indexes the template files in dirs, with their hashes, so that
+        get() doesn't have to look for the files or hash them. The
+        index is kept in path, and a file is only hashed again when
+        its mtime or size has changed. Returns the files that had.
+        """
+        try:
+            with open(path, 'rb') as handle:
+                old = pickle.load(handle)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            old = {}
+
+        files = {}
+        changed = []
+        for d in dirs:
+            for root, dirnames, fnames in os.walk(d):
+                for fname in fnames:
+                    if fname.startswith('.') or fname.endswith(('.py', '.pyc')):
+                        continue
+                    full = os.path.join(root, fname)
+                    name = '/' + os.path.relpath(full, d)
+                    # the first directory wins, as in the mako lookup
+                    if name in files:
+                        continue
+                    st = os.stat(full)
+                    stat = (st.st_mtime, st.st_size)
+                    entry = old.get(name)
+                    if not entry or entry[0] != stat:
+                        with open(full, 'rb') as handle:
+                            entry = (stat, sha.new(handle.read()).hexdigest())
+                        changed.append(name)
+                    files[name] = entry
+
+        if changed or len(old) != len(files):
+            try:
+                tmp = "%s.%d.tmp" % (path, os.getpid())
+                with open(tmp, 'wb') as handle:
+                    pickle.dump(files, handle, -1)
+                os.rename(tmp, path)
+            except (IOError, OSError):
+                pass
+
+        self.files = dict((name, h) for name, (stat, h) in files.iteritems())
+        return changed
+
+    def preload(self):
+        """Loads every top level template in the registry, which
+        compiles the ones that changed into mako's module directory
+        and imports the rest from it"""
+        for file in self.files:
+            name = file[1:]
+            if '/' in name or '.' not in name:
+                continue
+            name, style = name.rsplit('.', 1)
+            key = (name.lower(), style.lower())
+            current = self.templates.get(key, file)
+            if isinstance(current, basestring) and current == file:
+                try:
+                    self.templates[key] = self.load_template(file)
+                except Exception:
+                    # it'll fail again, and be reported, when used
+                    continue
+
     def get(self, thing, style, cache = True):
         if not isinstance(thing, type(object)):
             thing = thing.__class__
 
         style = style.lower()
+        if cache:
+            template = self.resolved.get((thing, style))
+            if template:
+                return template
         top_key = (thing.__name__.lower(), style)
 
         template = None
@@ -62,16 +156,16 @@ class tp_manager:
             if isinstance(self.templates[key], self.Template):
                 template = self.templates[key]
             else:
+                # skip what the registry knows isn't there
+                if (cache and self.files is not None and
+                    isinstance(self.templates[key], basestring) and
+                    self.templates[key] not in self.files):
+                    continue
                 try:
-                    _loader = pylons.buffet.engines[self.engine]['engine']
-                    template = _loader.load_template(self.templates[key])
+                    template = self.load_template(self.templates[key],
+                                                  cache)
                     if cache:
                         self.templates[key] = template
-                        # also store a hash for the template
-                        if (not hasattr(template, "hash") and
-                            hasattr(template, "filename")):
-                            with open(template.filename, 'r') as handle:
-                                template.hash = sha.new(handle.read()).hexdigest()
                         # cache also for the base class so
                         # introspection is not required on subsequent passes
                         if key != top_key:
@@ -82,5 +176,7 @@ class tp_manager:
 
         if not template or not isinstance(template, self.Template):
             raise AttributeError, ("template doesn't exist for %s" % str(top_key))
+        if cache:
+            self.resolved[(thing, style)] = template
         return template
 
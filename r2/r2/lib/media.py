@@ -19,38 +19,87 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
 
 from pylons import g, config
 
 from r2.models.link import Link
 from r2.lib import s3cp
 from r2.lib.utils import timeago, fetch_things2
-from r2.lib.utils import TimeoutFunction, TimeoutFunctionException
 from r2.lib.db.operators import desc
-from r2.lib.scraper import make_scraper, str_to_image, image_to_str, prepare_image
+from r2.lib.scraper import scrape, str_to_image, image_to_str, prepare_image
 from r2.lib import amqp
 
-import tempfile
+from Queue import Queue
+from threading import Thread, Condition, currentThread
+import os, socket, tempfile, time
 import traceback
+import StringIO
 
 s3_thumbnail_bucket = g.s3_thumb_bucket
 threads = 20
+#number of scraper_q messages to work on at once
+batch_size = 50
+#seconds before a single link is given up on
+link_timeout = 30
+#seconds before a single socket operation is given up on
+socket_timeout = 10
 log = g.log
 
+class S3Storage(object):
+    """Stores media in an s3 bucket"""
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def put(self, name, data, content_type):
+        s3cp.send_data(data, self.bucket + name, content_type, 'public-read')
+
+    def url(self, name):
+        return 'http:/%s%s' % (self.bucket, name)
+
+class LocalStorage(object):
+    """Stores media in a local directory (served from base_url), as a
+    stand-in for s3 when testing"""
+    def __init__(self, path, base_url):
+        self.path = path
+        self.base_url = base_url
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def put(self, name, data, content_type):
+        #write to a temporary file and rename it so that a half
+        #written file is never served
+        fd, tmp = tempfile.mkstemp(dir = self.path)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, os.path.join(self.path, name))
+
+    def url(self, name):
+        return self.base_url + name
+
+def get_storage():
+    """The storage backend for thumbnails: the local directory
+    media_fs_root if it is configured, s3 otherwise"""
+    path = getattr(g, 'media_fs_root', None)
+    if path:
+        return LocalStorage(path, getattr(g, 'media_fs_base_url', None) or '/')
+    return S3Storage(s3_thumbnail_bucket)
+
+storage = get_storage()
+
 def thumbnail_url(link):
     """Given a link, returns the url for its thumbnail based on its fullname"""
-    return 'http:/%s%s.png' % (s3_thumbnail_bucket, link._fullname)
-
+    return storage.url(link._fullname + '.png')
 
-def upload_thumb(link, image):
-    """Given a link and an image, uploads the image to s3 into an image
-    based on the link's fullname"""
-    f = tempfile.NamedTemporaryFile(suffix = '.png')
-    image.save(f)
 
-    resource = s3_thumbnail_bucket + link._fullname + '.png'
-    log.debug('uploading to s3: %s' % link._fullname)
-    s3cp.send_file(f.name, resource, 'image/png', 'public-read', None, False)
+def upload_thumb(link, data):
+    """Given a link and PNG data, uploads the image to the storage
+    backend into an image based on the link's fullname"""
+    log.debug('uploading thumbnail: %s' % link._fullname)
+    storage.put(link._fullname + '.png', data, 'image/png')
     log.debug('thumbnail %s: %s' % (link._fullname, thumbnail_url(link)))
 
 
@@ -74,10 +123,8 @@ def set_media(link, force = False):
     elif not force and (link.has_thumbnail or link.media_object):
         return
         
-    scraper = make_scraper(link.url)
-
-    thumbnail = scraper.thumbnail()
-    media_object = scraper.media_object()
+    #reposts of a url share the result of scraping it, unless forced
+    thumbnail, media_object = scrape(link.url, update = force)
 
     if thumbnail:
         upload_thumb(link, thumbnail)
@@ -87,26 +134,102 @@ def set_media(link, force = False):
 def force_thumbnail(link, image_data):
     image = str_to_image(image_data)
     image = prepare_image(image)
-    upload_thumb(link, image)
+    f = StringIO.StringIO()
+    image.save(f, 'PNG')
+    upload_thumb(link, f.getvalue())
     update_link(link, thumbnail = True, media_object = None)
 
-def run():
+class MediaWorkers(object):
+    """A fixed pool of long-lived threads running fn on the jobs given
+    to run_batch, so that each thread keeps its connection to s3
+    between links. A job that takes longer than timeout is given up
+    on: its thread is replaced, and exits when the job finally ends."""
+    global_env = g._current_obj()
+
+    def __init__(self, fn, num_workers = threads, timeout = link_timeout):
+        self.fn = fn
+        self.timeout = timeout
+        self.jobs = Queue()
+        self.cond = Condition()
+        #the number of jobs of the current batch not yet done
+        self.pending = 0
+        #thread -> when it started its job
+        self.busy = {}
+        self.abandoned = set()
+        for x in xrange(num_workers):
+            self.spawn()
+
+    def spawn(self):
+        t = Thread(target = self.work, args = (self.global_env,))
+        t.setDaemon(True)
+        t.start()
+
+    def work(self, global_env):
+        # make sure that pylons.g is available for the worker thread
+        g._push_object(global_env)
+        me = currentThread()
+        try:
+            while True:
+                job = self.jobs.get()
+                with self.cond:
+                    self.busy[me] = time.time()
+                try:
+                    self.fn(job)
+                except:
+                    print traceback.format_exc()
+                with self.cond:
+                    del self.busy[me]
+                    if me in self.abandoned:
+                        self.abandoned.remove(me)
+                        return
+                    self.pending -= 1
+                    self.cond.notifyAll()
+        finally:
+            s3cp.close_connection()
+            g._pop_object()
+
+    def run_batch(self, jobs):
+        """Runs the jobs and waits until each has finished or been
+        given up on"""
+        with self.cond:
+            self.pending += len(jobs)
+        for job in jobs:
+            self.jobs.put(job)
+
+        with self.cond:
+            while self.pending:
+                now = time.time()
+                for t, start in self.busy.items():
+                    if t not in self.abandoned and now - start > self.timeout:
+                        log.error('media: giving up on a job after %ds'
+                                  % self.timeout)
+                        self.abandoned.add(t)
+                        self.pending -= 1
+                        self.spawn()
+                if self.pending:
+                    self.cond.wait(1)
+
+def process_link(fname):
+    print "media: Processing %s" % fname
+    try:
+        link = Link._by_fullname(fname, data=True, return_dict=False)
+        set_media(link)
+    except:
+        print "Error fetching %s" % fname
+        print traceback.format_exc()
+
+def run(num_workers = threads, limit = batch_size):
+    """Processes scraper_q with a pool of num_workers threads. The
+    fetches are limited per domain in scraper.fetch_url, so one slow
+    host only holds up the workers fetching from it."""
+    socket.setdefaulttimeout(socket_timeout)
+
+    #the timeout is enforced by the pool rather than with signals,
+    #which only work in the main thread
+    workers = MediaWorkers(process_link, num_workers = num_workers,
+                           timeout = link_timeout)
+
     def process_msgs(msgs):
-        def _process_link(fname):
-            print "media: Processing %s" % fname
-
-            link = Link._by_fullname(fname, data=True, return_dict=False)
-            set_media(link)
-        for msg in msgs:
-            fname = msg.body
-            try:
-                TimeoutFunction(_process_link, 30)(fname)
-            except TimeoutFunctionException:
-                print "Timed out on %s" % fname
-            except KeyboardInterrupt:
-                raise
-            except:
-                print "Error fetching %s" % fname
-                print traceback.format_exc()
-
-    amqp.handle_items('scraper_q', process_msgs, limit=1)
+        workers.run_batch([msg.body for msg in msgs])
+
+    amqp.handle_items('scraper_q', process_msgs, limit=limit)
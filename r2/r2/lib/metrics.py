@@ -0,0 +1,351 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Counters, gauges and histograms kept per process in ring buffers of
+num_slots slots of resolution seconds each.
+
+Each process publishes a snapshot of its metrics, as json, into
+metrics_dir every publish_interval seconds, from whichever thread
+records a metric first after that. host_snapshot merges the snapshots
+of the live processes on the host. metrics_dir is set from the app's
+cache_dir when it's loaded; until then nothing is published. Only a
+directory that belongs to this user and no one else can get into is
+used.
+
+Recording is a dict lookup and an add, with a lock taken only when a
+series moves on to a new slot. Increments that race between threads
+can rarely be lost, which is the price of not locking them.
+"""
+from __future__ import with_statement
+import os, time, errno, bisect, stat, threading
+import simplejson
+
+#seconds covered by each slot, and the number of slots kept
+resolution = 10
+num_slots = 60
+#where processes publish their snapshots, and how often
+metrics_dir = None
+publish_interval = resolution
+
+#upper bounds of the default histogram buckets: 1ms to 32s, doubling
+default_buckets = tuple(.001 * 2 ** i for i in xrange(16))
+
+def now_slot():
+    return int(time.time()) // resolution
+
+class Series(object):
+    """A ring buffer of num_slots values, the newest for self.slot"""
+    kind = None
+
+    def __init__(self, name):
+        self.name = name
+        self.slot = now_slot()
+        self.values = [self.empty() for x in xrange(num_slots)]
+        self.lock = threading.Lock()
+
+    def empty(self):
+        raise NotImplementedError
+
+    def rotate(self, slot):
+        """Moves the newest slot up to slot, clearing those skipped"""
+        with self.lock:
+            if slot > self.slot:
+                for s in xrange(max(self.slot + 1, slot - num_slots + 1),
+                                slot + 1):
+                    self.values[s % num_slots] = self.empty()
+                self.slot = slot
+
+    def current(self):
+        """the index of the slot for now"""
+        slot = now_slot()
+        if slot != self.slot:
+            self.rotate(slot)
+            registry.maybe_publish()
+        return slot % num_slots
+
+    def window(self):
+        """the values from oldest to newest"""
+        i = self.slot % num_slots + 1
+        return self.values[i:] + self.values[:i]
+
+    def snapshot(self):
+        self.rotate(now_slot())
+        return (self.kind, self.slot, self.window(), None)
+
+    @staticmethod
+    def merge(a, b):
+        raise NotImplementedError
+
+class Counter(Series):
+    kind = 'counter'
+
+    def empty(self):
+        return 0
+
+    def incr(self, n = 1):
+        self.values[self.current()] += n
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+class Gauge(Series):
+    """The last value set in each slot. Across processes, the largest
+    is kept."""
+    kind = 'gauge'
+
+    def empty(self):
+        return None
+
+    def set(self, value):
+        self.values[self.current()] = value
+
+    @staticmethod
+    def merge(a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return max(a, b)
+
+class Histogram(Series):
+    """Counts of the values observed in each slot by the bucket they
+    fall in, followed by their sum"""
+    kind = 'histogram'
+
+    def __init__(self, name, buckets = default_buckets):
+        self.buckets = tuple(buckets)
+        Series.__init__(self, name)
+
+    def empty(self):
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value):
+        counts = self.values[self.current()]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def timer(self):
+        return Timer(self)
+
+    def snapshot(self):
+        self.rotate(now_slot())
+        return (self.kind, self.slot, [list(x) for x in self.window()],
+                list(self.buckets))
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+class Timer(object):
+    """with histogram.timer(): observes the seconds the block took"""
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, type, value, tb):
+        self.histogram.observe(time.time() - self.start)
+
+kinds = dict((cls.kind, cls) for cls in (Counter, Gauge, Histogram))
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.publish_lock = threading.Lock()
+        self.last_publish = time.time()
+        self.collectors = []
+
+    def get(self, cls, name, *a):
+        m = self.metrics.get(name)
+        if m is None:
+            with self.lock:
+                m = self.metrics.get(name)
+                if m is None:
+                    m = self.metrics[name] = cls(name, *a)
+        if not isinstance(m, cls):
+            raise TypeError("%s is a %s" % (name, m.kind))
+        return m
+
+    def counter(self, name):
+        return self.get(Counter, name)
+
+    def gauge(self, name):
+        return self.get(Gauge, name)
+
+    def histogram(self, name, buckets = default_buckets):
+        return self.get(Histogram, name, buckets)
+
+    def add_collector(self, fn):
+        """fn is called before each snapshot, to set gauges from state
+        that isn't recorded as it changes"""
+        self.collectors.append(fn)
+
+    def snapshot(self):
+        """name -> (kind, newest slot, values, buckets) for this process"""
+        for fn in self.collectors:
+            try:
+                fn()
+            except Exception:
+                pass
+        return dict((name, m.snapshot())
+                    for name, m in self.metrics.items())
+
+    def maybe_publish(self):
+        if (time.time() - self.last_publish >= publish_interval
+            and self.publish_lock.acquire(False)):
+            try:
+                self.last_publish = time.time()
+                self.publish()
+            except (IOError, OSError):
+                pass
+            finally:
+                self.publish_lock.release()
+
+    def publish(self):
+        if not metrics_dir:
+            return
+        if not os.path.isdir(metrics_dir):
+            os.makedirs(metrics_dir, 0700)
+        if not private(metrics_dir):
+            return
+        fname = os.path.join(metrics_dir, str(os.getpid()))
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as handle:
+            simplejson.dump(self.snapshot(), handle)
+        os.rename(tmp, fname)
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+add_collector = registry.add_collector
+
+def merge(snapshots):
+    """Merges snapshots of different processes, aligning their slots on
+    the newest among them"""
+    res = {}
+    for snapshot in snapshots:
+        for name, (kind, slot, values, buckets) in snapshot.iteritems():
+            if name not in res:
+                res[name] = (kind, slot, values, buckets)
+                continue
+            kind2, slot2, values2, buckets2 = res[name]
+            if kind2 != kind or buckets2 != buckets:
+                continue
+            if slot > slot2:
+                slot, slot2 = slot2, slot
+                values, values2 = values2, values
+            shift = slot2 - slot
+            fn = kinds[kind].merge
+            merged = list(values2)
+            for i in xrange(shift, num_slots):
+                merged[i - shift] = fn(merged[i - shift], values[i])
+            res[name] = (kind, slot2, merged, buckets)
+    return res
+
+def private(path):
+    """whether path belongs to this user, and (if it's a directory) no
+    one else can read or write in it"""
+    st = os.lstat(path)
+    if st.st_uid != os.getuid():
+        return False
+    if stat.S_ISDIR(st.st_mode):
+        return not st.st_mode & 077
+    return stat.S_ISREG(st.st_mode)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+def host_snapshot():
+    """The metrics of every process on the host, merged. This process's
+    are current; the others' are as of their last publish. Snapshots
+    of dead processes are cleaned up."""
+    snapshots = [registry.snapshot()]
+    try:
+        if metrics_dir and private(metrics_dir):
+            fnames = os.listdir(metrics_dir)
+        else:
+            fnames = []
+    except OSError:
+        fnames = []
+    for fname in fnames:
+        if not fname.isdigit() or int(fname) == os.getpid():
+            continue
+        path = os.path.join(metrics_dir, fname)
+        try:
+            if not process_alive(int(fname)):
+                os.unlink(path)
+                continue
+            if not private(path):
+                continue
+            with open(path, 'rb') as handle:
+                snapshots.append(simplejson.load(handle))
+        except (IOError, OSError, ValueError):
+            continue
+    return merge(snapshots)
+
+def percentile(counts, buckets, q):
+    """Estimates the q quantile of the values in counts, a histogram's
+    bucket counts, as the upper bound of its bucket. It's None if there
+    are no values, or if it's past the largest bucket, which has no
+    upper bound (and json has no infinity)"""
+    total = sum(counts[:-1])
+    if not total:
+        return None
+    seen = 0
+    for i, n in enumerate(counts[:-1]):
+        seen += n
+        if seen >= q * total:
+            return buckets[i] if i < len(buckets) else None
+
+def report(snapshot, summary_slots = 6):
+    """Makes snapshot json-able: each metric's series of values, plus a
+    summary of its last summary_slots slots: the rate per second of
+    counters, the last value of gauges and the count, mean and
+    percentiles of histograms."""
+    res = {}
+    for name, (kind, slot, values, buckets) in snapshot.iteritems():
+        r = dict(kind = kind, resolution = resolution,
+                 start = (slot - num_slots + 1) * resolution,
+                 values = values)
+        recent = values[-summary_slots:]
+        if kind == 'counter':
+            r['rate'] = float(sum(recent)) / (summary_slots * resolution)
+        elif kind == 'gauge':
+            r['last'] = ([x for x in values if x is not None] or [None])[-1]
+        elif kind == 'histogram':
+            r['buckets'] = buckets
+            counts = reduce(Histogram.merge, recent)
+            n = sum(counts[:-1])
+            r['count'] = n
+            r['mean'] = counts[-1] / n if n else None
+            for q in (.5, .9, .99):
+                r['p%d' % (q * 100)] = percentile(counts, buckets, q)
+        res[name] = r
+    return res
@@ -33,7 +33,7 @@ from pylons import c, request, g
 from pylons.controllers.util import abort
 
 from r2.lib import promote
-from r2.lib.traffic import load_traffic, load_summary
+from r2.lib.traffic import load_traffic, load_traffic_many, load_summary
 from r2.lib.captcha import get_iden
 from r2.lib.filters import spaceCompress, _force_unicode, _force_utf8, unsafe, websafe
 from r2.lib.menus import NavButton, NamedButton, NavMenu, PageNameNav, JsButton
@@ -1779,13 +1779,13 @@ class PromotedTraffic(Traffic):
         # the results are preliminary until 1 day after the promotion ends
         self.preliminary = (until + datetime.timedelta(1) > now)
 
-        self.traffic = load_traffic('hour', "thing", thing._fullname,
-                                    start_time = d, stop_time = until)
+        self.traffic, month, day = load_traffic_many(
+            [('hour', "thing", thing._fullname, d, until),
+             ('month', "thing", thing._fullname),
+             ('day', "thing", thing._fullname)])
 
         # load monthly totals if we have them, otherwise use the daily totals
-        self.totals =  load_traffic('month', "thing", thing._fullname)
-        if not self.totals:
-            self.totals = load_traffic('day', "thing", thing._fullname)
+        self.totals = month or day
         # generate a list of
         # (uniq impressions, # impressions, uniq clicks, # clicks)
         if self.totals:
@@ -1857,11 +1857,12 @@ class RedditTraffic(Traffic):
         if c.default_sr:
             ivals.append("month")
 
-        for ival in ivals:
-            if c.default_sr:
-                data = load_traffic(ival, "total", "")
-            else:
-                data = load_traffic(ival, "reddit", c.site.name)
+        if c.default_sr:
+            series = [(ival, "total", "") for ival in ivals]
+        else:
+            series = [(ival, "reddit", c.site.name) for ival in ivals]
+
+        for ival, data in zip(ivals, load_traffic_many(series)):
             if not data:
                 break
             slices = [("uniques",     (0, 2) if c.site.domain else (0,),
@@ -0,0 +1,201 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""Opaque cursors for paging through listings.
+
+A cursor records the fullname of the item a page starts after, its
+position in the listing (when the builder knows it) and the values of
+the listing's sort columns for that item. Builders use whichever of
+those they can to seek to the page directly: IDBuilder jumps to the
+position, QueryBuilder adds the sort values to its query and
+SearchBuilder asks solr for the rows from the position on. Cursors
+that were made from a plain fullname (old links and api clients) fall
+back to loading the thing."""
+
+from pylons import g
+from r2.lib.db.sorts import epoch_seconds
+
+from datetime import datetime, timedelta
+import base64, re
+import simplejson
+
+fullname_re = re.compile(r'^[rt][0-9a-z]+_[0-9a-z]+$')
+
+#bounds on the sort values a cursor can carry. they come from the
+#client, so anything outside them is treated as a tampered cursor
+max_sort_number = 2 ** 63
+max_sort_date = 253402300799 # the end of 9999
+max_sort_string = 1000
+
+def to_sort_value(value):
+    if isinstance(value, datetime):
+        return epoch_seconds(value)
+    return value
+
+def from_sort_value(col, value):
+    if col.endswith('_date'):
+        return (datetime(1970, 1, 1, tzinfo = g.tz)
+                + timedelta(seconds = value))
+    return value
+
+class Cursor(object):
+    def __init__(self, fullname, position = None, sort_values = None):
+        self.fullname = fullname
+        self.position = position
+        self.sort_values = sort_values or {}
+        self._thing = None
+
+    @classmethod
+    def from_item(cls, item, position = None, sort_cols = ()):
+        sort_values = {}
+        for col in sort_cols:
+            try:
+                sort_values[col] = to_sort_value(getattr(item, col))
+            except AttributeError:
+                pass
+        return cls(item._fullname, position, sort_values)
+
+    @property
+    def _fullname(self):
+        return self.fullname
+
+    @property
+    def thing(self):
+        from r2.lib.db.thing import Thing
+        if self._thing is None:
+            self._thing = Thing._by_fullname(self.fullname, data = True)
+        return self._thing
+
+    def valid(self):
+        """Whether the sort values are ones a listing could have made:
+        finite numbers in range (dates within what datetime can hold)
+        or short strings"""
+        for col, value in self.sort_values.iteritems():
+            if isinstance(value, basestring):
+                if col.endswith('_date') or len(value) > max_sort_string:
+                    return False
+            elif value != value or abs(value) >= max_sort_number:
+                #nan and inf
+                return False
+            elif col.endswith('_date') and not 0 <= value <= max_sort_date:
+                return False
+        return True
+
+    def has_sort(self, cols):
+        return all(col in self.sort_values for col in cols)
+
+    def __getattr__(self, attr):
+        """The sort values stand in for the thing's own attributes;
+        anything else is looked up on the thing, which is loaded on
+        first use"""
+        if attr.startswith('__'):
+            raise AttributeError, attr
+        sort_values = self.__dict__.get('sort_values', {})
+        if attr in sort_values:
+            return from_sort_value(attr, sort_values[attr])
+        return getattr(self.thing, attr)
+
+    def encode(self):
+        s = simplejson.dumps([self.fullname, self.position,
+                              self.sort_values])
+        return base64.urlsafe_b64encode(s).rstrip('=')
+
+    @classmethod
+    def decode(cls, token):
+        """Returns the Cursor for token, or None if it isn't one."""
+        try:
+            s = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+            fullname, position, sort_values = simplejson.loads(s)
+        except (TypeError, ValueError, UnicodeError):
+            return None
+
+        if (not isinstance(fullname, basestring)
+            or not fullname_re.match(fullname)
+            or not (position is None or isinstance(position, int))
+            or not isinstance(sort_values, dict)):
+            return None
+        for v in sort_values.itervalues():
+            if not isinstance(v, (int, long, float, basestring)):
+                return None
+
+        return cls(str(fullname), position,
+                   dict((str(k), v) for k, v in sort_values.iteritems()))
+
+    def __repr__(self):
+        return '<Cursor %s %s>' % (self.fullname, self.position)
+
+def make_cursor(after):
+    """Turns whatever a listing was given as its after/before (a
+    Cursor, a Thing or nothing) into a Cursor"""
+    if after is None or isinstance(after, Cursor):
+        return after
+    cursor = Cursor(after._fullname)
+    cursor._thing = after
+    return cursor
+
+class SortStub(object):
+    """Enough of a thing for Query._after to build its rules from a
+    cursor's sort values, without loading the thing"""
+    def __init__(self, kind, cursor, cols):
+        self.c = kind.c
+        for col in cols:
+            setattr(self, col, getattr(cursor, col))
+
+def cursor_index(names, cursor, data = None, sort = ()):
+    """Finds the index of the cursor's item in the list of fullnames.
+    The cursor's position is tried first. If the names are from
+    precomputed results (data is the list of (fullname, *sort_cols)
+    tuples and sort the query's sort), the sort values are then used to
+    binary search for it. Otherwise fall back to a scan."""
+    pos = cursor.position
+    if pos is not None and 0 <= pos < len(names) and names[pos] == cursor.fullname:
+        return pos
+
+    cols = [s.col for s in sort]
+    if data is not None and len(data) == len(names) and cursor.has_sort(cols):
+        from r2.lib.db.operators import asc
+        key = [cursor.sort_values[col] for col in cols]
+        def before(t):
+            #whether the tuple t sorts before the cursor
+            for i, s in enumerate(sort):
+                if t[i + 1] != key[i]:
+                    return ((t[i + 1] < key[i]) if isinstance(s, asc)
+                            else (t[i + 1] > key[i]))
+            return False
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if before(data[mid]):
+                lo = mid + 1
+            else:
+                hi = mid
+        #items can share sort values, so check the run of equal ones
+        while lo < len(data) and not before(data[lo]):
+            if data[lo][0] == cursor.fullname:
+                return lo
+            if [data[lo][i + 1] for i in range(len(cols))] != key:
+                break
+            lo += 1
+
+    try:
+        return names.index(cursor.fullname)
+    except ValueError:
+        return None
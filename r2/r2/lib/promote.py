@@ -368,13 +368,22 @@ def promote_promoted(test = False):
     'finished' and find all pending promotions that are supposed to be
     promoted and promote them.
     """
-    from r2.lib.traffic import load_traffic
+    from r2.lib.traffic import load_traffic_many
     with g.make_lock(promoted_lock_key):
         now = promo_datetime_now()
 
         promoted =  Link._by_fullname(get_promoted_direct().keys(),
                                       data = True, return_dict = False)
         promos = {}
+
+        # grab the traffic of every capped promotion at once
+        capped = [l for l in promoted
+                  if (getattr(l, "maximum_clicks", None) or
+                      getattr(l, "maximum_views", None))]
+        traffics = load_traffic_many([("day", "thing", l._fullname)
+                                      for l in capped])
+        traffics = dict(zip([l._fullname for l in capped], traffics))
+
         for l in promoted:
             keep = True
             if l.promote_until < now:
@@ -382,8 +391,7 @@ def promote_promoted(test = False):
             maximum_clicks = getattr(l, "maximum_clicks", None)
             maximum_views = getattr(l, "maximum_views", None)
             if maximum_clicks or maximum_views:
-                # grab the traffic
-                traffic = load_traffic("day", "thing", l._fullname)
+                traffic = traffics[l._fullname]
                 if traffic:
                     # (unique impressions, number impressions, 
                     #  unique clicks, number of clicks)
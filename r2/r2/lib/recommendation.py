@@ -19,10 +19,15 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
+
 from pylons import g, c
 from r2.models import *
 from r2.lib.utils import to36
 from datetime import datetime, timedelta
+from array import array
+import struct, heapq, math, os
+import cPickle as pickle
 
 from r2.lib.db import tdb_sql as tdb
 import sqlalchemy as sa
@@ -31,58 +36,223 @@ import sqlalchemy as sa
 def sgn(x):
     return 1 if x > 0 else 0 if x == 0 else -1
 
-def get_recommended(userid, age = 2, sort='relevance', num_users=10):
-    u = get_users_for_user(userid)[:num_users]
-    if not u: return []
+#the co-vote model: for each link, the links most liked by the same
+#people, stored in rec_cache as a recommendation record (see
+#decode_record) of link ids and similarities
+model_prefix = 'covote_'
+#neighbours kept per link
+model_size = 50
+#only a user's most recent likes are paired with new ones
+max_user_likes = 100
+#neighbours kept in rec_cache for a week after their last refresh
+model_time = 7 * 86400
 
+def vote_table():
     voter = Vote.rels[(Account, Link)]
+    return tdb.get_rel_table(voter._type_id)[0]
+
+def recent_likes(userid, age, limit = max_user_likes):
+    "ids of the links userid liked in the last `age` days, newest first"
+    votes = vote_table()
+    res = sa.select([votes.c.thing2_id],
+                    sa.and_(votes.c.thing1_id == userid,
+                            votes.c.name == '1',
+                            votes.c.date > datetime.now(g.tz) - timedelta(age)),
+                    order_by = sa.desc(votes.c.date),
+                    limit = limit).execute()
+    return [x for x, in res.fetchall()]
 
-    tables = tdb.get_rel_type_table(voter._type_id)
-    votertable = tables[0]
-    acct_col = votertable.c.thing1_id
-    link_col = votertable.c.thing2_id
-    date_col = votertable.c.date
-    count = sa.func.count(acct_col)
+def get_recommended(userid, age = 2, sort='relevance', num = 200):
+    """Links liked by people who liked the links userid liked in the
+    last `age` days, from the co-vote model. The links are at most
+    `age` days old"""
+    liked = recent_likes(userid, age)
+    if not liked: return []
 
-    linktable = tables[2]
-#    dlinktable, linktable = tdb.types_id[Link._type_id].data_table
-    link_id_col = linktable.c.thing_id
+    records = g.rec_cache.get_multi(liked, prefix = model_prefix)
+    scores = {}
+    for record in records.itervalues():
+        keys, values = decode_record(record)
+        for k, v in zip(keys, values):
+            scores[k] = scores.get(k, 0) + v
+    for l in liked:
+        scores.pop(l, None)
 
-    query = [sa.or_(*[acct_col == x for x in u]),
-             date_col > datetime.now(g.tz)-timedelta(age)]
-    cols = [link_col, count]
+    best = heapq.nlargest(num * 2, scores.iteritems(), key = lambda x: x[1])
+    links = Link._byID([k for k, v in best], return_dict = True)
+    oldest = datetime.now(g.tz) - timedelta(age)
+    links = [links[k] for k, v in best
+             if k in links and links[k]._date > oldest][:num]
 
     if sort == 'new':
-        sort = 'date'
+        links.sort(key = lambda l: l._date, reverse = True)
     elif sort == 'top':
-        sort = 'score'
+        links.sort(key = lambda l: l._score, reverse = True)
+
+    return [l._fullname for l in links]
+
+class CoVoteModel(object):
+    """Counts, for every pair of links, how many people liked both,
+    from a stream of likes. Kept as a local pickle between runs of
+    build_covote_model and refresh_covote_model.
+
+    Only each account's max_user_likes most recent likes are counted,
+    and the counts are always those of the likes kept: a like that is
+    pushed out by newer ones, expired or retracted is taken back out
+    of them."""
+    #bumped when the pickled state changes, so old pickles are rebuilt
+    version = 2
+
+    def __init__(self):
+        #account id -> [link id, date] of its most recent likes,
+        #oldest first
+        self.likes = {}
+        #link id -> number of people who liked it
+        self.counts = {}
+        #link id -> {link id: number of people who liked both}
+        self.pairs = {}
+        #the date of the newest vote read
+        self.last_date = None
+        #links whose neighbours have changed since the last publish
+        self.touched = set()
+
+    def add_like(self, account_id, link_id, date):
+        likes = self.likes.setdefault(account_id, [])
+        if any(l == link_id for l, d in likes):
+            return
+
+        for other, d in likes:
+            for a, b in ((link_id, other), (other, link_id)):
+                p = self.pairs.setdefault(a, {})
+                p[b] = p.get(b, 0) + 1
+            self.touched.add(other)
+        self.touched.add(link_id)
+
+        self.counts[link_id] = self.counts.get(link_id, 0) + 1
+        likes.append([link_id, date])
+        if len(likes) > max_user_likes:
+            self._remove(account_id, 0)
+
+    def remove_like(self, account_id, link_id):
+        "takes back a like, e.g. when the vote has been changed"
+        for i, (l, d) in enumerate(self.likes.get(account_id, ())):
+            if l == link_id:
+                return self._remove(account_id, i)
+
+    def _remove(self, account_id, i):
+        likes = self.likes[account_id]
+        link_id, date = likes.pop(i)
+        if not likes:
+            del self.likes[account_id]
+
+        for other, d in likes:
+            for a, b in ((link_id, other), (other, link_id)):
+                p = self.pairs[a]
+                p[b] -= 1
+                if not p[b]:
+                    del p[b]
+                    #links with no pairs left aren't kept
+                    if not p:
+                        del self.pairs[a]
+            self.touched.add(other)
+        self.touched.add(link_id)
+
+        self.counts[link_id] -= 1
+        if not self.counts[link_id]:
+            del self.counts[link_id]
+
+    def expire(self, before):
+        "removes the likes from before `before`"
+        for account_id in self.likes.keys():
+            while (account_id in self.likes and
+                   self.likes[account_id][0][1] < before):
+                self._remove(account_id, 0)
 
-    if sort and sort != 'relevance':
-        query.append(link_id_col == link_col)
-        s = tdb.translate_sort(linktable, sort)
-        order = [sa.desc(s), sa.desc(link_id_col)]
-        cols = [link_id_col, count]
-        group_by = [link_id_col, s]
-    else:
-        order = [sa.desc(count), sa.desc(link_col)]
-        group_by = link_col
+    def neighbours(self, link_id, num = model_size):
+        "the num links most similar to link_id, as (id, cosine similarity)"
+        count = self.counts.get(link_id)
+        if not count:
+            return []
+        sims = ((other, co / math.sqrt(count * self.counts[other]))
+                for other, co in self.pairs.get(link_id, {}).iteritems())
+        return heapq.nlargest(num, sims, key = lambda x: x[1])
 
-#    #TODO: wish I could just use query_rules
-#    if c.user and c.user.subreddits:
-#        query.append(dlinktable.c.thing_id == linktable.c.thing_id)
-#        q = sa.and_(dlinktable.c.key == 'sr_id',
-#                    sa.or_(*[dlinktable.c.value == x
-#                             for x in c.user.subreddits]))
-#        query.append(q)
+    def publish(self):
+        """writes the neighbours of the touched links to rec_cache (which
+        is none for those no one likes any more)"""
+        touched, self.touched = list(self.touched), set()
+        for i in xrange(0, len(touched), 1000):
+            records = {}
+            for link_id in touched[i:i + 1000]:
+                n = self.neighbours(link_id)
+                records[link_id] = encode_record([k for k, v in n],
+                                                 [v for k, v in n])
+            g.rec_cache.set_multi(records, prefix = model_prefix,
+                                  time = model_time)
+        return len(touched)
 
-    res = sa.select(cols, sa.and_(*query),
-                    group_by=group_by,
-                    order_by=order).execute()
+    def read_votes(self, since):
+        """counts the votes since `since`, oldest first: likes are added
+        and any other vote takes back a like of the same link"""
+        votes = vote_table()
+        res = sa.select([votes.c.thing1_id, votes.c.thing2_id,
+                         votes.c.name, votes.c.date],
+                        votes.c.date > since,
+                        order_by = votes.c.date).execute()
+        count = 0
+        while True:
+            rows = res.fetchmany(10000)
+            if not rows:
+                break
+            for account_id, link_id, name, date in rows:
+                if name == '1':
+                    self.add_like(account_id, link_id, date)
+                else:
+                    self.remove_like(account_id, link_id)
+                self.last_date = date
+            count += len(rows)
+        return count
 
+    def save(self, path):
+        #write then rename, so a crash never leaves half a model
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
 
-    prefix = "t%s" % to36(Link._type_id)
-    return ["%s_%s" % (prefix, to36(x)) for x, y in res.fetchall()]
-    
+    @classmethod
+    def load(cls, path):
+        """the model saved at path, or None if there's none (or it's
+        from an older version)"""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+        if getattr(model, 'version', 1) != cls.version:
+            return None
+        return model
+
+def build_covote_model(path, age = 2):
+    """Run from cron: builds the co-vote model from the likes of the
+    last `age` days, publishes it, and saves it to path"""
+    model = CoVoteModel()
+    count = model.read_votes(datetime.now(g.tz) - timedelta(age))
+    published = model.publish()
+    model.save(path)
+    print "covote: %d votes, %d links" % (count, published)
+
+def refresh_covote_model(path, age = 2):
+    """Run from cron between builds: counts the votes since the model
+    at path was last saved, drops the likes that are now more than
+    `age` days old, and republishes the links they change"""
+    model = CoVoteModel.load(path)
+    if not model or not model.last_date:
+        return build_covote_model(path, age)
+    count = model.read_votes(model.last_date)
+    model.expire(datetime.now(g.tz) - timedelta(age))
+    published = model.publish()
+    model.save(path)
+    print "covote: %d new votes, %d links" % (count, published)
 
 
 def get_users_for_user(userid, dateWeight = 0.1):
@@ -101,45 +271,88 @@ def grab_int(str, start, end):
         rval = (rval << 8) | (ord(x) & 255)
     return rval;
 
+# A recommendation record is a byte giving the record size n, the
+# number of entries as an (n-1)-byte little-endian int, then the
+# entries: an (n-1)-byte little-endian id and a signed byte holding
+# the weight * 128.
+
+def key_format(key_size):
+    """The struct codes that make up a key_size byte little-endian int,
+    and the shift to apply to each"""
+    codes, shifts = '', []
+    shift = 0
+    for code, size in (('Q', 8), ('I', 4), ('H', 2), ('B', 1)):
+        while key_size - shift / 8 >= size:
+            codes += code
+            shifts.append(shift)
+            shift += size * 8
+    return codes, shifts
+
+def decode_record(entry):
+    """Returns the ids and weights in the recommendation record entry,
+    as an array of ints and an array of floats"""
+    record_size = ord(entry[0])
+    codes, shifts = key_format(record_size - 1)
+    header = struct.unpack('<' + codes, entry[1:record_size])
+    num_records = sum(x << s for x, s in zip(header, shifts))
+
+    end = record_size * (num_records + 1)
+    fields = struct.unpack('<' + (codes + 'b') * num_records,
+                           entry[record_size:end])
+
+    step = len(codes) + 1
+    keys = fields[0::step]
+    for i, s in enumerate(shifts[1:]):
+        keys = [k | (x << s) for k, x in zip(keys, fields[i + 1::step])]
+    #0x80 is a weight of 1
+    values = array('f', [x / 128. if x != -128 else 1.
+                         for x in fields[step - 1::step]])
+    return array('L', keys), values
+
+def encode_record(keys, values, key_size = 4):
+    """The inverse of decode_record: packs ids and weights (in [-1, 1])
+    into a record with key_size byte ids"""
+    codes, shifts = key_format(key_size)
+    masks = [(1 << (struct.calcsize(c) * 8)) - 1 for c in codes]
+
+    def split(x):
+        return [(x >> s) & m for s, m in zip(shifts, masks)]
+
+    fields = []
+    for k, v in zip(keys, values):
+        fields.extend(split(k))
+        #0x80 is read back as 1, so -1 can only be approximated
+        v = max(int(round(v * 128)), -127)
+        fields.append(v if v != 128 else -128)
+    return (chr(key_size + 1) +
+            struct.pack('<' + codes, *split(len(keys))) +
+            struct.pack('<' + (codes + 'b') * len(keys), *fields))
+
 def load_from_mc(userid, positiveOnly = True, dateWeight = 0):
    cachedEntry = g.rec_cache.get("recommend_" + str(userid))
    rval = []
-   resortingHash = {}
-   min_id = None;
-   max_id = None
 
    if cachedEntry:
-       record_size = ord(cachedEntry[0])
-       num_records = grab_int(cachedEntry, 1, record_size)
-       offset = record_size;
-       for i in range(0, num_records):
-           key = grab_int(cachedEntry, 
-                          i*record_size + offset,
-                          (i+1)*record_size + offset-1)
-           value = float(ord(cachedEntry[(i+1)*record_size + offset-1]))/128.
-
-           if not min_id or key < min_id:
-               min_id = key
-           if not max_id or key > max_id:
-               max_id = key
-
-           if value > 1: value -= 2
-           if value < 0 and positiveOnly: continue
-           rval += [key, value]
-           resortingHash[key] = value
-       
+       keys, values = decode_record(cachedEntry)
+       if not keys:
+           return rval
+
+       entries = zip(keys, values)
+       if positiveOnly:
+           entries = [(k, v) for k, v in entries if v >= 0]
+
+       min_id, max_id = min(keys), max(keys)
        if dateWeight > 0 and min_id != max_id:
-           arts = resortingHash.keys()
-           def sortingFunc(x, y):
-               qx = ( dateWeight * float(x - min_id) / (max_id - min_id) +
-                      (1-dateWeight) * resortingHash[x])
-               qy = ( dateWeight * float(y - min_id) / (max_id - min_id) +
-                      (1-dateWeight) * resortingHash[y])
-               return cmp(qy, qx)
-           arts.sort(sortingFunc)
-           rval = []
-           for x in arts:
-               rval += [x, resortingHash[x]]
+           #later entries for the same id replace earlier ones
+           resortingHash = dict(entries)
+           def quality(x):
+               return ( dateWeight * float(x - min_id) / (max_id - min_id) +
+                        (1-dateWeight) * resortingHash[x])
+           arts = sorted(resortingHash.keys(), key = quality, reverse = True)
+           entries = [(x, resortingHash[x]) for x in arts]
+
+       for k, v in entries:
+           rval += [k, v]
 
    return rval
 
@@ -19,10 +19,22 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
-import socket, cPickle as pickle
-from threading import Thread
+from __future__ import with_statement
+
+import socket, struct, time, itertools, cPickle as pickle
+from threading import Thread, Lock
+from Queue import Queue
 from SocketServer import DatagramRequestHandler, StreamRequestHandler, ThreadingMixIn, UDPServer, TCPServer
 
+#calls can be queued on the server before connections stop being read
+max_pending = 1000
+num_workers = 16
+#seconds to wait for a response
+timeout = 10
+#how often, in seconds, a connection checks for calls that have waited
+#longer than timeout
+check_interval = 1
+
 class CustomThreadingMixIn(ThreadingMixIn):
     """Mix-in class to handle each request in a new thread."""
     
@@ -35,61 +47,177 @@ class CustomThreadingMixIn(ThreadingMixIn):
                               args = (request, client_address))
         if self.daemon_threads:
             t.setDaemon (1)
+        t.start()
+
+class WorkerPool:
+    """A fixed set of threads running the calls put to it. put blocks
+    while max_pending calls are waiting, which pushes back on whoever
+    is making them."""
+    def __init__(self, num_workers = num_workers, max_pending = max_pending,
+                 thread_class = Thread):
+        self.q = Queue(max_pending)
+        for x in xrange(num_workers):
+            t = thread_class(target = self.work)
+            t.setDaemon(True)
             t.start()
-            
+
+    def put(self, fn, *a):
+        self.q.put((fn, a))
+
+    def work(self):
+        while True:
+            fn, a = self.q.get()
+            try:
+                fn(*a)
+            except Exception:
+                pass
+
+class PooledMixIn:
+    """Mix-in class to handle each request on a WorkerPool."""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def process_request(self, request, client_address):
+        self.pool.put(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+            self.close_request(request)
+        except:
+            self.handle_error(request, client_address)
+            self.close_request(request)
 
 class Responses:
     OK, ERROR = range(2)
 
+def call(container, msg):
+    """Runs msg, a (fn, a, kw) or a list of them, against container
+    and returns the pickled response"""
+    def run(fn_name, a, kw):
+        try:
+            fn = getattr(container, fn_name)
+            return (Responses.OK, fn(*a, **kw))
+        except Exception, e:
+            return (Responses.ERROR, e)
+
+    if isinstance(msg, list):
+        res = [run(*m) for m in msg]
+    else:
+        res = run(*msg)
+    try:
+        return pickle.dumps(res, -1)
+    except:
+        res = (Responses.ERROR, 'Error while pickling.' )
+        return pickle.dumps(res, -1)
+
+def result(res):
+    error_code, res = res
+    if error_code == Responses.OK:
+        return res
+    else:
+        raise Exception, res
+
+#TCP messages are framed by a version, their length and a request id,
+#so calls on a connection can be answered out of order. Calls with id
+#0 aren't answered. Either end closes the connection on a frame of
+#another version, which includes the unframed pickles of the older
+#protocol, so the two don't misread each other.
+frame_version = 1
+header = struct.Struct('!BIQ')
+
+def frame(req_id, msg):
+    return header.pack(frame_version, len(msg), req_id) + msg
+
+def read_frame(f):
+    """(req_id, msg) from the file f, or None at the end of it or on a
+    frame of another version"""
+    head = f.read(header.size)
+    if len(head) < header.size:
+        return None
+    version, length, req_id = header.unpack(head)
+    if version != frame_version:
+        return None
+    msg = f.read(length)
+    if len(msg) < length:
+        return None
+    return req_id, msg
+
 class SimpleHandler:
     def handle(self):
         try:
-            fn_name, a, kw = pickle.load(self.rfile)
-            fn = getattr(self.server.container, fn_name)
-            res = (Responses.OK, fn(*a, **kw))
+            msg = pickle.load(self.rfile)
         except Exception, e:
-            res = (Responses.ERROR, e)
+            res = pickle.dumps((Responses.ERROR, e), -1)
+        else:
+            res = call(self.server.container, msg)
+        self.wfile.write(res)
+
+class MultiplexedHandler(StreamRequestHandler):
+    """Reads the calls on a connection as they come and passes them to
+    the server's pool, which writes each response when it's ready"""
+    def handle(self):
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        write_lock = Lock()
+        while True:
+            req = read_frame(self.rfile)
+            if req is None:
+                return
+            req_id, msg = req
+            self.server.pool.put(self.respond, write_lock, req_id, msg)
+
+    def respond(self, write_lock, req_id, msg):
         try:
-            self.wfile.write(pickle.dumps(res, -1))
-        except:
-            res = (Responses.ERROR, 'Error while pickling.' )
-            self.wfile.write(pickle.dumps(res, -1))
+            res = call(self.server.container, pickle.loads(msg))
+        except Exception, e:
+            res = pickle.dumps((Responses.ERROR, e), -1)
+        if req_id:
+            with write_lock:
+                self.connection.sendall(frame(req_id, res))
 
 class SimpleUDPHandler(SimpleHandler, DatagramRequestHandler): pass
-class SimpleTCPHandler(SimpleHandler, StreamRequestHandler): pass
+SimpleTCPHandler = MultiplexedHandler
 
-class ThreadedUDPServer(CustomThreadingMixIn, UDPServer): 
+class ThreadedUDPServer(PooledMixIn, UDPServer): 
     def __init__(self, server_address, RequestHandlerClass, container,
-                 thread_class = Thread):
+                 thread_class = Thread, pool = None):
         UDPServer.__init__(self, server_address, RequestHandlerClass)
-        CustomThreadingMixIn.__init__(self, thread_class)
+        PooledMixIn.__init__(self, pool or WorkerPool(thread_class = thread_class))
         self.container = container
-        self.daemon_threads = True
 
 class ThreadedTCPServer(CustomThreadingMixIn, TCPServer): 
+    """Connections are long lived, so each gets a thread to read it;
+    the calls made on them share the pool"""
     def __init__(self, server_address, RequestHandlerClass, container,
-                 thread_class = Thread):
+                 thread_class = Thread, pool = None):
         self.allow_reuse_address = True
         TCPServer.__init__(self, server_address, RequestHandlerClass)
         CustomThreadingMixIn.__init__(self, thread_class)
         self.container = container
         self.daemon_threads = True
+        self.pool = pool or WorkerPool(thread_class = thread_class)
 
 
 class Server:
     def __init__(self, container, addr='', port=5000,
-                 daemon=True, tcp=False, thread_class = Thread):
+                 daemon=True, tcp=False, thread_class = Thread,
+                 num_workers = num_workers, max_pending = max_pending):
+        pool = WorkerPool(num_workers, max_pending, thread_class)
         if tcp:
             self.s = ThreadedTCPServer((addr, port), SimpleTCPHandler,
-                                       container, thread_class)
+                                       container, thread_class, pool)
         else:
             self.s = ThreadedUDPServer((addr, port), SimpleUDPHandler,
-                                       container, thread_class)
+                                       container, thread_class, pool)
 
         self.handle_thread = thread_class(target = self.s.serve_forever)
         self.handle_thread.setDaemon(daemon)
         self.handle_thread.start()
 
+    def stop(self):
+        self.s.shutdown()
+        self.s.server_close()
+
 
 class RemoteCall:
     def __init__(self, client, response_required):
@@ -101,45 +229,197 @@ class RemoteCall:
             return self.client.send(self.response_required, attr, a, kw)
         return fn
 
+class ConnectionLost(Exception): pass
+class CallTimeout(Exception): pass
+
+class PendingCall:
+    """A call waiting for its response. It waits on a lock rather than
+    with a timeout, which python only does by polling; the connection's
+    reader fails the call with CallTimeout once it passes its deadline,
+    so get never waits much past it."""
+    def __init__(self):
+        self.done = Lock()
+        self.done.acquire()
+        self.deadline = time.time() + timeout
+        self.res = None
+        self.error = None
+
+    def set(self, res):
+        self.res = res
+        self.done.release()
+
+    def fail(self, error):
+        self.error = error
+        self.done.release()
+
+    def get(self):
+        self.done.acquire()
+        if self.error:
+            raise self.error
+        return pickle.loads(self.res)
+
+class Connection:
+    """A TCP connection shared by any number of threads. Calls are
+    written as they're made and a reader thread hands each response to
+    the call waiting for it."""
+    def __init__(self, conninfo):
+        self.sock = socket.create_connection(conninfo, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        #a server that goes away without closing the connection is
+        #noticed by the keepalives, rather than by calls timing out
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock.settimeout(check_interval)
+        self.write_lock = Lock()
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.alive = True
+
+        t = Thread(target = self.read)
+        t.setDaemon(True)
+        t.start()
+
+    def send(self, msg, response_required):
+        """Writes msg, returning the PendingCall for its response if one
+        is required"""
+        pending = None
+        req_id = 0
+        if response_required:
+            pending = PendingCall()
+            req_id = self.ids.next()
+            self.pending[req_id] = pending
+        try:
+            with self.write_lock:
+                self.sock.sendall(frame(req_id, msg))
+        except socket.error:
+            self.close()
+            raise ConnectionLost
+        return pending
+
+    def expire(self):
+        """Fails the calls that are past their deadline. The rest keep
+        waiting, and their responses are still read"""
+        now = time.time()
+        for req_id, pending in self.pending.items():
+            if pending.deadline < now and self.pending.pop(req_id, None):
+                pending.fail(CallTimeout())
+
+    def read(self):
+        buf = ''
+        last_check = time.time()
+        try:
+            while True:
+                try:
+                    data = self.sock.recv(65536)
+                except socket.timeout:
+                    data = None
+                #checked however busy the connection is
+                if time.time() - last_check >= check_interval:
+                    last_check = time.time()
+                    self.expire()
+                if data is None:
+                    continue
+                if not data:
+                    return
+                buf += data
+                while len(buf) >= header.size:
+                    version, length, req_id = header.unpack_from(buf)
+                    if version != frame_version:
+                        return
+                    end = header.size + length
+                    if len(buf) < end:
+                        break
+                    pending = self.pending.pop(req_id, None)
+                    if pending:
+                        pending.set(buf[header.size:end])
+                    buf = buf[end:]
+        except socket.error:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.alive = False
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        #the calls left waiting get ConnectionLost
+        while self.pending:
+            req_id, pending = self.pending.popitem()
+            pending.fail(ConnectionLost())
+
+class Batch:
+    """Calls made through batch.call are sent together by run, which
+    returns their results in order"""
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.call = RemoteCall(self, True)
+
+    def send(self, response_required, fn, a, kw):
+        self.calls.append((fn, a, kw))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        if not calls:
+            return []
+        res = self.client.send_msg(pickle.dumps(calls, -1), True)
+        return [result(r) for r in res] if res is not None else None
+
 class Client:
-    def __init__(self, host='localhost', port=5000, tcp=False):
+    def __init__(self, host='localhost', port=5000, tcp=False,
+                 connections = 1):
         self.conninfo = (host, port)
         self.call = RemoteCall(self, True)
         self.call_nr = RemoteCall(self, False)
         self.tcp = tcp
+        self.connections = [None] * connections
+        self.next_conn = itertools.cycle(range(connections))
+        self.conn_lock = Lock()
+
+    def batch(self):
+        return Batch(self)
+
+    def connection(self):
+        """One of the client's connections, reconnecting it if it has
+        been lost"""
+        i = self.next_conn.next()
+        conn = self.connections[i]
+        if conn and conn.alive:
+            return conn
+        with self.conn_lock:
+            conn = self.connections[i]
+            if not (conn and conn.alive):
+                conn = self.connections[i] = Connection(self.conninfo)
+            return conn
 
     def send(self, response_required, fn, a, kw):
         msg = pickle.dumps((fn, a, kw), -1)
+        res = self.send_msg(msg, response_required)
+        if res is not None:
+            return result(res)
 
-        #get socket + send
-        if self.tcp:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                s.connect(self.conninfo)
-            except:
-                return
-            s.send(msg)
-        else:
+    def send_msg(self, msg, response_required):
+        """Sends a pickled call or list of calls, returning the
+        unpickled response if one is required. The response is None
+        when the server can't be reached."""
+        if not self.tcp:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.settimeout(10)
+            s.settimeout(timeout)
             s.sendto(msg, self.conninfo)
+            if response_required:
+                return pickle.loads(s.recv(65536))
+            return
 
-        if response_required:
-            infile = s.makefile('rb')
-            error_code, res = pickle.load(infile)
-            #close
-            try:
-                if self.tcp: s.close()
-            except: pass
-            #return
-            if error_code == Responses.OK:
-                return res
-            else:
-                raise Exception, res
-        elif self.tcp:
+        try:
+            pending = self.connection().send(msg, response_required)
+        except (socket.error, ConnectionLost):
+            return
+        if pending:
             try:
-                s.close()
-            except: pass
+                return pending.get()
+            except (ConnectionLost, CallTimeout):
+                return
 
 class TH:
     def add(self, x,y):
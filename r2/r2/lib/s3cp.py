@@ -23,14 +23,23 @@
 ################################################################################
 
 import base64, hmac, sha, os, sys, getopt
+import httplib, socket
 from datetime import datetime
+from threading import local
 from pylons import g,config
 
 KEY_ID = g.S3KEY_ID
 SECRET_KEY = g.S3SECRET_KEY
 
+S3_HOST = 's3.amazonaws.com'
+
 class S3Exception(Exception): pass
 
+# one kept-alive connection to s3 per thread. the threads that upload
+# are expected to be long-lived (see media.MediaWorkers) and to call
+# close_connection when they finish
+connections = local()
+
 def make_header(verb, date, amz_headers, resource, content_type):
     content_md5 = ''
 
@@ -83,7 +92,55 @@ def send_file(filename, resource, content_type, acl, rate, meter):
     if exit_code:
         raise S3Exception(exit_code)
 
-               
+
+def get_connection():
+    conn = getattr(connections, 'conn', None)
+    if conn is None:
+        conn = connections.conn = httplib.HTTPSConnection(S3_HOST)
+    return conn
+
+def close_connection():
+    """Closes this thread's connection to s3, for threads that are
+    done uploading"""
+    conn = getattr(connections, 'conn', None)
+    if conn is not None:
+        conn.close()
+        connections.conn = None
+
+def send_data(data, resource, content_type, acl):
+    """Uploads the string data to resource in-process, reusing this
+    thread's connection to s3. Like send_file, raises S3Exception with
+    the http status if the upload fails."""
+    date = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
+    amz_headers = {'x-amz-acl': acl}
+
+    auth_header = make_header('PUT', date, amz_headers, resource, content_type)
+
+    headers = {'x-amz-acl': acl,
+               'Authorization': 'AWS %s:%s' % (KEY_ID, auth_header),
+               'Date': date,
+               'Content-Length': str(len(data))}
+    if content_type:
+        headers['Content-Type'] = content_type
+
+    #the kept-alive connection may have been closed by s3, so retry
+    #once on a new one
+    for attempt in (0, 1):
+        conn = get_connection()
+        try:
+            conn.request('PUT', resource, data, headers)
+            res = conn.getresponse()
+            res.read()
+            break
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            connections.conn = None
+            if attempt:
+                raise
+
+    if res.status != 200:
+        raise S3Exception(res.status)
+
 if __name__ == '__main__':
     options = "a:c:l:m"
     try:
@@ -19,6 +19,7 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
 
 from pylons import g
 from r2.lib import utils
@@ -28,6 +29,7 @@ from urllib2 import Request, HTTPError, URLError, urlopen
 from httplib import InvalidURL
 import urlparse, re, urllib, logging, StringIO, logging
 import Image, ImageFile, math
+import threading, time, sha
 from BeautifulSoup import BeautifulSoup
 
 log = g.log
@@ -48,7 +50,33 @@ def str_to_image(s):
     image = Image.open(s)
     return image
 
+#images are shrunk to about this width before they are cropped, which
+#is plenty for the crop's entropy to match the full size image's
+working_width = thumbnail_size[0] * 4
+
+def reduce_image(img):
+    """Cheaply shrinks img to no less than working_width wide, keeping
+    its aspect ratio. JPEGs are decoded at a reduced scale (draft mode)
+    where possible, then the image is halved with a fast filter until
+    another halving would take it below working_width."""
+    x, y = img.size
+    if x <= working_width:
+        return img
+
+    if img.format == 'JPEG':
+        #draft picks the smallest scale that is at least this size
+        img.draft(img.mode, (working_width, y * working_width / x))
+
+    if img.mode in ('RGB', 'RGBA', 'L'):
+        x, y = img.size
+        while x >= working_width * 2:
+            x, y = x / 2, max(y / 2, 1)
+            img = img.resize((x, y), Image.BILINEAR)
+
+    return img
+
 def prepare_image(image):
+    image = reduce_image(image)
     image = square_image(image)
     image.thumbnail(thumbnail_size, Image.ANTIALIAS)
     return image
@@ -82,6 +110,63 @@ def square_image(img):
 
     return img
 
+class DomainLimiter(object):
+    """Keeps concurrent fetchers polite: at most max_concurrent fetches
+    from a domain at once, started at least min_interval seconds
+    apart. A fetch that has held its slot for max_hold seconds is
+    assumed to be stuck and stops counting against its domain.
+    Domains are forgotten once they have no fetches, so the
+    bookkeeping only grows with the number of fetches in flight."""
+    def __init__(self, max_concurrent = 2, min_interval = .5, max_hold = 60):
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self.max_hold = max_hold
+        self.cond = threading.Condition()
+        #domain -> start times of the fetches holding a slot
+        self.active = {}
+        self.last_start = {}
+
+    def _prune(self, now):
+        for domain, starts in self.active.items():
+            starts[:] = [t for t in starts if now - t < self.max_hold]
+            if not starts:
+                del self.active[domain]
+        for domain, t in self.last_start.items():
+            if now - t >= self.min_interval:
+                del self.last_start[domain]
+
+    def acquire(self, domain):
+        """Waits for a slot for domain and returns a token to release
+        it with"""
+        with self.cond:
+            while True:
+                now = time.time()
+                self._prune(now)
+                starts = self.active.get(domain, [])
+                wait = 0
+                if domain in self.last_start:
+                    wait = self.last_start[domain] + self.min_interval - now
+                if len(starts) >= self.max_concurrent:
+                    #until a slot is released, or the oldest expires
+                    wait = max(wait, min(starts) + self.max_hold - now)
+                elif wait <= 0:
+                    self.active.setdefault(domain, []).append(now)
+                    self.last_start[domain] = now
+                    return now
+                self.cond.wait(wait)
+
+    def release(self, domain, token):
+        with self.cond:
+            starts = self.active.get(domain, [])
+            #it may already have been expired
+            if token in starts:
+                starts.remove(token)
+                if not starts:
+                    del self.active[domain]
+            self.cond.notifyAll()
+
+domain_limiter = DomainLimiter()
+
 def clean_url(url):
     """url quotes unicode data out of urls"""
     s = url
@@ -89,14 +174,65 @@ def clean_url(url):
     url = ''.join([urllib.quote(c) if ord(c) >= 127 else c for c in url])
     return url
 
-def fetch_url(url, referer = None, retries = 1, dimension = False):
-    cur_try = 0
+def normalize_url(url):
+    """Canonical form of url for caching: the scheme and host are
+    lowercased and the fragment and default port are dropped"""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(clean_url(url))
+    scheme, netloc = scheme.lower(), netloc.lower()
+    if netloc.endswith(':80') and scheme == 'http':
+        netloc = netloc[:-3]
+    return urlparse.urlunsplit((scheme, netloc, path or '/', query, ''))
+
+#most pages have everything we look for well before this many bytes,
+#so the rest isn't downloaded
+max_page_size = 256 * 1024
+#an image can't be cut short, so larger ones are skipped instead
+max_image_size = 4 * 1024 * 1024
+
+def fetch_url(url, referer = None, retries = 1, dimension = False,
+              content_types = None, max_size = None, stop_rx = None):
+    """Fetches url, returning (content_type, content), or just the
+    dimensions of the image at url if dimension is True.
+
+    The body is read in chunks and not at all if its content type
+    doesn't contain one of content_types. Pages are cut short after
+    max_size bytes or once stop_rx matches what has been read;
+    images over max_image_size aren't returned."""
     log.debug('fetching: %s' % url)
     nothing = None if dimension else (None, None)
     url = clean_url(url)
     #just basic urls
     if not url.startswith('http://'):
         return nothing
+    domain = utils.domain(url)
+    token = domain_limiter.acquire(domain)
+    try:
+        return _fetch_url(url, referer, retries, dimension, nothing,
+                          content_types, max_size, stop_rx)
+    finally:
+        domain_limiter.release(domain, token)
+
+def _read_page(open_req, content, max_size, stop_rx):
+    """Reads the rest of a page into content, stopping after max_size
+    bytes or once stop_rx matches"""
+    while True:
+        if stop_rx:
+            #only the new data (and enough of the old for a match that
+            #spans chunks) needs to be searched
+            if stop_rx.search(content, max(0, len(content) - 2 * chunk_size)):
+                break
+        if max_size and len(content) >= max_size:
+            log.debug('truncating at %d bytes' % len(content))
+            return content[:max_size]
+        new_data = open_req.read(chunk_size)
+        if not new_data:
+            break
+        content += new_data
+    return content
+
+def _fetch_url(url, referer, retries, dimension, nothing,
+               content_types, max_size, stop_rx):
+    cur_try = 0
     while True:
         try:
             req = Request(url)
@@ -107,17 +243,29 @@ def fetch_url(url, referer = None, retries = 1, dimension = False):
 
             open_req = urlopen(req)
 
-            #if we only need the dimension of the image, we may not
-            #need to download the entire thing
-            if dimension:
-                content = open_req.read(chunk_size)
-            else:
-                content = open_req.read()
+            #decide from the headers whether the body is worth reading
             content_type = open_req.headers.get('content-type')
-
             if not content_type:
                 return nothing
 
+            if dimension and 'image' not in content_type:
+                #expected an image, but didn't get one
+                return nothing
+
+            if content_types and not any(t in content_type
+                                         for t in content_types):
+                log.debug('skipping body of %s: %s' % (url, content_type))
+                return content_type, None
+
+            length = open_req.headers.get('content-length')
+            if ('image' in content_type and not dimension and
+                length and length.isdigit() and
+                int(length) > max_image_size):
+                log.debug('image too large: %s (%s)' % (url, length))
+                return nothing
+
+            content = open_req.read(chunk_size)
+
             if 'image' in content_type:
                 p = ImageFile.Parser()
                 new_data = content
@@ -131,9 +279,19 @@ def fetch_url(url, referer = None, retries = 1, dimension = False):
                     return p.image.size
                 elif dimension:
                     return nothing
-            elif dimension:
-                #expected an image, but didn't get one
-                return nothing
+
+                content = _read_page(open_req, content, max_image_size + 1,
+                                     None)
+                if len(content) > max_image_size:
+                    log.debug('image too large: %s' % url)
+                    return nothing
+            else:
+                #a page that is really a binary file
+                if 'html' in content_type and '\0' in content:
+                    log.debug('binary content labelled %s: %s'
+                              % (content_type, url))
+                    return content_type, None
+                content = _read_page(open_req, content, max_size, stop_rx)
 
             return content_type, content
 
@@ -164,17 +322,30 @@ class MediaEmbed(object):
         self.scrolling = scrolling
 
 class Scraper:
+    #the body of the url is only read if it is one of these
+    content_types = ('html',)
+    #scrapers that only look at part of the page can set this to a
+    #regex that matches once that part has been downloaded
+    download_until = None
+
     def __init__(self, url):
         self.url = url
         self.content = None
         self.content_type = None
         self.soup = None
+        self.downloaded = False
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.url)
 
     def download(self):
-        self.content_type, self.content = fetch_url(self.url)
+        #a failed download isn't retried by each caller
+        if self.downloaded:
+            return
+        self.downloaded = True
+        self.content_type, self.content = \
+            fetch_url(self.url, content_types = self.content_types,
+                      max_size = max_page_size, stop_rx = self.download_until)
         if self.content_type and 'html' in self.content_type and self.content:
             self.soup = BeautifulSoup(self.content)
 
@@ -192,8 +363,9 @@ class Scraper:
         if not self.content:
             self.download()
 
-        #if download didn't work
-        if not self.content or not self.content_type:
+        #if download didn't work. the body of an image isn't read
+        if (not self.content_type or
+            not (self.content or 'image' in self.content_type)):
             return None
 
         max_area = 0
@@ -236,7 +408,8 @@ class Scraper:
     def thumbnail(self):
         image_url = self.largest_image_url()
         if image_url:
-            content_type, image_str = fetch_url(image_url, referer = self.url)
+            content_type, image_str = fetch_url(image_url, referer = self.url,
+                                                content_types = ('image',))
             if image_str:
                 image = str_to_image(image_str)
                 try:
@@ -329,6 +502,34 @@ def make_scraper(url):
             return make_scraper(youtube_url)
     return scraper(url)
 
+#how long the result of scraping a url is kept, so that reposts of it
+#aren't scraped again. finding nothing may only mean the fetch failed
+#(a timeout, an error page, rate limiting), so that's soon tried again
+scrape_cache_time = 3600
+empty_scrape_cache_time = 60
+
+def scrape_key(url):
+    return 'scrape_' + sha.new(normalize_url(url)).hexdigest()
+
+def scrape(url, update = False):
+    """Returns (thumbnail, media_object) for url, where thumbnail is
+    the thumbnail as PNG data, or None. The result is cached by the
+    normalized url unless update is set."""
+    key = scrape_key(url)
+    res = None if update else g.cache.get(key)
+    if res is None:
+        scraper = make_scraper(url)
+        thumbnail = scraper.thumbnail()
+        if thumbnail:
+            f = StringIO.StringIO()
+            thumbnail.save(f, 'PNG')
+            thumbnail = f.getvalue()
+        res = (thumbnail, scraper.media_object())
+        found = thumbnail or res[1]
+        g.cache.set(key, res, time = scrape_cache_time if found
+                                     else empty_scrape_cache_time)
+    return res
+
 ########## site-specific video scrapers ##########
 
 class YoutubeScraper(MediaScraper):
@@ -487,6 +688,8 @@ class LiveLeakScraper(MediaScraper):
     width = 450
     media_template = '<object width="450" height="370"><param name="movie" value="http://www.liveleak.com/e/$video_id"></param><param name="wmode" value="transparent"></param><embed src="http://www.liveleak.com/e/$video_id" type="application/x-shockwave-flash" wmode="transparent" width="450" height="370"></embed></object>'
     video_id_rx = re.compile('.*i=([a-zA-Z0-9_]+).*')
+    #the thumbnail is linked in the head
+    download_until = re.compile('</head>', re.I)
 
     def largest_image_url(self):
         if not self.soup:
@@ -22,6 +22,7 @@
 from r2.models import Subreddit
 from r2.lib.db.operators import desc
 from r2.lib import count
+from r2.lib.subreddit_search import update_reddit
     
 def run():
     sr_counts = count.get_sr_counts()
@@ -32,4 +33,5 @@ def run():
         if c != sr._downs and c > 0:
             sr._downs = max(c, 0)
             sr._commit()
+            update_reddit(sr)
     count.clear_sr_counts(names)
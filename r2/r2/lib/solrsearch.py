@@ -28,9 +28,9 @@
 
 from __future__ import with_statement
 
-from Queue import Queue
-from threading import Thread
-import time
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock
+import time, traceback
 from datetime import datetime, date
 from time import strftime
 
@@ -42,6 +42,7 @@ from r2.lib.contrib.pysolr import SolrError
 from r2.lib.utils import timeago
 from r2.lib.utils import unicode_safe, tup
 from r2.lib.cache import SelfEmptyingCache
+from r2.lib.db.operators import asc
 from r2.lib import amqp
 
 ## Changes to the list of searchable languages will require changes to
@@ -247,6 +248,91 @@ def tokenize_things(things,return_dict=False):
 
     return ret if return_dict else ret.values()
 
+def document_plan(cls):
+    """
+        The ([Field], [ThingField], type names) that apply to
+        instances of `cls`, in the order `tokenize_things` visits them
+    """
+    fields, thing_fields, types = [], [], []
+    for c in (cls,) + cls.__bases__:
+        types.append(c.__name__.lower())
+        for field in search_fields.get(c, ()):
+            if field.__class__ == Field:
+                fields.append(field)
+            elif field.__class__ == ThingField:
+                thing_fields.append(field)
+    return fields, thing_fields, types
+
+def build_documents(things, return_dict=False):
+    """
+        Builds the same documents as `tokenize_things`, but a column
+        at a time: the fields are worked out once per class, each
+        field is extracted for every Thing in the batch before moving
+        on to the next, and the Things referred to by every
+        ThingField are looked up together, with one `_byID` per class
+    """
+    by_cls = {}
+    for thing in things:
+        by_cls.setdefault(thing.__class__, []).append(thing)
+
+    plans = dict((cls, document_plan(cls)) for cls in by_cls)
+
+    # collect the ids of every looked-up Thing first
+    lookup_ids = {}
+    for cls, cls_things in by_cls.iteritems():
+        for field in plans[cls][1]:
+            ids = lookup_ids.setdefault(field.cls, set())
+            for thing in cls_things:
+                try:
+                    ids.add(getattr(thing, field.id_attr))
+                except AttributeError, e:
+                    print e
+    found = dict((lu_cls, lu_cls._byID(ids, data=True, return_dict=True))
+                 for lu_cls, ids in lookup_ids.iteritems())
+
+    ret = {}
+    for cls, cls_things in by_cls.iteritems():
+        fields, thing_fields, types = plans[cls]
+        docs = [{'type': list(types)} for thing in cls_things]
+
+        for field in fields:
+            extract = field.thing_attr_func
+            name = field.name
+            for thing, doc in zip(cls_things, docs):
+                try:
+                    val = extract(thing)
+                    if val != None and val != '':
+                        doc[name] = val
+                except AttributeError, e:
+                    print e
+
+        for thing, doc in zip(cls_things, docs):
+            # copy 'contents' to ('contents_%s' % lang) and contents_ws
+            try:
+                doc[lang_to_fieldname(thing.lang)] = doc['contents']
+                doc['contents_ws'] = doc['contents']
+                ret[thing._fullname] = doc
+            except AttributeError, e:
+                print e
+            except KeyError, e:
+                print e
+
+        for field in thing_fields:
+            batch = found[field.cls]
+            for thing in cls_things:
+                doc = ret.get(thing._fullname)
+                if doc is None:
+                    continue
+                try:
+                    doc[field.name] = getattr(batch[getattr(thing, field.id_attr)],
+                                              field.lu_attr_name)
+                except AttributeError, e:
+                    print e
+                except KeyError, e:
+                    print e
+
+    return ret if return_dict else ret.values()
+
 def lang_to_fieldname(l):
     """
         Returns the field-name for the given language, or `contents`
@@ -266,13 +352,13 @@ def tokenize(thing):
 
 def index_things(s=None,things=[]):
     "Sends the given Things to Solr to be indexed"
-    tokenized = tokenize_things(things)
+    tokenized = build_documents(things)
 
     if s:
         s.add(tokenized)
     else:
         with SolrConnection(commit=True) as s:
-            s.add(tokenize_things(things))
+            s.add(tokenized)
 
 def fetch_batches(t_class,size,since,until):
     """
@@ -323,47 +409,295 @@ class SolrConnection(object):
         solr_queue.task_done()
         solr_queue.put(self.conn)
 
-def indexer_worker(q,delete_all_first=False):
+class Indexer(object):
     """
-        The thread for mass-indexing that connects to Solr and submits
-        tokenised objects
+        Indexes Things from `num_workers` threads, each with its own
+        Solr connection. Things that are spam or deleted are removed
+        from the index instead. Things are tokenised and sent in
+        batches of up to `batch_size`, or of whatever was added within
+        `batch_time` seconds, and the workers share a single commit
+        every `commit_docs` documents or `commit_time` seconds (if
+        `commit` is set). Used like
+
+            indexer = Indexer()
+            indexer.start()
+            indexer.add(things, done = callback)
+            indexer.finish()
+
+        where `callback` is called once `things` have been committed
     """
-    with SolrConnection(commit=True,optimize=True) as s:
-        count = 0
+    global_env = g._current_obj()
+
+    def __init__(self, num_workers = 4, batch_size = 1000, batch_time = 5,
+                 commit = True, commit_docs = 25000, commit_time = 300):
+        self.num_workers = num_workers
+        self.batch_size  = batch_size
+        self.batch_time  = batch_time
+        self.commit      = commit
+        self.commit_docs = commit_docs
+        self.commit_time = commit_time
+
+        self.q = Queue(num_workers * 4)
+        self.workers = []
+        self.errors = []
+
+        self.lock = Lock()
+        self.commit_lock = Lock()
+        # documents sent since the last commit, and the callbacks
+        # waiting on them
+        self.uncommitted = 0
+        self.pending = []
+        self.last_commit = time.time()
+
+    def start(self):
+        for x in xrange(self.num_workers):
+            worker = Thread(target = self._init_thread)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def add(self, things, done = None):
+        self._put((things, done))
+
+    def _put(self, item):
+        # the queue is bounded, so don't block on it forever if the
+        # workers have died
+        while True:
+            self.check()
+            try:
+                self.q.put(item, timeout = 1)
+                return
+            except Full:
+                pass
+
+    def check(self):
+        """Re-raises the first error seen by a worker, or raises if the
+        workers have all stopped"""
+        if self.errors:
+            raise self.errors[0]
+        if self.workers and not any(w.isAlive() for w in self.workers):
+            raise RuntimeError("the indexer's workers have all stopped")
+
+    def wait(self):
+        "Blocks until everything added so far has been sent"
+        cond = self.q.all_tasks_done
+        cond.acquire()
+        try:
+            while self.q.unfinished_tasks:
+                self.check()
+                cond.wait(1)
+        finally:
+            cond.release()
+        self.check()
+
+    def finish(self, optimize = False):
+        "Sends everything added so far, stops the workers and commits"
+        for worker in self.workers:
+            self._put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.errors:
+            raise self.errors[0]
+        if self.commit:
+            self._commit(optimize = optimize)
 
-        if delete_all_first:
-            s.delete(q='*:*')
-
-        t = q.get()
-        while t != "done":
-            # if it's not a list or a dictionary, I don't know how to
-            # handle it, so die. It's probably an exception pushed in
-            # by the handler in my parent
-            if not (isinstance(t,list) and isinstance(t[0],dict)):
-                raise t
-            count += len(t)
-            s.add(t)
-            if count > 25000:
-                print "Committing... (q:%d)" % (q.qsize(),)
-                s.commit()
-                count = 0
-            q.task_done()
-
-            t=q.get()
-        q.task_done()
-
-def reindex_all(types = None, delete_all_first=False):
+    def _init_thread(self):
+        # make sure that pylons.g is available for the worker thread
+        g._push_object(self.global_env)
+        try:
+            # anything that kills the worker, like failing to connect,
+            # is recorded so that wait() doesn't hang on its batches
+            try:
+                with SolrConnection() as s:
+                    self._work(s)
+            except Exception, e:
+                traceback.print_exc()
+                self.errors.append(e)
+        finally:
+            g._pop_object()
+
+    def _next_batch(self):
+        """
+            Takes items off the queue until there are `batch_size`
+            things or `batch_time` has passed. Returns the items and
+            whether the worker has been told to stop
+        """
+        item = self.q.get()
+        if item is None:
+            return [], True
+
+        items = [item]
+        count = len(item[0])
+        deadline = time.time() + self.batch_time
+        while count < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.q.get(timeout = timeout)
+            except Empty:
+                break
+            if item is None:
+                return items, True
+            items.append(item)
+            count += len(item[0])
+        return items, False
+
+    def _work(self, s):
+        while True:
+            items, stop = self._next_batch()
+            try:
+                if items:
+                    self._send(s, items)
+                    self._maybe_commit(s)
+            except Exception, e:
+                # the things in this batch are never marked done, so a
+                # checkpoint won't pass them
+                traceback.print_exc()
+                self.errors.append(e)
+            finally:
+                for x in xrange(len(items) + stop):
+                    self.q.task_done()
+            if stop:
+                return
+
+    def _send(self, s, items):
+        things = [t for (batch, done) in items for t in batch]
+        update = [t for t in things if not t._spam and not t._deleted]
+        delete = [t._fullname for t in things if t._spam or t._deleted]
+
+        if update:
+            s.add(build_documents(update))
+        if delete:
+            s.delete(id = delete)
+
+        with self.lock:
+            self.uncommitted += len(things)
+            self.pending.extend(done for (batch, done) in items if done)
+
+    def _maybe_commit(self, s):
+        if not self.commit:
+            return
+        with self.lock:
+            due = (self.uncommitted >= self.commit_docs or
+                   time.time() - self.last_commit >= self.commit_time)
+        # if another worker is already committing, this worker's
+        # documents will make the next one
+        if due and self.commit_lock.acquire(False):
+            try:
+                self._commit(s)
+            finally:
+                self.commit_lock.release()
+
+    def _commit(self, s = None, optimize = False):
+        # everything in pending was sent before this point, so it is
+        # covered by the commit
+        with self.lock:
+            pending, self.pending = self.pending, []
+            count, self.uncommitted = self.uncommitted, 0
+
+        print "Committing %d documents (q:%d)" % (count, self.q.qsize())
+        if s and not optimize:
+            s.commit()
+        else:
+            with SolrConnection(commit = True, optimize = optimize):
+                pass
+        self.last_commit = time.time()
+
+        for done in pending:
+            done()
+
+class ReindexCheckpoint(object):
+    """
+        Remembers in the permacache which Things a reindex has
+        committed so that `reindex_all` can resume after a crash. The
+        reindex is split into slices by class and date, and each slice
+        is fetched newest first, so its progress is the date of the
+        oldest Thing committed so far
+    """
+    key = 'solr_reindex_checkpoint'
+
+    def __init__(self, slices):
+        # {(class name, n): [since, until, finished]}
+        self.slices = slices
+        self.lock = Lock()
+        # {slice: {batch number: date}} for batches that were committed
+        # before earlier batches from the same slice
+        self.committed = {}
+        self.next_batch = {}
+
+    @classmethod
+    def load(cls):
+        slices = g.permacache.get(cls.key)
+        if slices:
+            return cls(slices)
+
+    @classmethod
+    def create(cls, types, until, num_slices):
+        slices = {}
+        for t_cls in types:
+            oldest = list(t_cls._query(t_cls.c._spam == (True,False),
+                                       t_cls.c._deleted == (True,False),
+                                       sort = asc('_date'), limit = 1))
+            since = oldest[0]._date if oldest else until
+            step = (until - since) / num_slices
+            for n in xrange(num_slices):
+                s_since = since + step * n
+                s_until = until if n == num_slices - 1 else s_since + step
+                slices[(t_cls.__name__, n)] = [s_since, s_until, False]
+        checkpoint = cls(slices)
+        checkpoint.save()
+        return checkpoint
+
+    def save(self):
+        g.permacache.set(self.key, self.slices)
+
+    def clear(self):
+        g.permacache.delete(self.key)
+
+    def marker(self, slice, n, date):
+        """
+            Returns a callback that records the `n`th batch of `slice`
+            (which goes back to `date`, or finishes the slice if date
+            is None) as committed
+        """
+        def done():
+            with self.lock:
+                committed = self.committed.setdefault(slice, {})
+                committed[n] = date
+                next_batch = self.next_batch.get(slice, 0)
+                while next_batch in committed:
+                    date_ = committed.pop(next_batch)
+                    if date_ is None:
+                        self.slices[slice][2] = True
+                    else:
+                        self.slices[slice][1] = date_
+                    next_batch += 1
+                self.next_batch[slice] = next_batch
+                self.save()
+        return done
+
+    def remaining(self):
+        "The (slice, since, until) of slices that aren't finished, newest first"
+        return sorted(((slice, since, until)
+                       for slice, (since, until, finished)
+                       in self.slices.iteritems() if not finished),
+                      key = lambda x: x[2], reverse = True)
+
+def reindex_all(types = None, delete_all_first=False, resume = False,
+                num_fetchers = 4, num_workers = 4, num_slices = 16):
     """
         Called from `paster run` to totally re-index everything in the
-        database. Spawns a thread to connect to Solr, and sends it
-        tokenised Things
+        database. Things are fetched by `num_fetchers` threads, each
+        working through slices of the date range, and handed to an
+        Indexer with `num_workers` threads. With `resume`, an
+        interrupted reindex carries on from its last commit
     """
     global indexed_types
 
-    start_t = datetime.now()
-
     if not types:
         types = indexed_types
+    classes = dict((cls.__name__, cls) for cls in indexed_types)
 
     # We don't want the default thread-local cache (which is just a
     # dict) to grow un-bounded (normally, we'd use
@@ -372,39 +706,68 @@ def reindex_all(types = None, delete_all_first=False):
     # because it would dump out more recent stuff)
     g.cache.caches = (SelfEmptyingCache(),) # + g.cache.caches[1:]
 
-    count = 0
-    q=Queue(100)
-    indexer=Thread(target=indexer_worker,
-                   args=(q,delete_all_first))
-    indexer.start()
-
-    try:
-        for cls in types:
-            for batch in fetch_batches(cls,1000,
-                                       timeago("50 years"),
-                                       start_t):
-                r = tokenize_things([ x for x in batch
-                                      if not x._spam and not x._deleted ])
+    checkpoint = ReindexCheckpoint.load() if resume else None
+    if checkpoint:
+        print "Resuming: %d slices left" % len(checkpoint.remaining())
+    else:
+        checkpoint = ReindexCheckpoint.create(types, datetime.now(),
+                                              num_slices)
+        if delete_all_first:
+            with SolrConnection() as s:
+                s.delete(q='*:*')
 
-                count += len(r)
-                print ("Processing %s #%d(%s): %s"
-                       % (cls.__name__, count, q.qsize(), r[0]['contents']))
+    indexer = Indexer(num_workers = num_workers)
+    indexer.start()
 
-                if indexer.isAlive():
-                    q.put(r)
-                else:
-                    raise Exception("'tis a shame that I have but one thread to give")
-        q.put("done")
-        indexer.join()
+    slices = Queue()
+    for x in checkpoint.remaining():
+        slices.put(x)
 
-    except object,e:
-        if indexer.isAlive():
-            q.put(e,timeout=30)
-        raise e
-    except KeyboardInterrupt,e: # turns out KeyboardInterrupts aren't objects. Who knew?
-        if indexer.isAlive():
-            q.put(e,timeout=30)
-        raise e
+    counts = {}
+    errors = []
+    def fetcher():
+        g._push_object(Indexer.global_env)
+        try:
+            while not errors:
+                try:
+                    slice, since, until = slices.get_nowait()
+                except Empty:
+                    return
+                cls = classes[slice[0]]
+                n = 0
+                for batch in fetch_batches(cls, 1000, since, until):
+                    things = [x for x in batch
+                              if not x._spam and not x._deleted]
+                    indexer.add(things, done = checkpoint.marker(
+                            slice, n, batch[-1]._date))
+                    n += 1
+
+                    counts[cls] = counts.get(cls, 0) + len(things)
+                    print ("Processing %s #%d(%s): %s"
+                           % (cls.__name__, counts[cls], indexer.q.qsize(),
+                              batch[-1]._date))
+                indexer.add([], done = checkpoint.marker(slice, n, None))
+        except Exception, e:
+            traceback.print_exc()
+            errors.append(e)
+        finally:
+            g._pop_object()
+
+    fetchers = [Thread(target = fetcher) for x in xrange(num_fetchers)]
+    for t in fetchers:
+        t.setDaemon(True)
+        t.start()
+
+    # join() can't be interrupted, so poll to let a KeyboardInterrupt
+    # through. whatever was committed before it is kept
+    while any(t.isAlive() for t in fetchers):
+        time.sleep(1)
+    if errors:
+        raise errors[0]
+
+    indexer.finish(optimize = True)
+    if not checkpoint.remaining():
+        checkpoint.clear()
 
 
 def combine_searchterms(terms):
@@ -466,7 +829,7 @@ class SearchQuery(object):
         else:
             self.timerange = timerange
 
-    def run(self, after = None, num = 100, reverse = False):
+    def run(self, after = None, num = 100, reverse = False, start = None):
         if not self.q or not g.solr_url:
             return pysolr.Results([],0)
 
@@ -538,7 +901,7 @@ class SearchQuery(object):
 
         try:
             search = self.run_search(q, self.sort, solr_params,
-                                     reverse, after, num)
+                                     reverse, after, num, start)
             return search
 
         except SolrError,e:
@@ -546,8 +909,29 @@ class SearchQuery(object):
             return pysolr.Results([],0)
 
     @classmethod
-    def run_search(cls, q, sort, solr_params, reverse, after, num):
-        "returns pysolr.Results(docs=[fullname()],hits=int())"
+    def run_search(cls, q, sort, solr_params, reverse, after, num,
+                   start = None):
+        """returns pysolr.Results(docs=[fullname()],hits=int()), with
+        positions, a dict of fullname -> index in the forward results,
+        when they are known. if start is given, the results are the num
+        from index start on, or the num before index start if reverse"""
+
+        if start is not None:
+            # the search is always run forwards, so that positions
+            # don't depend on the direction we're paging in
+            if reverse:
+                begin = max(start - num, 0)
+                search = cls.run_search_cached(q, sort, begin,
+                                               start - begin, solr_params)
+                search.positions = dict((name, begin + i)
+                                        for i, name in enumerate(search.docs))
+                search.docs.reverse()
+            else:
+                search = cls.run_search_cached(q, sort, start, num,
+                                               solr_params)
+                search.positions = dict((name, start + i)
+                                        for i, name in enumerate(search.docs))
+            return search
 
         if reverse:
             sort = swap_strings(sort,'asc','desc')
@@ -577,6 +961,9 @@ class SearchQuery(object):
                                                pre_search.hits,
                                                solr_params, max=True)
 
+            if not reverse:
+                search.positions = dict((name, i) for i, name
+                                        in enumerate(search.docs))
             search.docs = get_after(search.docs, after._fullname, num)
         else:
             search = cls.run_search_cached(q, sort, 0, num, solr_params)
@@ -703,13 +1090,20 @@ def run_commit(optimize=False):
         pass
 
 
-def run_changed(drain=False):
+def run_changed(drain=False, limit=1000, num_workers=4):
     """
         Run by `cron` (through `paster run`) on a schedule to update
         all Things that have been created or have changed since the
         last run. Note: unlike many queue-using functions, this one is
-        run from cron and totally drains the queue before terminating
+        run from cron and totally drains the queue before terminating.
+        Each pass of up to `limit` changes is split across
+        `num_workers` Solr connections; commits are left to
+        `run_commit`
     """
+    batch_size = max(limit / num_workers, 1)
+    indexer = Indexer(num_workers = num_workers, batch_size = batch_size,
+                      batch_time = 1, commit = False)
+    indexer.start()
 
     def _run_changed(msgs):
         print "changed: Processing %d items" % len(msgs)
@@ -718,16 +1112,11 @@ def run_changed(drain=False):
         things = Thing._by_fullname(fullnames, data=True, return_dict=False)
         things = [x for x in things if isinstance(x, indexed_types)]
 
-        update_things = [x for x in things if not x._spam and not x._deleted]
-        delete_things = [x for x in things if x._spam or x._deleted]
-
-        with SolrConnection() as s:
-            if update_things:
-                tokenized = tokenize_things(update_things)
-                s.add(tokenized)
-            if delete_things:
-                for i in delete_things:
-                    s.delete(id=i._fullname)
+        for i in xrange(0, len(things), batch_size):
+            indexer.add(things[i:i + batch_size])
+        # the messages are only acked once they have all been sent
+        indexer.wait()
 
-    amqp.handle_items('searchchanges_q', _run_changed, limit=1000,
+    amqp.handle_items('searchchanges_q', _run_changed, limit=limit,
                       drain=drain)
+    indexer.finish()
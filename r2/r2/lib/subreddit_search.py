@@ -1,31 +1,239 @@
+from __future__ import with_statement
+
 from r2.models import *
 from r2.lib import utils
 
 from pylons import g
 
+import threading, time
+
+#the old cron job cached the results for every prefix under these
 sr_prefix = 'sr_search_'
 
+#the permacache holds a snapshot of every searchable reddit, in
+#chunks, plus a log of the changes made since
+index_prefix = 'sr_index_'
+snapshot_key = index_prefix + 'snapshot'
+snapshot_chunk = 5000
+seq_key = index_prefix + 'seq'
+log_prefix = index_prefix + 'log_'
+log_time = 86400
+
+max_results = 10
+#seconds between checks of the change log
+refresh_interval = 10
+
+class TrieNode(object):
+    __slots__ = ('children', 'top', 'name')
+
+    def __init__(self):
+        #first character -> (edge label, node)
+        self.children = {}
+        #the best (score, name) at or below this node, best first
+        self.top = []
+        #the reddit whose lowercased name ends at this node, if any
+        self.name = None
+
+class SubredditIndex(object):
+    """A compressed trie of lowercased reddit names. Every node keeps
+    the max_results most popular reddits below it, so a prefix lookup
+    is a walk down at most len(prefix) edges."""
+    def __init__(self):
+        self.root = TrieNode()
+        #lowercased name -> (score, name)
+        self.entries = {}
+
+    def search(self, query):
+        node, rest = self.root, query
+        while rest:
+            child = node.children.get(rest[0])
+            if not child:
+                return []
+            label, node = child
+            if rest.startswith(label):
+                rest = rest[len(label):]
+            elif label.startswith(rest):
+                break
+            else:
+                return []
+        return [name for score, name in node.top]
+
+    def path(self, key):
+        """The nodes from the root down to the one for key, adding it if
+        need be"""
+        node, rest = self.root, key
+        path = [node]
+        while rest:
+            child = node.children.get(rest[0])
+            if not child:
+                new = TrieNode()
+                node.children[rest[0]] = (rest, new)
+                path.append(new)
+                return path
+
+            label, next = child
+            common = 0
+            while (common < len(label) and common < len(rest)
+                   and label[common] == rest[common]):
+                common += 1
+
+            if common < len(label):
+                #split the edge where key leaves it
+                mid = TrieNode()
+                mid.children[label[common]] = (label[common:], next)
+                mid.top = list(next.top)
+                node.children[rest[0]] = (label[:common], mid)
+                next = mid
+
+            node, rest = next, rest[common:]
+            path.append(node)
+        return path
+
+    def set(self, name, score):
+        """Adds or re-ranks the reddit name, or removes it if score is
+        None"""
+        key = name.lower()
+        old = self.entries.pop(key, None)
+        if score is None and old is None:
+            return
+
+        path = self.path(key)
+        leaf = path[-1]
+        if score is None:
+            leaf.name = None
+        else:
+            leaf.name = self.entries[key] = (score, name)
+
+        #only the nodes above the reddit can have it in their top
+        for node in reversed(path):
+            self.rank(node, old, leaf.name)
+
+    def rank(self, node, old, new):
+        #lists are replaced rather than changed, so searches don't need
+        #to lock
+        top = node.top
+        if old in top:
+            if len(top) == max_results:
+                #something below may move up to take its place
+                self.refill(node)
+                return
+            top = [x for x in top if x != old]
+        if new and (len(top) < max_results or new > top[-1]):
+            top = sorted(top + [new], reverse = True)[:max_results]
+        node.top = top
+
+    def refill(self, node):
+        candidates = [node.name] if node.name else []
+        for label, child in node.children.itervalues():
+            candidates.extend(child.top)
+        candidates.sort(reverse = True)
+        node.top = candidates[:max_results]
+
+def sr_score(sr):
+    """the rank of sr in the index, or None if it shouldn't be in it"""
+    if sr.type == 'public' and not sr._spam and not sr._deleted:
+        return (sr._downs, sr._ups)
 
 def load_all_reddits():
-    query_cache = {}
+    """Run from cron: snapshots every searchable reddit into the
+    permacache, for processes to load their index from"""
+    #changes made while this runs are replayed on top of it
+    seq = g.permacache.get(seq_key) or 0
 
     q = Subreddit._query(Subreddit.c.type == 'public',
-                         Subreddit.c._downs > 1,
                          sort = (desc('_downs'), desc('_ups')),
                          data = True)
-    for sr in utils.fetch_things2(q):
-        name = sr.name.lower()
-        for i in xrange(len(name)):
-            prefix = name[:i + 1]
-            names = query_cache.setdefault(prefix, [])
-            if len(names) < 10:
-                names.append(sr.name)
+    entries = [(sr.name, sr_score(sr)) for sr in utils.fetch_things2(q)]
+
+    chunks = {}
+    for i in xrange(0, len(entries), snapshot_chunk):
+        chunks[i / snapshot_chunk] = entries[i:i + snapshot_chunk]
+    g.permacache.set_multi(chunks, prefix = snapshot_key + '_')
+    g.permacache.set(snapshot_key, (seq, len(chunks)))
+
+def update_reddit(sr):
+    """Records a new reddit or a change to one's popularity in the
+    change log and in this process's index"""
+    entry = (sr.name, sr_score(sr))
+    g.permacache.add(seq_key, 0)
+    seq = g.permacache.incr(seq_key)
+    if seq:
+        g.permacache.set(log_prefix + str(seq), entry, time = log_time)
+
+    if index.loaded:
+        with index.lock:
+            index.index.set(*entry)
 
-    g.permacache.set_multi(query_cache, prefix = sr_prefix)
+class ProcessIndex(object):
+    """This process's SubredditIndex, loaded on first use and kept up
+    to date from the change log"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.index = None
+        self.seq = 0
+        self.last_check = 0
+
+    @property
+    def loaded(self):
+        return self.index is not None
+
+    def load(self, replay = True):
+        """Loads the index from the snapshot. Building the snapshot
+        scans every reddit, so that's left to cron (load_all_reddits)
+        rather than done here; until it exists, the index stays
+        unloaded"""
+        head = g.permacache.get(snapshot_key)
+        if not head:
+            return
+        seq, num_chunks = head
+        chunks = g.permacache.get_multi(range(num_chunks),
+                                        prefix = snapshot_key + '_')
+
+        new = SubredditIndex()
+        for i in xrange(num_chunks):
+            for name, score in chunks.get(i, ()):
+                new.set(name, score)
+        self.index, self.seq = new, seq
+        self.replay(reload = replay)
+
+    def replay(self, reload = True):
+        """Applies the changes made since the index was last brought up
+        to date. If some have expired, the snapshot is reloaded"""
+        seq = g.permacache.get(seq_key) or 0
+        if seq <= self.seq:
+            return
+        missing = range(self.seq + 1, seq + 1)
+        changes = g.permacache.get_multi(missing, prefix = log_prefix)
+        if len(changes) < len(missing) and reload:
+            return self.load(replay = False)
+        for n in missing:
+            if n in changes:
+                self.index.set(*changes[n])
+        self.seq = seq
+
+    def get(self):
+        """The index, or None if there's no snapshot to load it from
+        yet"""
+        now = time.time()
+        if now - self.last_check > refresh_interval:
+            with self.lock:
+                if now - self.last_check > refresh_interval:
+                    if self.index is None:
+                        self.load()
+                    else:
+                        self.replay()
+                    self.last_check = now
+        return self.index
+
+index = ProcessIndex()
 
 def search_reddits(query):
     query = str(query.lower())
-    return g.permacache.get(sr_prefix + query) or []
+    sr_index = index.get()
+    if sr_index is None:
+        #no snapshot yet, so fall back on the old cron job's results
+        return g.permacache.get(sr_prefix + query) or []
+    return sr_index.search(query)
 
 @memoize('popular_searches', time = 3600)
 def popular_searches():
@@ -41,4 +249,3 @@ def popular_searches():
             r = search_reddits(query)
             top_searches[query] = r
     return top_searches
-
@@ -21,8 +21,7 @@
 ################################################################################
 
 from datetime import datetime
-from itertools import ifilter
-import time, md5
+import time, md5, struct
 
 import simplejson
 
@@ -56,14 +55,105 @@ def make_sup_id(user, action):
     #cause cool kids only use part of the hash
     return sup_id[:10]
 
-def add_update(user, action):
-    update_time = int(time.time())
-    sup_id = make_sup_id(user, action)
-    supdate = ',%s:%s' % (sup_id, update_time)
+#updates are stored in memcache by MIN_PERIOD bucket, as fixed size
+#entries: the sup id (5 bytes) and the second within the bucket at
+#which it was updated
+entry_format = struct.Struct('<5sH')
+ENTRY_SIZE = entry_format.size
+#a bucket is split into segments of this many entries, so that no
+#memcache value grows too large...
+SEGMENT_ENTRIES = 4096
+#...and holds at most this many. updates past it are dropped and the
+#bucket is marked as having overflowed
+MAX_ENTRIES = 16 * SEGMENT_ENTRIES
+#how long buckets are kept
+BUCKET_TIME = MAX_PERIOD + 2 * MIN_PERIOD
+
+def seq_key(bucket):
+    "the number of entries that have been added to bucket"
+    return cache_key(bucket) + '_seq'
+
+def segment_key(bucket, n):
+    return '%s_%d' % (cache_key(bucket), n)
+
+def seen_key(bucket, sup_id):
+    return '%s_seen_%s' % (cache_key(bucket), sup_id)
 
-    key = cache_key(make_cur_time(MIN_PERIOD))
-    g.cache.add(key, '')
-    g.cache.append(key, supdate)
+def add_update(user, action):
+    add_sup_id(make_sup_id(user, action), int(time.time()))
+
+def add_sup_id(sup_id, update_time):
+    bucket = update_time - update_time % MIN_PERIOD
+    mc = g.memcache
+
+    #a sup id only needs to be in a bucket once
+    if not mc.add(seen_key(bucket, sup_id), 1, time = BUCKET_TIME):
+        return
+
+    #the entry's position in the bucket picks its segment
+    mc.add(seq_key(bucket), 0, time = BUCKET_TIME)
+    seq = mc.incr(seq_key(bucket))
+    if not seq or seq > MAX_ENTRIES:
+        return
+
+    key = segment_key(bucket, (seq - 1) / SEGMENT_ENTRIES)
+    entry = entry_format.pack(sup_id.decode('hex'), update_time - bucket)
+    if not mc.append(key, entry):
+        #the first entry of the segment. another process may have got
+        #there first
+        if not mc.add(key, entry, time = BUCKET_TIME):
+            mc.append(key, entry)
+
+def read_bucket(bucket, start = 0):
+    """Returns the updates in bucket from position start on, as a list of
+    (sup_id, time), along with the position to read from next and
+    whether the bucket has overflowed"""
+    mc = g.memcache
+    count = int(mc.get(seq_key(bucket)) or 0)
+    overflowed = count > MAX_ENTRIES
+    count = min(count, MAX_ENTRIES)
+    if start >= count:
+        return [], start, overflowed
+
+    segments = range(start / SEGMENT_ENTRIES,
+                     (count - 1) / SEGMENT_ENTRIES + 1)
+    data = mc.get_multi([segment_key(bucket, n) for n in segments])
+
+    updates = []
+    next = start
+    for n in segments:
+        segment = data.get(segment_key(bucket, n))
+        if not segment:
+            continue
+        first = max(start - n * SEGMENT_ENTRIES, 0)
+        num = len(segment) / ENTRY_SIZE - first
+        if num <= 0:
+            continue
+        fields = struct.unpack('<' + '5sH' * num,
+                               segment[first * ENTRY_SIZE:
+                                       (first + num) * ENTRY_SIZE])
+        updates.extend((fields[i].encode('hex'), bucket + fields[i + 1])
+                       for i in xrange(0, len(fields), 2))
+        next = n * SEGMENT_ENTRIES + first + num
+    return updates, next, overflowed
+
+#bucket -> (updates, next position, overflowed) for the buckets this
+#process has read, so that it only fetches what has been added since
+bucket_reads = {}
+
+def bucket_updates(bucket):
+    """The updates in bucket, and whether it overflowed, reading only the
+    entries added since this process last read it"""
+    updates, next, overflowed = bucket_reads.get(bucket, ([], 0, False))
+    new, next, overflowed = read_bucket(bucket, next)
+    if new:
+        updates = updates + new
+    bucket_reads[bucket] = (updates, next, overflowed)
+
+    for old in bucket_reads.keys():
+        if old < bucket - BUCKET_TIME:
+            del bucket_reads[old]
+    return updates, overflowed
 
 @memoize('set_json', time = MAX_PERIOD)
 def sup_json_cached(period, last_time):
@@ -71,28 +161,30 @@ def sup_json_cached(period, last_time):
     #the call to make_last_time
     target_time = last_time + MIN_PERIOD - period
 
-    updates = ''
+    updates = []
+    overflowed = False
     #loop backwards adding MIN_PERIOD chunks until last_time is as old
     #as target time
     while last_time >= target_time:
-        updates += g.cache.get(cache_key(last_time)) or ''
+        u, o = bucket_updates(last_time)
+        updates.extend(u)
+        overflowed = overflowed or o
         last_time -= MIN_PERIOD
 
-    supdates = []
-    if updates:
-        for u in ifilter(None, updates.split(',')):
-            sup_id, time = u.split(':')
-            time = int(time)
-            if time >= target_time:
-                supdates.append([sup_id, to36(time)])
+    supdates = [[sup_id, to36(time)] for sup_id, time in updates
+                if time >= target_time]
 
     update_time = datetime.utcnow()
     since_time = datetime.utcfromtimestamp(target_time)
-    json = simplejson.dumps({'updated_time' : rfc3339_date_str(update_time),
-                             'since_time' : rfc3339_date_str(since_time),
-                             'period' : period,
-                             'available_periods' : period_urls(),
-                             'updates' : supdates})
+    sup = {'updated_time' : rfc3339_date_str(update_time),
+           'since_time' : rfc3339_date_str(since_time),
+           'period' : period,
+           'available_periods' : period_urls(),
+           'updates' : supdates}
+    #some updates were dropped, so clients can't rely on the list
+    if overflowed:
+        sup['overflowed'] = True
+    json = simplejson.dumps(sup)
 
     #undo json escaping
     json = json.replace('\/', '/')
@@ -25,7 +25,13 @@ from Crypto.Cipher import AES
 from random import choice
 from pylons import g, c
 from urllib import quote_plus, unquote_plus
-import sha
+from threading import local
+import sha, os
+try:
+    from Crypto.Util.strxor import strxor
+except ImportError:
+    # xor'ing in python costs more than keying a new cipher
+    strxor = None
 
 key_len = 16
 pad_len = 32
@@ -34,8 +40,7 @@ def pkcs5pad(text, padlen = 8):
     '''Insures the string is an integer multiple of padlen by appending to its end
     N characters which are chr(N).'''
     l = (padlen - len(text) % padlen) or padlen
-    padding = ''.join([chr(l) for x in xrange(0,l)])
-    return text + padding
+    return text + chr(l) * l
 
 def pkcs5unpad(text, padlen = 8):
     '''Undoes padding of pkcs5pad'''
@@ -51,10 +56,97 @@ def cipher(lv):
     key = g.tracking_secret
     return AES.new(key[:key_len], AES.MODE_CBC, lv[:key_len])
 
+class ChainedCipher(local):
+    '''
+    A CBC cipher for each thread, reused across messages instead of
+    keying a new one for each.
+
+    A CBC cipher encrypts each block xor'd with the ciphertext block
+    before it, starting with the IV, and carries that over between
+    calls. So a message can be given its own IV by xor'ing its first
+    block with the carried-over block and the IV, which gives the same
+    bytes as a fresh cipher would. Decrypting is the same, the other
+    way round.
+    '''
+    def __init__(self):
+        self.secret = None
+
+    def cipher(self):
+        if self.secret != g.tracking_secret:
+            self.secret = g.tracking_secret
+            self.last = '\0' * key_len
+            self.cip = AES.new(self.secret[:key_len], AES.MODE_CBC, self.last)
+        return self.cip
+
+    def encrypt(self, lv, text):
+        if not strxor:
+            return cipher(lv).encrypt(text)
+        cip = self.cipher()
+        try:
+            first = strxor(strxor(text[:key_len], lv[:key_len]), self.last)
+            res = cip.encrypt(first + text[key_len:])
+        except:
+            self.secret = None
+            raise
+        self.last = res[-key_len:]
+        return res
+
+    def decrypt(self, lv, text):
+        if not strxor:
+            return cipher(lv).decrypt(text)
+        if not text:
+            return text
+        cip = self.cipher()
+        try:
+            res = cip.decrypt(text)
+        except:
+            self.secret = None
+            raise
+        res = strxor(strxor(res[:key_len], lv[:key_len]), self.last) + res[key_len:]
+        self.last = text[-key_len:]
+        return res
+
+chained = ChainedCipher()
+
+def random_salts(n):
+    '''n random strings of pad_len characters from the base64
+    alphabet, from one read of urandom'''
+    per_salt = pad_len * 3 / 4
+    salts = b64enc(os.urandom(per_salt * n))
+    return [salts[i:i + pad_len] for i in xrange(0, pad_len * n, pad_len)]
+
+def quote_b64(text):
+    '''quote_plus(text, safe='') for base64 text, which can only have
+    these three characters in need of quoting'''
+    return text.replace('+', '%2B').replace('/', '%2F').replace('=', '%3D')
+
 def encrypt(text):
     '''generates an encrypted version of text.  The encryption is salted using the pad_len characters
     that randomly make up the front of the resulting string.  The string is base64 encoded, and url escaped
     so as to be suitable to be used as a GET parameter'''
+    return encrypt_many([text])[0]
+
+def encrypt_many(texts):
+    '''encrypt for each of texts, sharing a cipher and one random read'''
+    res = []
+    for randstr, text in zip(random_salts(len(texts)), texts):
+        text = b64enc(chained.encrypt(randstr, pkcs5pad(text, key_len)))
+        res.append(quote_b64(randstr + text))
+    return res
+
+def decrypt(text):
+    '''Inverts encrypt'''
+    # we can unquote even if text is not quoted.  
+    text = unquote_plus(text)
+    # grab salt
+    randstr = text[:pad_len]
+    # grab message
+    text = text[pad_len:]
+    return pkcs5unpad(chained.decrypt(randstr, b64dec(text)), key_len)
+
+def encrypt_simple(text):
+    '''encrypt as it was written before ChainedCipher, with a new
+    cipher for each call, to check and benchmark against'''
     randstr = ''.join(choice('1234567890abcdefghijklmnopqrstuvwxyz' +
                              'ABCDEFGHIJKLMNOPQRSTUVWXYZ+/')
                       for x in xrange(pad_len))
@@ -62,13 +154,9 @@ def encrypt(text):
     text = b64enc(cip.encrypt(pkcs5pad(text, key_len)))
     return quote_plus(randstr + text, safe='')
 
-def decrypt(text):
-    '''Inverts encrypt'''
-    # we can unquote even if text is not quoted.  
+def decrypt_simple(text):
     text = unquote_plus(text)
-    # grab salt
     randstr = text[:pad_len]
-    # grab message
     text = text[pad_len:]
     cip = cipher(randstr)
     return pkcs5unpad(cip.decrypt(b64dec(text)), key_len)
@@ -182,15 +270,3 @@ class AdframeInfo(PromotedLinkInfo):
     def make_hash(cls, ip, fullname):
         return sha.new("%s%s" % (fullname,
                                  g.tracking_secret)).hexdigest()
-
-
-
-def benchmark(n = 10000):
-    """on my humble desktop machine, this gives ~150 microseconds per gen_url"""
-    import time
-    t = time.time()
-    for x in xrange(n):
-        gen_url()
-    t = time.time() - t
-    print ("%d generations in %5.3f seconds (%5.3f us/gen)" % 
-           (n, t, 10**6 * t/n))
@@ -19,29 +19,38 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2009
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
-from httplib import HTTPConnection
+from __future__ import with_statement
+
+from httplib import HTTPConnection, HTTPException
 from urlparse import urlparse
-from cPickle import loads
+from cPickle import loads, dumps
 from utils import query_string
-import os, socket, time, datetime
+from Queue import Queue, Empty
+import os, socket, time, datetime, threading, sha
 from pylons import g
-from r2.lib.memoize import memoize, clear_memo
 
-def load_traffic_uncached(interval, what, iden, 
-                          start_time = None, stop_time = None,
-                          npoints = None):
-    """
-    Fetches pickled traffic from the traffic server and returns it as a list.
-    On connection failure (or no data) returns an empy list. 
-    """
-    def format_date(d):
-        if d.tzinfo is None:
-            d = d.replace(tzinfo = g.tz)
-        else:
-            d = d.astimezone(g.tz)
-        return ":".join(map(str, d.timetuple()[:6]))
-    
-    traffic_url = os.path.join(g.traffic_url, interval, what, iden)
+#seconds before a cached series is brought up to date
+refresh_time = 60
+#seconds to wait on the traffic server
+timeout = 5
+#most requests to make to the traffic server at once
+max_fetchers = 8
+#a cached series is fetched whole again after this long. in between,
+#refreshes only fetch its last refetch_window of points, which the
+#server may still be filling in
+series_time = 86400
+refetch_window = datetime.timedelta(days = 1)
+
+def format_date(d):
+    if d.tzinfo is None:
+        d = d.replace(tzinfo = g.tz)
+    else:
+        d = d.astimezone(g.tz)
+    return ":".join(map(str, d.timetuple()[:6]))
+
+def series_path(interval, what, iden, start_time = None, stop_time = None,
+                npoints = None):
+    "the path (and query) of a series on the traffic server"
     args = {}
     if start_time:
         args['start_time'] = format_date(start_time)
@@ -49,33 +58,176 @@ def load_traffic_uncached(interval, what, iden,
         args['stop_time'] = format_date(stop_time)
     if npoints:
         args['n'] = npoints
-    u = urlparse(traffic_url)
+    path = urlparse(os.path.join(g.traffic_url, interval, what, iden)).path
+    return path + query_string(args)
+
+def connect():
+    u = urlparse(g.traffic_url)
+    conn = HTTPConnection(u.hostname, u.port)
+    conn.connect()
+    conn.sock.settimeout(timeout)
+    return conn
+
+def fetch(conn, method, path, body = None):
+    """Requests path over conn, returning the response's status and,
+    if it's a 200, the unpickled response (None otherwise)"""
+    conn.request(method, path, body)
+    res = conn.getresponse()
+    data = res.read()
+    return res.status, loads(data) if res.status == 200 else None
+
+#whether the traffic server has a /batch endpoint, which takes a
+#pickled list of paths and returns a pickled list of their series
+batch_supported = True
+
+def fetch_batch(paths):
+    """Fetches the series at paths in one request, returning None if the
+    server can't batch"""
+    global batch_supported
+    if not batch_supported:
+        return None
     try:
-        conn = HTTPConnection(u.hostname, u.port)
-        conn.request("GET", u.path + query_string(args))
-        res = conn.getresponse()
-        res = loads(res.read()) if res.status == 200 else []
-        conn.close()
-        return res
-    except socket.error:
+        conn = connect()
+        try:
+            status, res = fetch(conn, "POST",
+                                urlparse(g.traffic_url).path + "/batch",
+                                dumps(paths))
+        finally:
+            conn.close()
+    except (socket.error, HTTPException):
+        return None
+    #only stop trying if there's no /batch, rather than on errors that
+    #would fail the single fetches as well
+    if status in (404, 405):
+        batch_supported = False
+    return res
+
+def fetch_concurrently(paths):
+    """Fetches the series at paths from up to max_fetchers threads, each
+    keeping its connection open between requests. Series that fail
+    come back empty"""
+    results = {}
+    todo = Queue()
+    for path in paths:
+        todo.put(path)
+
+    def fetcher():
+        conn = None
+        try:
+            while True:
+                try:
+                    path = todo.get_nowait()
+                except Empty:
+                    return
+                try:
+                    conn = conn or connect()
+                    status, res = fetch(conn, "GET", path)
+                    results[path] = res or []
+                except (socket.error, HTTPException):
+                    results[path] = []
+                    if conn:
+                        conn.close()
+                    conn = None
+        finally:
+            if conn:
+                conn.close()
+
+    threads = [threading.Thread(target = fetcher)
+               for x in xrange(min(max_fetchers, len(paths)))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join(timeout * 2)
+    return [results.get(path, []) for path in paths]
+
+def fetch_many(paths):
+    if not paths:
         return []
+    res = fetch_batch(paths) if len(paths) > 1 else None
+    if res is None:
+        res = fetch_concurrently(paths)
+    return res
 
-@memoize("cached_traffic", time = 60)
-def load_traffic(interval, what, iden = '', 
-                 start_time = None, stop_time = None,
-                 npoints = None):
+def series_key(path):
+    return 'traffic_series_' + sha.new(path).hexdigest()
+
+def load_traffic_multi(series):
     """
-     interval = (hour, day, month)
-     
-     what = (reddit, lang, thing, promos)
-     
-     iden is the specific thing (reddit name, language name, thing
-     fullname) that one is seeking traffic for.
+    Loads several traffic series at once, each given as the tuple of
+    arguments to load_traffic_uncached. Cached series are found in one
+    memcache get. Those that are missing, or were last fetched whole
+    more than series_time ago, are fetched in one batch; those that are
+    stale only ask the server for the points from refetch_window before
+    their last one on, which replace the ones they overlap.
     """
-    res = load_traffic_uncached(interval, what, iden, 
-                                start_time = start_time, stop_time = stop_time,
-                                npoints = npoints)
+    series = [tuple(s) + (None,) * (6 - len(s)) for s in series]
+    paths = [series_path(*s) for s in series]
+    cached = g.cache.get_multi(set(series_key(p) for p in paths))
+
+    now = time.time()
+    need, fetch_paths = [], []
+    results, fetched = {}, {}
+    for s, path in zip(series, paths):
+        if path in results or path in need:
+            continue
+        #entries are (time refreshed, points, time fetched whole)
+        entry = cached.get(series_key(path))
+        if entry and now - entry[0] < refresh_time:
+            results[path] = entry[1]
+            continue
+
+        interval, what, iden, start_time, stop_time, npoints = s
+        points = entry[1] if entry else None
+        if (points and isinstance(points[-1][0], datetime.datetime)
+            and now - entry[2] < series_time):
+            #the recent points may have been partial
+            since = points[-1][0] - refetch_window
+            if start_time:
+                #naive times are in g.tz, as in format_date
+                since = max(since, start_time.tzinfo and start_time or
+                                   start_time.replace(tzinfo = g.tz))
+            fetch_paths.append(series_path(interval, what, iden,
+                                           start_time = since,
+                                           stop_time = stop_time))
+            fetched[path] = entry[2]
+        else:
+            points = None
+            fetch_paths.append(path)
+            fetched[path] = now
+        need.append(path)
+        results[path] = points
+
+    updates = {}
+    for path, new in zip(need, fetch_many(fetch_paths)):
+        old = results[path]
+        if old and new:
+            points = [p for p in old if p[0] < new[0][0]] + list(new)
+            #an npoints series stays the same length
+            npoints = series[paths.index(path)][5]
+            if npoints:
+                points = points[-npoints:]
+        else:
+            points = new or old or []
+        results[path] = points
+        if points:
+            updates[series_key(path)] = (now, points, fetched[path])
+    if updates:
+        g.cache.set_multi(updates, time = series_time)
+
+    return [results[path] for path in paths]
 
+def load_traffic_uncached(interval, what, iden, 
+                          start_time = None, stop_time = None,
+                          npoints = None):
+    """
+    Fetches pickled traffic from the traffic server and returns it as a list.
+    On connection failure (or no data) returns an empy list. 
+    """
+    return fetch_many([series_path(interval, what, iden, start_time,
+                                   stop_time, npoints)])[0]
+
+def localize(interval, res):
     if res and isinstance(res[0][0], datetime.datetime):
         dates, data = zip(*res)
         if interval == 'hour':
@@ -87,7 +239,26 @@ def load_traffic(interval, what, iden = '',
             dates = [x.date() for x in dates]
         res = zip(dates, data)
     return res
-    
+
+def load_traffic(interval, what, iden = '', 
+                 start_time = None, stop_time = None,
+                 npoints = None):
+    """
+     interval = (hour, day, month)
+     
+     what = (reddit, lang, thing, promos)
+     
+     iden is the specific thing (reddit name, language name, thing
+     fullname) that one is seeking traffic for.
+    """
+    return load_traffic_many([(interval, what, iden, start_time,
+                               stop_time, npoints)])[0]
+
+def load_traffic_many(series):
+    """load_traffic for several series, given as tuples of its
+    arguments, loaded together by load_traffic_multi"""
+    res = load_traffic_multi(series)
+    return [localize(s[0], r) for s, r in zip(series, res)]
 
 def load_summary(what, interval = "month", npoints = 50):
     return load_traffic(interval, "summary", what, npoints = npoints)
@@ -83,3 +83,279 @@ def bench_cache_lifetime_multi(attempts=10, minutes=60*24):
                % (x+1, attempts, this_attempt, minimum, maximum, mean))
 
     return (minimum, maximum, mean)
+
+def bench_thumbnails(path):
+    """
+    Times scraper.prepare_image against cropping and resizing at full
+    size for each image in the directory path, and reports the mean
+    pixel difference between the two thumbnails (0-255).
+
+    Example:
+        paster run production.ini r2/lib/utils/cmd_utils.py -c "bench_thumbnails('/tmp/images')"
+    """
+    import os, time
+    import Image, ImageChops, ImageStat
+    from r2.lib.scraper import (square_image, prepare_image, str_to_image,
+                                thumbnail_size)
+
+    def full_size(image):
+        image = square_image(image)
+        image.thumbnail(thumbnail_size, Image.ANTIALIAS)
+        return image
+
+    totals = {full_size: 0., prepare_image: 0.}
+    worst = 0
+    for fname in sorted(os.listdir(path)):
+        f = open(os.path.join(path, fname))
+        data = f.read()
+        f.close()
+
+        thumbs = {}
+        try:
+            for fn in totals.keys():
+                start = time.time()
+                thumbs[fn] = fn(str_to_image(data))
+                totals[fn] += time.time() - start
+        except IOError:
+            continue
+
+        a, b = thumbs[full_size], thumbs[prepare_image]
+        #rounding can leave the thumbnails a pixel apart in size
+        size = min(a.size[0], b.size[0]), min(a.size[1], b.size[1])
+        a = a.convert('RGB').crop((0, 0) + size)
+        b = b.convert('RGB').crop((0, 0) + size)
+        diff = ImageStat.Stat(ImageChops.difference(a, b)).mean
+        diff = sum(diff) / len(diff)
+        worst = max(worst, diff)
+        print '%s: %.1f' % (fname, diff)
+
+    print 'full size: %.3fs, reduced: %.3fs, worst difference: %.1f' % \
+          (totals[full_size], totals[prepare_image], worst)
+
+def bench_search_documents(cls_name = 'Link', num = 5000, rounds = 3):
+    """
+    Times solrsearch.build_documents against tokenize_things on the
+    num newest Things of the class named cls_name, after checking that
+    both build the same documents
+
+    Example:
+        paster run production.ini r2/lib/utils/cmd_utils.py -c "bench_search_documents('Comment')"
+    """
+    import time
+    from pylons import g
+    from r2 import models
+    from r2.lib.cache import SelfEmptyingCache
+    from r2.lib.db.operators import desc
+    from r2.lib.solrsearch import tokenize_things, build_documents
+
+    cls = getattr(models, cls_name)
+    things = list(cls._query(sort = desc('_date'), limit = num, data = True))
+    if tokenize_things(things, True) != build_documents(things, True):
+        print "documents differ!"
+        return
+
+    for fn in (tokenize_things, build_documents):
+        best = None
+        for x in xrange(rounds):
+            # don't let the local cache hide the lookups
+            g.cache.caches = (SelfEmptyingCache(),) + g.cache.caches[1:]
+            start = time.time()
+            fn(things)
+            elapsed = time.time() - start
+            best = min(best, elapsed) if best else elapsed
+        print "%s: %d docs in %.3fs (%.0f docs/s)" % (fn.__name__, len(things),
+                                                     best, len(things) / best)
+
+def bench_recommendation_records(sizes = (10, 100, 1000, 10000), rounds = 20):
+    """
+    Times recommendation.decode_record against decoding with grab_int,
+    one int at a time, on random records with sizes entries
+
+    Example:
+        paster run production.ini r2/lib/utils/cmd_utils.py -c "bench_recommendation_records()"
+    """
+    import random, time
+    from r2.lib.recommendation import encode_record, decode_record, grab_int
+
+    def decode_loop(entry):
+        record_size = ord(entry[0])
+        num_records = grab_int(entry, 1, record_size)
+        keys, values = [], []
+        for i in range(num_records):
+            start = (i + 1) * record_size
+            keys.append(grab_int(entry, start, start + record_size - 1))
+            value = ord(entry[start + record_size - 1]) / 128.
+            values.append(value - 2 if value > 1 else value)
+        return keys, values
+
+    for size in sizes:
+        keys = [random.randint(0, 1 << 31) for x in xrange(size)]
+        values = [random.randint(-127, 128) / 128. for x in xrange(size)]
+        entry = encode_record(keys, values)
+
+        times = []
+        for fn in (decode_loop, decode_record):
+            start = time.time()
+            for x in xrange(rounds):
+                fn(entry)
+            times.append((time.time() - start) / rounds)
+        print "%6d entries: grab_int %.5fs, struct %.5fs" % ((size,) + tuple(times))
+
+def bench_sup_buckets(rate = 2000, seconds = 10, read_every = .5):
+    """
+    Adds distinct updates to one sup bucket at `rate` a second for
+    `seconds`, reading the bucket every `read_every` seconds both whole
+    and from where the last read stopped, and reports the mean latency
+    of each kind of read
+
+    Example:
+        paster run production.ini r2/lib/utils/cmd_utils.py -c "bench_sup_buckets()"
+    """
+    import random, time
+    from r2.lib.sup import MIN_PERIOD, add_sup_id, read_bucket
+
+    now = int(time.time())
+    bucket = now - now % MIN_PERIOD
+
+    full, incremental = [], []
+    next = 0
+    start = last_read = time.time()
+    added = 0
+    while time.time() - start < seconds:
+        #keep up with the target rate
+        while added < (time.time() - start) * rate:
+            add_sup_id('%010x' % random.getrandbits(40), bucket)
+            added += 1
+
+        if time.time() - last_read >= read_every:
+            last_read = time.time()
+            t = time.time()
+            read_bucket(bucket)
+            full.append(time.time() - t)
+
+            t = time.time()
+            updates, next, overflowed = read_bucket(bucket, next)
+            incremental.append(time.time() - t)
+
+    def ms(l):
+        return 1000 * sum(l) / max(len(l), 1)
+    print ("%d updates (%d/s): whole bucket %.2fms, new entries %.2fms"
+           % (added, added / seconds, ms(full), ms(incremental)))
+
+def bench_rpc(calls = 1000, threads = 1, batch = 0, connections = 1,
+              port = 5010):
+    """
+    Makes `calls` echo calls from each of `threads` to a local rpc
+    server over TCP, `batch` at a time if batch is set, and reports the
+    throughput and per call latency
+
+    Example:
+        paster run production.ini r2/lib/utils/cmd_utils.py -c "bench_rpc(threads = 10, batch = 50)"
+    """
+    import time
+    from threading import Thread
+    from r2.lib.rpc import Server, Client, TH
+
+    server = Server(TH(), addr = 'localhost', port = port, tcp = True)
+    client = Client(port = port, tcp = True, connections = connections)
+
+    latencies = []
+    def run():
+        times = []
+        for x in xrange(0, calls, batch or 1):
+            start = time.time()
+            if batch:
+                b = client.batch()
+                for y in xrange(batch):
+                    b.call.echo('test')
+                b.run()
+            else:
+                client.call.echo('test')
+            times.append(time.time() - start)
+        latencies.extend(times)
+
+    start = time.time()
+    workers = [Thread(target = run) for x in xrange(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+    server.stop()
+
+    latencies.sort()
+    print "%d calls in %.2fs: %d/s, latency median %.2fms, 99%% %.2fms" % (
+        calls * threads, elapsed, calls * threads / elapsed,
+        latencies[len(latencies) / 2] * 1000,
+        latencies[int(len(latencies) * .99)] * 1000)
+
+def bench_metrics(n = 1000000):
+    """
+    Times counter.incr and histogram.observe, n calls of each
+
+    Example:
+        paster run production.ini r2/lib/utils/cmd_utils.py -c "bench_metrics()"
+    """
+    import time
+    from r2.lib import metrics
+
+    c = metrics.counter('benchmark.counter')
+    h = metrics.histogram('benchmark.histogram')
+    start = time.time()
+    for x in xrange(n):
+        c.incr()
+    t1 = time.time()
+    for x in xrange(n):
+        h.observe(.01)
+    t2 = time.time()
+    print "counter.incr: %.2fus, histogram.observe: %.2fus" % (
+        (t1 - start) / n * 1e6, (t2 - t1) / n * 1e6)
+
+def bench_tracking(n = 1000, listing = 25):
+    """
+    Times the tracking payloads of n pages of `listing` links each,
+    encrypted one at a time with a new cipher each (encrypt_simple),
+    one at a time with the chained cipher, and a page at a time with
+    encrypt_many
+
+    Example:
+        paster run production.ini r2/lib/utils/cmd_utils.py -c "bench_tracking()"
+    """
+    import time
+    from r2.lib.tracking import encrypt, encrypt_simple, encrypt_many
+
+    payloads = ['|'.join(('t3_%d' % (i * 1000 + x), 'pics', 'en', 'False'))
+                for x in xrange(listing)
+                for i in xrange(n)]
+    pages = [payloads[i:i + listing]
+             for i in xrange(0, len(payloads), listing)]
+
+    for name, fn in (("new cipher per call",
+                      lambda page: map(encrypt_simple, page)),
+                     ("chained cipher", lambda page: map(encrypt, page)),
+                     ("encrypt_many", encrypt_many)):
+        t = time.time()
+        for page in pages:
+            fn(page)
+        t = time.time() - t
+        print ("%s: %d pages in %5.3f seconds (%5.3f us/payload)" %
+               (name, n, t, 10**6 * t / len(payloads)))
+
+def bench_filters(text, n = 1000):
+    """
+    Prints the time a call of each filter takes on text, in python and
+    in Cfilters
+
+    Example:
+        paster run production.ini r2/lib/utils/cmd_utils.py -c "bench_filters(open('page.html').read())"
+    """
+    import time
+    from r2.lib.filters import _native_pairs
+
+    for name, py, native in _native_pairs():
+        for label, fn in (('python', py), ('native', native)):
+            start = time.time()
+            for i in xrange(n):
+                fn(text)
+            print '%-16s %-6s %.2fus' % (name, label,
+                                         (time.time() - start) * 1e6 / n)
@@ -34,14 +34,22 @@ from r2.lib.wrapped import Wrapped
 from r2.lib import utils
 from r2.lib.db import operators
 from r2.lib.cache import sgm
-from r2.lib.comment_tree import link_comments
+from r2.lib.comment_tree import link_comments, link_comment_sort
+from r2.lib.pagination import Cursor, SortStub, make_cursor, cursor_index
 from copy import deepcopy, copy
 
+import heapq
 import time
+import sha
 from datetime import datetime,timedelta
 from admintools import compute_votes, admintools, ip_span
 
 EXTRA_FACTOR = 1.5
+MAX_EXTRA_FACTOR = 10
+#weight of the newest observation in a listing's filter survival rate
+SURVIVAL_WEIGHT = .2
+SURVIVAL_CACHE_TIME = 60 * 60
+FILTERED_CACHE_TIME = 30
 MAX_RECURSION = 10
 
 class Builder(object):
@@ -221,6 +229,10 @@ class Builder(object):
     def get_items(self):
         raise NotImplementedError
 
+    def make_cursor(self, item):
+        """Returns the Cursor for a page starting after (or before) item"""
+        return Cursor.from_item(item)
+
     def item_iter(self, *a):
         """Iterates over the items returned by get_items"""
         raise NotImplementedError
@@ -240,7 +252,7 @@ class QueryBuilder(Builder):
         self.skip = skip
         self.num = kw.get('num')
         self.start_count = kw.get('count', 0) or 0
-        self.after = kw.get('after')
+        self.after = make_cursor(kw.get('after'))
         self.reverse = kw.get('reverse')
         
         self.prewrap_fn = None
@@ -248,6 +260,15 @@ class QueryBuilder(Builder):
             self.prewrap_fn = query.prewrap_fn
         #self.prewrap_fn = kw.get('prewrap_fn')
 
+        #identifies the listing for the survival rate and filtered
+        #caches. set by init_query for builders that have one
+        self.iden = None
+        #the number of items run through the filters and the number
+        #that were kept, for the survival rate
+        self.num_checked = 0
+        self.num_kept = 0
+        self._extra_factor = None
+
     def item_iter(self, a):
         """Iterates over the items returned by get_items"""
         for i in a[0]:
@@ -260,9 +281,64 @@ class QueryBuilder(Builder):
             q._reverse()
 
         q._data = True
+        self.iden = q._iden()
         self.orig_rules = deepcopy(q._rules)
         if self.after:
-            q._after(self.after)
+            #seek with the cursor's sort values if it has them, rather
+            #than loading the thing. merged queries have no kind of
+            #their own to build the rules from
+            cols = [s.col for s in q._sort]
+            if q._kind is not None and self.after.has_sort(cols):
+                q._after(SortStub(q._kind, self.after, cols))
+            else:
+                q._after(self.after)
+
+    def make_cursor(self, item):
+        return Cursor.from_item(item,
+                                sort_cols = [s.col for s in self.query._sort])
+
+    def survival_key(self):
+        if self.iden:
+            user_type = 'user' if c.user_is_loggedin else 'nouser'
+            return 'survival_%s_%s' % (user_type, self.iden)
+
+    def extra_factor(self):
+        """How many items to fetch per item still needed, based on the
+        fraction of this listing's items that survived the filters on
+        previous requests. It's looked up once per builder"""
+        if self._extra_factor is None:
+            key = self.survival_key()
+            rate = g.cache.get(key) if key else None
+            if rate is None:
+                self._extra_factor = EXTRA_FACTOR
+            else:
+                rate = max(rate, 1. / MAX_EXTRA_FACTOR)
+                self._extra_factor = min(1.1 / rate, MAX_EXTRA_FACTOR)
+        return self._extra_factor
+
+    def update_survival(self):
+        key = self.survival_key()
+        if not key or not self.num_checked:
+            return
+        observed = float(self.num_kept) / self.num_checked
+        rate = g.cache.get(key)
+        if rate is None:
+            new_rate = observed
+        else:
+            new_rate = (1 - SURVIVAL_WEIGHT) * rate + SURVIVAL_WEIGHT * observed
+        #don't bother memcache with small changes
+        if rate is None or abs(new_rate - rate) > .05:
+            g.cache.set(key, new_rate, SURVIVAL_CACHE_TIME)
+
+    def filtered_key(self):
+        """Key for caching the filtered listing. The filters only
+        depend on the user, so logged out users all share the result"""
+        if (self.iden and self.skip and not c.user_is_loggedin
+            and not self.prewrap_fn):
+            after = self.after._fullname if self.after else ''
+            key = '%s_%s_%s_%s_%s' % (self.iden, request.path, after,
+                                      self.num, self.reverse)
+            return 'filtered_' + sha.new(key).hexdigest()
 
     def fetch_more(self, last_item, num_have):
         done = False
@@ -276,10 +352,12 @@ class QueryBuilder(Builder):
                 #q = self.query
                 #check last_item if we have a num because we may need to iterate
                 if last_item:
+                    #_filter adds to the rules in place (and a MultiQuery's
+                    #are a list of lists), so start from a full copy
                     q._rules = deepcopy(self.orig_rules)
                     q._after(last_item)
                     last_item = None
-                q._limit = max(int(num_need * EXTRA_FACTOR), 1)
+                q._limit = max(int(num_need * self.extra_factor()), 1)
         else:
             done = True
         new_items = list(q)
@@ -289,6 +367,12 @@ class QueryBuilder(Builder):
     def get_items(self):
         self.init_query()
 
+        filtered_key = self.filtered_key()
+        if filtered_key:
+            r = g.cache.get(filtered_key)
+            if r:
+                return self.get_filtered_items(*r)
+
         num_have = 0
         done = False
         items = []
@@ -340,9 +424,11 @@ class QueryBuilder(Builder):
             #skip and count
             while new_items and (not self.num or num_have < self.num):
                 i = new_items.pop(0)
+                self.num_checked += 1
                 if not (self.must_skip(i) or self.skip and not self.keep_item(i)):
                     items.append(i)
                     num_have += 1
+                    self.num_kept += 1
                     if self.wrap:
                         count = count - 1 if self.reverse else count + 1
                         i.num = count
@@ -352,13 +438,46 @@ class QueryBuilder(Builder):
             if self.prewrap_fn and last_item:
                 last_item = orig_items[last_item._id]
 
+        self.update_survival()
+
+        if filtered_key:
+            g.cache.set(filtered_key,
+                        ([i._fullname for i in items],
+                         first_item and first_item._fullname,
+                         have_next and last_item and last_item._fullname),
+                        FILTERED_CACHE_TIME)
+
+        return self.finish_items(items, count, first_item,
+                                 have_next and last_item)
+
+    def get_filtered_items(self, names, first_name, last_name):
+        """Rebuilds the listing from a cached filtered result, skipping
+        the fetch and filter loop"""
+        things = Thing._by_fullname(filter(None, names +
+                                           [first_name, last_name]),
+                                    data = True, return_dict = True)
+        items = [things[n] for n in names if n in things]
+        first_item = things.get(first_name)
+        last_item = things.get(last_name)
+
+        if self.wrap:
+            items = self.wrap_items(items)
+
+        count = self.start_count
+        for i in items:
+            if self.wrap:
+                count = count - 1 if self.reverse else count + 1
+                i.num = count
+
+        return self.finish_items(items, count, first_item, last_item)
+
+    def finish_items(self, items, count, first_item, last_item):
         if self.reverse:
             items.reverse()
-            last_item, first_item = first_item, have_next and last_item
+            last_item, first_item = first_item, last_item
             before_count = count
             after_count = self.start_count - 1
         else:
-            last_item = have_next and last_item
             before_count = self.start_count + 1
             after_count = count
 
@@ -371,18 +490,29 @@ class QueryBuilder(Builder):
 
 class IDBuilder(QueryBuilder):
     def init_query(self):
+        #precomputed listings (queries.CachedResults) can be identified
+        self.iden = getattr(self.query, 'iden', None)
         names = self.names = list(tup(self.query))
 
-        if self.reverse:
-            names.reverse()
-
+        #the names are always read in their listing order, so that
+        #positions in cursors are the same for both directions. pos is
+        #the index of the next name to read
+        self.positions = {}
         if self.after:
-            try:
-                i = names.index(self.after._fullname)
-            except ValueError:
-                self.names = ()
+            data = sort = None
+            if hasattr(self.query, 'sort_cols'):
+                data, sort = self.query.data, self.query.query._sort
+            i = cursor_index(names, self.after, data, sort or ())
+            if i is None:
+                self.pos = -1 if self.reverse else len(names)
             else:
-                self.names = names[i + 1:]
+                self.pos = i - 1 if self.reverse else i + 1
+        else:
+            self.pos = len(names) - 1 if self.reverse else 0
+
+    def make_cursor(self, item):
+        return Cursor.from_item(item, self.positions.get(item._fullname),
+                                getattr(self.query, 'sort_cols', ()))
 
     def fetch_more(self, last_item, num_have):
         done = False
@@ -394,12 +524,28 @@ class IDBuilder(QueryBuilder):
             else:
                 if last_item:
                     last_item = None
-                slice_size = max(int(num_need * EXTRA_FACTOR), 1)
+                slice_size = max(int(num_need * self.extra_factor()), 1)
         else:
             slice_size = len(names)
             done = True
 
-        self.names, new_names = names[slice_size:], names[:slice_size]
+        if self.reverse:
+            start = max(self.pos - slice_size + 1, 0)
+            indices = range(self.pos, start - 1, -1)
+            self.pos = start - 1
+        else:
+            end = min(self.pos + slice_size, len(names))
+            indices = range(self.pos, end)
+            self.pos = end
+
+        new_names = []
+        for i in indices:
+            self.positions[names[i]] = i
+            new_names.append(names[i])
+
+        if not new_names:
+            return done, []
+
         new_items = Thing._by_fullname(new_names, data = True, return_dict=False)
 
         return done, new_items
@@ -410,7 +556,18 @@ class SearchBuilder(QueryBuilder):
         self.total_num = 0
         self.start_time = time.time()
 
-        self.start_time = time.time()
+        #with a position to start from, solr can be asked for just the
+        #page. start is the index of the next result going forward, or
+        #the index just past it going backwards
+        self.positions = {}
+        self.start = 0
+        if self.after:
+            self.start = None
+            if self.after.position is not None:
+                self.start = self.after.position + (0 if self.reverse else 1)
+
+    def make_cursor(self, item):
+        return Cursor.from_item(item, self.positions.get(item._fullname))
 
     def keep_item(self,item):
         # doesn't use the default keep_item because we want to keep
@@ -432,13 +589,23 @@ class SearchBuilder(QueryBuilder):
             if num_need <= 0:
                 return True, None
             else:
-                limit = max(int(num_need * EXTRA_FACTOR), 1)
+                limit = max(int(num_need * self.extra_factor()), 1)
         else:
             done = True
 
+        #paging backwards has reached the first result
+        if self.reverse and self.start == 0:
+            return True, None
+
         search = self.query.run(after = last_item or self.after,
                                 reverse = self.reverse,
-                                num = limit)
+                                num = limit, start = self.start)
+        self.positions.update(getattr(search, 'positions', {}))
+        if self.start is not None and limit:
+            if self.reverse:
+                self.start = max(self.start - limit, 0)
+            else:
+                self.start += limit
 
         new_items = Thing._by_fullname(search.docs, data = True, return_dict=False)
 
@@ -446,6 +613,16 @@ class SearchBuilder(QueryBuilder):
 
         return done, new_items
 
+class CommentStub(object):
+    """Stands in for a comment that is only referenced by id (e.g. in
+    the children of a MoreChildren link) so that it needn't be loaded"""
+    def __init__(self, cid):
+        self._id = cid
+        self._id36 = utils.to36(cid)
+        self._fullname = '%s%s_%s' % (Comment._type_prefix,
+                                      utils.to36(Comment._type_id),
+                                      self._id36)
+
 class CommentBuilder(Builder):
     def __init__(self, link, sort, comment = None, context = None,
                  load_more=True, continue_this_thread=True,
@@ -458,10 +635,7 @@ class CommentBuilder(Builder):
         self.max_depth = max_depth
         self.continue_this_thread = continue_this_thread
 
-        if sort.col == '_date':
-            self.sort_key = lambda x: x._date
-        else:
-            self.sort_key = lambda x: (getattr(x, sort.col), x._date)
+        self.sort = sort
         self.rev_sort = True if isinstance(sort, operators.desc) else False
 
     def item_iter(self, a):
@@ -474,11 +648,20 @@ class CommentBuilder(Builder):
     def get_items(self, num, starting_depth = 0):
         r = link_comments(self.link._id)
         cids, comment_tree, depth, num_children = r
-        if cids:
-            comments = set(Comment._byID(cids, data = True, 
-                                         return_dict = False))
-        else:
-            comments = ()
+
+        #the tree only has parent -> children, so invert it to walk up
+        parents = {}
+        for p_id, children in comment_tree.iteritems():
+            for cid in children:
+                parents[cid] = p_id
+
+        #the comments are ordered by the precomputed sort orders so
+        #that we only need to load the comments that will be displayed.
+        #ties go to the newest comment (ids are increasing with date)
+        values, order = link_comment_sort(self.link._id, self.sort.col)
+        sign = -1 if self.rev_sort else 1
+        def sort_key(cid):
+            return (sign * values.get(cid, 0), sign * cid)
 
         def empty_listing(*things):
             parent_name = None
@@ -491,79 +674,98 @@ class CommentBuilder(Builder):
             l = Listing(None, None, parent_name = parent_name)
             l.things = list(things)
             return Wrapped(l)
-            
-        comment_dict = dict((cm._id, cm) for cm in comments)
 
-        #convert tree into objects
-        for k, v in comment_tree.iteritems():
-            comment_tree[k] = [comment_dict[cid] for cid in comment_tree[k]]
+        #overrides to the cached tree for permalinks with context, so
+        #that the cached tree is never modified
+        tree_override = {}
+        def children_of(cid):
+            if cid in tree_override:
+                return tree_override[cid]
+            siblings = order.get(cid, ())
+            if self.rev_sort:
+                siblings = reversed(siblings)
+            return [child for value, child in siblings]
 
-        items = []
         extra = {}
         top = None
         dont_collapse = []
         #loading a portion of the tree
         if isinstance(self.comment, utils.iters):
-            candidates = []
-            candidates.extend(self.comment)
-            dont_collapse.extend(cm._id for cm in self.comment)
-            #assume the comments all have the same parent
-            # TODO: removed by Chris to get rid of parent being sent
-            # when morecomments is used.  
-            #if hasattr(candidates[0], "parent_id"):
-            #    parent = comment_dict[candidates[0].parent_id]
-            #    items.append(parent)
+            candidates = sorted((cm._id for cm in self.comment),
+                                key = sort_key)
+            dont_collapse.extend(candidates)
         #if permalink
         elif self.comment:
-            top = self.comment
-            dont_collapse.append(top._id)
+            top = self.comment._id
+            dont_collapse.append(top)
             #add parents for context
-            while self.context > 0 and hasattr(top, 'parent_id'):
+            while self.context > 0 and parents.get(top):
                 self.context -= 1
-                new_top = comment_dict[top.parent_id]
-                comment_tree[new_top._id] = [top]
-                num_children[new_top._id] = num_children[top._id] + 1
-                dont_collapse.append(new_top._id)
+                new_top = parents[top]
+                tree_override[new_top] = [top]
+                num_children[new_top] = num_children[top] + 1
+                dont_collapse.append(new_top)
                 top = new_top
             candidates = [top]
         #else start with the root comments
         else:
-            candidates = []
-            candidates.extend(comment_tree.get(top, ()))
+            candidates = children_of(None)
 
         #update the starting depth if required
-        if top and depth[top._id] > 0:
-            delta = depth[top._id]
-            for k, v in depth.iteritems():
-                depth[k] = v - delta
-
-        def sort_candidates():
-            candidates.sort(key = self.sort_key, reverse = self.rev_sort)
-        
-        #find the comments
-        num_have = 0
-        sort_candidates()
-        while num_have < num and candidates:
-            to_add = candidates.pop(0)
-            comments.remove(to_add)
-            if to_add._deleted and not comment_tree.has_key(to_add._id):
-                pass
-            elif depth[to_add._id] < self.max_depth:
-                #add children
-                if comment_tree.has_key(to_add._id):
-                    candidates.extend(comment_tree[to_add._id])
-                    sort_candidates()
-                items.append(to_add)
-                num_have += 1
-            elif self.continue_this_thread:
-                #add the recursion limit
-                p_id = to_add.parent_id
-                w = Wrapped(MoreRecursion(self.link, 0,
-                                          comment_dict[p_id]))
-                w.children.append(to_add)
-                extra[p_id] = w
-
-        wrapped = self.wrap_items(items)
+        depth_offset = depth.get(top, 0) if top else 0
+        def depth_of(cid):
+            return depth[cid] - depth_offset
+
+        #find the window of comments to display. each list of siblings
+        #is already in order, so they are merged lazily: the heap only
+        #holds the next comment from each list, and pos is the index of
+        #that comment in its list
+        lists = []
+        pos = []
+        heap = []
+        def push(n):
+            if pos[n] < len(lists[n]):
+                cid = lists[n][pos[n]]
+                heapq.heappush(heap, (sort_key(cid), n))
+        def add_list(l):
+            lists.append(l)
+            pos.append(0)
+            push(len(lists) - 1)
+
+        add_list(candidates)
+        #deleted comments without children aren't shown, so they don't
+        #count towards num. whether a comment is deleted for this user
+        #is only known once it's wrapped, so the window is loaded in
+        #rounds until it's full or there are no comments left
+        wrapped = []
+        comment_dict = {}
+        while len(wrapped) < num and heap:
+            window = []
+            while len(wrapped) + len(window) < num and heap:
+                n = heapq.heappop(heap)[1]
+                to_add = lists[n][pos[n]]
+                pos[n] += 1
+                push(n)
+                if depth_of(to_add) < self.max_depth:
+                    #add children
+                    children = children_of(to_add)
+                    if children:
+                        add_list(children)
+                    window.append(to_add)
+                elif self.continue_this_thread:
+                    #add the recursion limit
+                    extra[parents[to_add]] = to_add
+
+            #load only the comments in the window
+            if not window:
+                continue
+            loaded = Comment._byID(window, data = True, return_dict = True)
+            comment_dict.update(loaded)
+            for cm in self.wrap_items([loaded[cid] for cid in window
+                                       if cid in loaded]):
+                # don't show spam with no children
+                if not (cm.deleted and not children_of(cm._id)):
+                    wrapped.append(cm)
 
         cids = dict((cm._id, cm) for cm in wrapped)
         
@@ -571,9 +773,6 @@ class CommentBuilder(Builder):
         #make tree
 
         for cm in wrapped:
-            # don't show spam with no children
-            if cm.deleted and not comment_tree.has_key(cm._id):
-                continue
             cm.num_children = num_children[cm._id]
             if cm.collapsed and cm._id in dont_collapse:
                 cm.collapsed = False
@@ -588,37 +787,35 @@ class CommentBuilder(Builder):
                 final.append(cm)
 
         #put the extras in the tree
-        for p_id, morelink in extra.iteritems():
-            parent = cids[p_id]
-            parent.child = empty_listing(morelink)
+        for p_id, cid in extra.iteritems():
+            parent = cids.get(p_id)
+            if not parent:
+                continue
+            w = Wrapped(MoreRecursion(self.link, 0, comment_dict[p_id]))
+            w.children.append(CommentStub(cid))
+            parent.child = empty_listing(w)
             parent.child.parent_name = parent._fullname
 
         if not self.load_more:
             return final
 
-        #put the remaining comments into the tree (the show more comments link)
+        #put the remaining comments into the tree (the show more
+        #comments link). none of their descendants were displayed, so
+        #they are counted from num_children rather than walked
         more_comments = {}
-        while candidates:
-            to_add = candidates.pop(0)
+        remaining = [cid for n, l in enumerate(lists) for cid in l[pos[n]:]]
+        for to_add in remaining:
             direct_child = True
-            #ignore top-level comments for now
-            if not hasattr(to_add, 'parent_id'):
-                p_id = None
-            else:
-                #find the parent actually being displayed
-                #direct_child is whether the comment is 'top-level'
-                p_id = to_add.parent_id
-                while p_id and not cids.has_key(p_id):
-                    p = comment_dict[p_id]
-                    if hasattr(p, 'parent_id'):
-                        p_id = p.parent_id
-                    else:
-                        p_id = None
-                    direct_child = False
+            #find the parent actually being displayed
+            #direct_child is whether the comment is 'top-level'
+            p_id = parents.get(to_add)
+            while p_id and not cids.has_key(p_id):
+                p_id = parents.get(p_id)
+                direct_child = False
 
             mc2 = more_comments.get(p_id)
             if not mc2:
-                mc2 = MoreChildren(self.link, depth[to_add._id],
+                mc2 = MoreChildren(self.link, depth_of(to_add),
                                    parent = comment_dict.get(p_id))
                 more_comments[p_id] = mc2
                 w_mc2 = Wrapped(mc2)
@@ -632,14 +829,10 @@ class CommentBuilder(Builder):
                         parent.child = empty_listing(w_mc2)
                         parent.child.parent_name = parent._fullname
 
-            #add more children
-            if comment_tree.has_key(to_add._id):
-                candidates.extend(comment_tree[to_add._id])
-                
             if direct_child:
-                mc2.children.append(to_add)
+                mc2.children.append(CommentStub(to_add))
 
-            mc2.count += 1
+            mc2.count += 1 + num_children.get(to_add, 0)
 
         return final
 
@@ -68,14 +68,18 @@ class Listing(object):
         self.after = None
         self.before = None
 
+        #the links carry opaque cursors so that the builder can seek
+        #straight to the page; after/before stay fullnames for the api
         if self.nextprev and self.prev_link and prev and bcount > 1:
             p = request.get.copy()
-            p.update({'after':None, 'before':prev._fullname, 'count':bcount})
+            p.update({'after':None, 'count':bcount,
+                      'before':self.builder.make_cursor(prev).encode()})
             self.before = prev._fullname
             self.prev = (request.path + utils.query_string(p))
         if self.nextprev and self.next_link and next:
             p = request.get.copy()
-            p.update({'after':next._fullname, 'before':None, 'count':acount})
+            p.update({'after':self.builder.make_cursor(next).encode(),
+                      'before':None, 'count':acount})
             self.after = next._fullname
             self.next = (request.path + utils.query_string(p))
         #TODO: need name for template -- must be better way
@@ -279,12 +279,22 @@ class EmailHandler(object):
                        fname, date, ip, ips[ip], kind, msg_hash, body,
                        fr_addr, reply_to)
                 
-    def clear_queue(self, max_date, kind = None):
+    def clear_queue(self, max_date, kind = None, msg_hashes = None):
+        """Deletes the queued mail from before max_date, or only the
+        mail among it with the given msg_hashes"""
         s = self.queue_table
         where = [s.c.date < max_date]
         if kind:
             where.append([s.c.kind == kind])
-        sa.delete(s, sa.and_(*where)).execute()
+        if msg_hashes is None:
+            sa.delete(s, sa.and_(*where)).execute()
+            return
+
+        msg_hashes = list(msg_hashes)
+        for i in xrange(0, len(msg_hashes), 100):
+            chunk = msg_hashes[i:i + 100]
+            sa.delete(s, sa.and_(sa.or_(*[s.c.msg_hash == h for h in chunk]),
+                                 *where)).execute()
 
 
 class Email(object):
@@ -0,0 +1,139 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+from unittest import TestCase
+import threading
+
+from r2.lib import captcha
+
+class Cache(object):
+    """Enough of a memcache for the pool, with an atomic incr"""
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, val, time = 0):
+        self.data[key] = val
+
+    def add(self, key, val, time = 0):
+        with self.lock:
+            if key in self.data:
+                return False
+            self.data[key] = val
+            return True
+
+    def incr(self, key, delta = 1):
+        with self.lock:
+            if key not in self.data:
+                return None
+            self.data[key] += delta
+            return self.data[key]
+
+class Lock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        pass
+
+class Globals(object):
+    def __init__(self):
+        self.rendercache = Cache()
+
+    def make_lock(self, key, time = None, timeout = None):
+        return Lock()
+
+class TestPool(TestCase):
+    def setUp(self):
+        self.old = captcha.g, captcha.render
+        captcha.g = Globals()
+        self.renders = 0
+        def render(solution):
+            self.renders += 1
+            return 'png ' + solution
+        captcha.render = render
+
+    def tearDown(self):
+        captcha.g, captcha.render = self.old
+
+    def claim(self, num, threads = 4):
+        "takes num entries from the pool, from several threads at once"
+        claimed = []
+        def run():
+            for x in xrange(num / threads):
+                claimed.append(captcha.take_from_pool())
+        workers = [threading.Thread(target = run) for x in xrange(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return claimed
+
+    def test_dry(self):
+        "nothing is rendered on the request path"
+        self.assertEqual(captcha.take_from_pool(), None)
+        self.assertEqual(self.renders, 0)
+
+    def test_single_use(self):
+        captcha.fill_pool(50)
+        self.assertEqual(self.renders, 50)
+        claimed = self.claim(60)
+        entries = [e for e in claimed if e is not None]
+        self.assertEqual(len(entries), 50)
+        self.assertEqual(len(set(entries)), 50)
+        self.assertEqual(self.renders, 50)
+
+        #the next fill only renders what was claimed
+        captcha.fill_pool(50)
+        self.assertEqual(self.renders, 100)
+        again = [e for e in self.claim(48) if e is not None]
+        self.assertEqual(len(again), 48)
+        self.assert_(not set(again) & set(entries))
+
+    def test_expired(self):
+        """a consumer that finds its entry expired resets the pool, and
+        the next fill renders it again"""
+        captcha.fill_pool(20)
+        captcha.take_from_pool()
+        cache = captcha.g.rendercache.data
+        for key in cache.keys():
+            if key[len(captcha.pool_prefix):].isdigit():
+                del cache[key]
+
+        self.assertEqual(captcha.take_from_pool(), None)
+        self.assertEqual(cache[captcha.pool_head_key], 2)
+        captcha.fill_pool(20)
+        entries = [captcha.take_from_pool() for x in xrange(20)]
+        self.assert_(None not in entries)
+        self.assertEqual(captcha.take_from_pool(), None)
+
+    def test_fill_expired(self):
+        "fill_pool renders an expired pool again by itself"
+        captcha.fill_pool(20)
+        del captcha.g.rendercache.data[captcha.pool_prefix + '0']
+        captcha.fill_pool(20)
+        self.assertEqual(self.renders, 40)
+        self.assert_(None not in [captcha.take_from_pool()
+                                  for x in xrange(20)])
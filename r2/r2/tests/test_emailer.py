@@ -0,0 +1,92 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+from unittest import TestCase
+from email.MIMEText import MIMEText
+import smtpd, asyncore, threading
+
+from r2.lib.emailer import MailSender, SMTPPool
+
+class Sink(smtpd.SMTPServer):
+    """A local SMTP server that counts the mail it's sent, and turns
+    away the first try at each message to a domain in greylist"""
+    def __init__(self, greylist = ()):
+        smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.greylist = set(greylist)
+        self.seen = set()
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        domain = rcpttos[0].rsplit('@', 1)[-1]
+        if domain in self.greylist and data not in self.seen:
+            self.seen.add(data)
+            return '451 try again later'
+        self.received.append(data)
+
+def send(sink, addresses, **kw):
+    #each test gets its own loop over the socket map, stopped (and the
+    #sockets closed) before the next starts
+    done = threading.Event()
+    def serve():
+        while not done.isSet():
+            asyncore.loop(timeout = .05, count = 1)
+    t = threading.Thread(target = serve)
+    t.setDaemon(True)
+    t.start()
+
+    sender = MailSender(SMTPPool('localhost:%d' % sink.port, size = 3),
+                        num_senders = 3, **kw)
+    sender.start()
+    results = []
+    try:
+        for i, to_addr in enumerate(addresses):
+            msg = MIMEText('test message %d' % i)
+            msg['Subject'] = 'test %d' % i
+            sender.add('from@example.com', to_addr, msg.as_string(),
+                       results.append)
+        counts = sender.finish()
+    finally:
+        done.set()
+        t.join()
+        asyncore.close_all()
+    return counts, results
+
+class TestMailSender(TestCase):
+    def test_send(self):
+        sink = Sink()
+        addresses = ['to%d@example%d.com' % (i, i % 5) for i in xrange(50)]
+        counts, results = send(sink, addresses)
+        self.assertEqual(counts, dict(sent = 50, rejected = 0, failed = 0))
+        self.assertEqual(results, ['sent'] * 50)
+        self.assertEqual(len(sink.received), 50)
+
+    def test_greylisted(self):
+        """the greylisted domain's mail is held back and retried, without
+        holding up the rest"""
+        sink = Sink(greylist = ['grey.com'])
+        addresses = ['to%d@%s' % (i, 'grey.com' if i % 2 else 'white.com')
+                     for i in xrange(40)]
+        counts, results = send(sink, addresses, backoff_min = .05,
+                               backoff_max = .1)
+        self.assertEqual(counts, dict(sent = 40, rejected = 0, failed = 0))
+        self.assertEqual(len(sink.received), 40)
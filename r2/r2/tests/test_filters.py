@@ -0,0 +1,70 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+from nose.plugins.skip import SkipTest
+import random
+
+from r2.lib import filters
+from r2.lib.filters import _Unsafe, SC_OFF, SC_ON, python_force_unicode
+from r2.lib.wrapped import Templated
+
+#pieces the random strings are made of: the characters the filters
+#treat specially, whitespace that \s doesn't match without re.UNICODE,
+#and the markers in other cases
+pieces = [' ', '  ', '\t', '\n', '\r', '\f', '\v', u'\xa0', u'\x85',
+          u'\u2028', '<', '>', '&', '"', "'", 'a', 'B', u'\xe9',
+          u'\u017f', '\xe9', '\xc3\xa9', '\xff', '<p>', '</a> ',
+          SC_OFF, SC_ON, SC_OFF.lower(), SC_ON.lower(),
+          SC_OFF[:-1], SC_ON[1:], '<!-- sc_On -->']
+
+class TestCfilters(TestCase):
+    """The Cfilters versions of the filters give what the python ones
+    do, down to the class of the result"""
+    def setUp(self):
+        if not filters.Cfilters:
+            raise SkipTest("Cfilters isn't built")
+        self.pairs = filters._native_pairs()
+
+    def check(self, text):
+        for name, py, native in self.pairs:
+            expected, got = py(text), native(text)
+            self.assertEqual((expected, expected.__class__),
+                             (got, got.__class__),
+                             (name, text, expected, got))
+
+    def test_random(self):
+        rand = random.Random(1)
+        for i in xrange(10000):
+            parts = [rand.choice(pieces) for j in xrange(rand.randint(0, 20))]
+            #either all bytes (maybe not valid utf-8) or all unicode
+            if rand.random() < .5:
+                text = ''.join(p.encode('utf8') if isinstance(p, unicode)
+                               else p for p in parts)
+            else:
+                text = u''.join(python_force_unicode(p) for p in parts)
+            self.check(text)
+            self.check(_Unsafe(python_force_unicode(text)))
+
+    def test_not_strings(self):
+        for text in (None, 1, 2.5, Templated):
+            for name, py, native in self.pairs:
+                self.assertEqual(py(text), native(text), (name, text))
@@ -0,0 +1,81 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+from unittest import TestCase
+import os, shutil, tempfile
+import simplejson
+
+from r2.lib import metrics
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.old_dir = metrics.metrics_dir
+        self.tmp = tempfile.mkdtemp()
+        metrics.metrics_dir = os.path.join(self.tmp, 'metrics')
+
+    def tearDown(self):
+        metrics.metrics_dir = self.old_dir
+        shutil.rmtree(self.tmp)
+
+    def test_merge(self):
+        a = metrics.Counter('a')
+        b = metrics.Counter('a')
+        a.incr(2)
+        b.incr(3)
+        merged = metrics.merge([dict(a = a.snapshot()), dict(a = b.snapshot())])
+        self.assertEqual(merged['a'][2][-1], 5)
+
+    def test_publish(self):
+        """snapshots are published as json into a directory only this
+        user can get into, and read back by host_snapshot"""
+        metrics.histogram('test.histogram').observe(.01)
+        metrics.registry.publish()
+        st = os.stat(metrics.metrics_dir)
+        self.assertEqual(st.st_mode & 0777, 0700)
+
+        path = os.path.join(metrics.metrics_dir, str(os.getpid()))
+        with open(path) as handle:
+            published = simplejson.load(handle)
+        self.assert_('test.histogram' in published)
+
+        #a snapshot left by another (live) process is merged in
+        os.rename(path, os.path.join(metrics.metrics_dir, str(os.getppid())))
+        snapshot = metrics.host_snapshot()
+        counts = snapshot['test.histogram'][2][-1]
+        self.assertEqual(sum(counts[:-1]), 2)
+
+    def test_shared_dir(self):
+        "a directory others can write in isn't used"
+        os.makedirs(metrics.metrics_dir, 0777)
+        os.chmod(metrics.metrics_dir, 0777)
+        metrics.registry.publish()
+        self.assertEqual(os.listdir(metrics.metrics_dir), [])
+
+    def test_report(self):
+        "reports are strict json, even with values past the last bucket"
+        h = metrics.Histogram('h', buckets = (1, 2))
+        for x in (.5, 5, 5, 5):
+            h.observe(x)
+        report = metrics.report(dict(h = h.snapshot()))
+        self.assertEqual(report['h']['p50'], None)
+        self.assertEqual(report['h']['count'], 4)
+        simplejson.dumps(report, allow_nan = False)
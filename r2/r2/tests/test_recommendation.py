@@ -0,0 +1,157 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+from datetime import datetime, timedelta
+import random, math
+
+from r2.lib import recommendation
+from r2.lib.recommendation import (encode_record, decode_record, grab_int,
+                                   CoVoteModel)
+
+def decode_loop(entry):
+    """decode_record one int at a time, as it used to be"""
+    record_size = ord(entry[0])
+    num_records = grab_int(entry, 1, record_size)
+    keys, values = [], []
+    for i in range(num_records):
+        start = (i + 1) * record_size
+        keys.append(grab_int(entry, start, start + record_size - 1))
+        value = ord(entry[start + record_size - 1]) / 128.
+        values.append(value - 2 if value > 1 else value)
+    return keys, values
+
+class TestRecords(TestCase):
+    def test_round_trip(self):
+        rand = random.Random(0)
+        for key_size in (1, 3, 4, 8):
+            #the number of entries is stored in key_size bytes too
+            for size in (0, 1, 10, 255, 1000):
+                if size >> (8 * key_size):
+                    continue
+                keys = [rand.randint(0, (1 << (8 * key_size)) - 1)
+                        for x in xrange(size)]
+                values = [rand.randint(-127, 128) / 128.
+                          for x in xrange(size)]
+                entry = encode_record(keys, values, key_size)
+
+                k, v = decode_record(entry)
+                self.assertEqual((list(k), list(v)), (keys, values))
+                self.assertEqual(decode_loop(entry), (keys, values))
+
+class TestCoVoteModel(TestCase):
+    start = datetime(2009, 1, 1)
+
+    def day(self, n):
+        return self.start + timedelta(n)
+
+    def check_counts(self, model):
+        """the counts are exactly those of the likes kept"""
+        counts, pairs = {}, {}
+        for likes in model.likes.itervalues():
+            ids = [l for l, d in likes]
+            for l in ids:
+                counts[l] = counts.get(l, 0) + 1
+                for other in ids:
+                    if other != l:
+                        p = pairs.setdefault(l, {})
+                        p[other] = p.get(other, 0) + 1
+        self.assertEqual(model.counts, counts)
+        self.assertEqual(model.pairs, pairs)
+
+    def test_pairs(self):
+        model = CoVoteModel()
+        for account, link in ((1, 10), (1, 11), (1, 12), (2, 10), (2, 11),
+                              (2, 10)):
+            model.add_like(account, link, self.day(0))
+        self.assertEqual(model.counts, {10: 2, 11: 2, 12: 1})
+        self.assertEqual(model.pairs[10], {11: 2, 12: 1})
+        self.assertEqual(model.pairs[12], {10: 1, 11: 1})
+        self.check_counts(model)
+
+    def test_cap(self):
+        """only an account's max_user_likes most recent likes count"""
+        model = CoVoteModel()
+        cap = recommendation.max_user_likes
+        for link in xrange(cap + 5):
+            model.add_like(1, link, self.day(0))
+        self.assertEqual([l for l, d in model.likes[1]], range(5, cap + 5))
+        self.assert_(0 not in model.counts)
+        self.assert_(0 not in model.pairs.get(5, {}))
+        self.check_counts(model)
+
+    def test_neighbours(self):
+        model = CoVoteModel()
+        #10 and 11 are liked by the same people, 12 by one of them
+        for account in (1, 2, 3):
+            model.add_like(account, 10, self.day(0))
+            model.add_like(account, 11, self.day(0))
+        model.add_like(1, 12, self.day(0))
+        model.add_like(4, 12, self.day(0))
+
+        n = model.neighbours(10)
+        self.assertEqual([l for l, sim in n], [11, 12])
+        self.assertAlmostEqual(n[0][1], 1.)
+        self.assertAlmostEqual(n[1][1], 1 / math.sqrt(3 * 2))
+        self.assertEqual(len(model.neighbours(10, num = 1)), 1)
+        self.assertEqual(model.neighbours(99), [])
+
+    def test_expire(self):
+        model = CoVoteModel()
+        model.add_like(1, 10, self.day(0))
+        model.add_like(1, 11, self.day(1))
+        model.add_like(1, 12, self.day(2))
+        model.add_like(2, 10, self.day(0))
+        model.touched.clear()
+
+        model.expire(self.day(1))
+        self.assertEqual(model.likes, {1: [[11, self.day(1)],
+                                           [12, self.day(2)]]})
+        self.assertEqual(model.counts, {11: 1, 12: 1})
+        self.assertEqual(model.touched, set([10, 11, 12]))
+        self.check_counts(model)
+        self.assertEqual(model.neighbours(10), [])
+
+    def test_retract(self):
+        model = CoVoteModel()
+        for account in (1, 2):
+            model.add_like(account, 10, self.day(0))
+            model.add_like(account, 11, self.day(0))
+        model.remove_like(1, 10)
+        model.remove_like(1, 99)
+        self.assertEqual(model.counts, {10: 1, 11: 2})
+        self.assertEqual(model.pairs[10], {11: 1})
+        self.check_counts(model)
+
+    def test_random(self):
+        """the counts stay those of the likes kept through any mix of
+        likes, retractions and expiry"""
+        rand = random.Random(0)
+        model = CoVoteModel()
+        for i in xrange(3000):
+            account, link = rand.randint(1, 20), rand.randint(1, 150)
+            if rand.random() < .8:
+                model.add_like(account, link, self.day(i / 300.))
+            else:
+                model.remove_like(account, link)
+            if i % 500 == 0:
+                model.expire(self.day(i / 300. - 2))
+        self.check_counts(model)
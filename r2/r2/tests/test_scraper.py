@@ -0,0 +1,85 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+from StringIO import StringIO
+import re
+
+from r2.lib import scraper
+from r2.lib.scraper import normalize_url, _read_page, chunk_size
+
+class Page(StringIO):
+    """A response body that counts the bytes read from it"""
+    def __init__(self, data):
+        StringIO.__init__(self, data)
+        self.bytes_read = 0
+
+    def read(self, n = -1):
+        data = StringIO.read(self, n)
+        self.bytes_read += len(data)
+        return data
+
+class TestNormalizeUrl(TestCase):
+    def test_normalize(self):
+        for url, expected in (
+            ('http://Example.COM/a/B?x=1#top', 'http://example.com/a/B?x=1'),
+            ('HTTP://example.com:80/', 'http://example.com/'),
+            ('http://example.com', 'http://example.com/'),
+            ('http://example.com:8080/a', 'http://example.com:8080/a'),
+            (u'http://example.com/caf\xe9', 'http://example.com/caf%C3%A9')):
+            self.assertEqual(normalize_url(url), expected)
+
+    def test_same_key(self):
+        self.assertEqual(scraper.scrape_key('http://EXAMPLE.com:80/x#a'),
+                         scraper.scrape_key('http://example.com/x'))
+        self.assertNotEqual(scraper.scrape_key('http://example.com/x'),
+                            scraper.scrape_key('http://example.com/X'))
+
+class TestReadPage(TestCase):
+    def test_whole(self):
+        data = 'x' * (chunk_size * 5 + 10)
+        page = Page(data)
+        self.assertEqual(_read_page(page, '', None, None), data)
+
+    def test_max_size(self):
+        data = 'x' * (chunk_size * 10)
+        page = Page(data)
+        content = _read_page(page, '', chunk_size * 3 + 5, None)
+        self.assertEqual(content, data[:chunk_size * 3 + 5])
+        self.assert_(page.bytes_read <= chunk_size * 4)
+
+    def test_stop_across_chunks(self):
+        """a stop_rx match split between two chunks still stops the read
+        at the chunk it ends in"""
+        stop_rx = re.compile('</head>', re.I)
+        start = chunk_size * 3 - 3
+        data = 'x' * start + '</HEAD>' + 'y' * (chunk_size * 10)
+        page = Page(data)
+        content = _read_page(page, '', None, stop_rx)
+        self.assertEqual(page.bytes_read, chunk_size * 4)
+        self.assertEqual(content, data[:chunk_size * 4])
+
+    def test_stop_in_first_chunk(self):
+        "content already read is searched before reading more"
+        page = Page('y' * chunk_size)
+        content = _read_page(page, '<head></head>', None,
+                             re.compile('</head>'))
+        self.assertEqual((content, page.bytes_read), ('<head></head>', 0))
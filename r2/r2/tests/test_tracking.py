@@ -0,0 +1,83 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+import threading
+
+from r2.lib import tracking
+from r2.lib.tracking import (encrypt, decrypt, encrypt_many,
+                             encrypt_simple, decrypt_simple)
+
+payloads = ['', 'a', 'x' * 15, 'y' * 16, 'z' * 17,
+            't3_abc|pics|en|False', '\xe2\x98\x83' * 40]
+
+class TestTracking(TestCase):
+    def test_round_trip(self):
+        for p in payloads:
+            self.assertEqual(decrypt(encrypt(p)), p)
+
+    def test_simple(self):
+        """the chained cipher's output is what a new cipher per call
+        gives, so each decrypts the other's"""
+        for p in payloads:
+            self.assertEqual(decrypt_simple(encrypt(p)), p)
+            self.assertEqual(decrypt(encrypt_simple(p)), p)
+
+    def test_many(self):
+        res = encrypt_many(payloads)
+        self.assertEqual(len(set(res)), len(payloads))
+        self.assertEqual(map(decrypt_simple, res), payloads)
+        self.assertEqual(map(decrypt, res), payloads)
+
+    def test_interleaved(self):
+        "decrypting between encrypts doesn't upset the carried-over block"
+        for p in payloads:
+            e = encrypt(p)
+            self.assertEqual(decrypt(encrypt_simple('other')), 'other')
+            self.assertEqual(decrypt_simple(e), p)
+            self.assertEqual(decrypt(e), p)
+
+    def test_threads(self):
+        "each thread has its own cipher"
+        errors = []
+        def run():
+            try:
+                for x in xrange(200):
+                    for p in payloads:
+                        if decrypt_simple(encrypt(p)) != p:
+                            errors.append(p)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target = run) for x in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_info(self):
+        "a UserInfo's tracking url carries its fields through encryption"
+        info = tracking.UserInfo.__new__(tracking.UserInfo)
+        info.name, info.site, info.lang, info.cname = 'joe', 'pics', 'en', 'False'
+        v = info.tracking_url().split('?v=', 1)[1]
+        read = tracking.UserInfo(v)
+        self.assertEqual((read.name, read.site, read.lang, read.cname),
+                         ('joe', 'pics', 'en', 'False'))
@@ -0,0 +1,155 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2009
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+from unittest import TestCase
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from cgi import parse_qs
+from cPickle import loads, dumps
+import datetime, random, threading
+
+from pylons import g
+from r2.lib import traffic
+
+def parse_date(s):
+    return datetime.datetime(*map(int, s.split(':')), **dict(tzinfo = g.tz))
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def series(self, path):
+        """every series is hourly points up to now of five counts, made
+        up from the path and time"""
+        server = self.server
+        path, q = (path.split('?', 1) + [''])[:2]
+        q = dict((k, v[0]) for k, v in parse_qs(q).iteritems())
+        now = datetime.datetime.now(g.tz).replace(minute = 0, second = 0,
+                                                  microsecond = 0)
+        start = (parse_date(q['start_time']) if 'start_time' in q
+                 else now - datetime.timedelta(hours = server.npoints - 1))
+        stop = parse_date(q['stop_time']) if 'stop_time' in q else now
+        points = []
+        while start <= stop:
+            seed = hash((path, start))
+            points.append((start, tuple(abs(seed >> i) % 1000
+                                        for i in xrange(5))))
+            start += datetime.timedelta(hours = 1)
+        if 'n' in q:
+            points = points[-int(q['n']):]
+        server.points += len(points)
+        return points
+
+    def respond(self, status, data = None):
+        data = dumps(data)
+        self.server.requests += 1
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.respond(200, self.series(self.path))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.batch_status != 200:
+            return self.respond(self.server.batch_status)
+        self.respond(200, [self.series(p) for p in loads(body)])
+
+    def log_message(self, *a):
+        pass
+
+class Server(ThreadingMixIn, HTTPServer):
+    """A stand-in for the traffic server, which counts the requests and
+    points it has served"""
+    daemon_threads = True
+
+    def __init__(self, npoints = 100, batch_status = 200):
+        HTTPServer.__init__(self, ('localhost', 0), Handler)
+        self.npoints = npoints
+        self.batch_status = batch_status
+        self.requests = self.points = 0
+
+class TestLoadTraffic(TestCase):
+    def setUp(self):
+        self.old = (g.traffic_url, traffic.refresh_time,
+                    traffic.batch_supported)
+        self.server = None
+
+    def tearDown(self):
+        (g.traffic_url, traffic.refresh_time,
+         traffic.batch_supported) = self.old
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def serve(self, **kw):
+        self.server = Server(**kw)
+        t = threading.Thread(target = self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        g.traffic_url = ('http://localhost:%d/traffic' %
+                         self.server.server_address[1])
+        traffic.batch_supported = True
+        return self.server
+
+    def make_series(self, num = 20):
+        #new idens each time, so nothing comes from an earlier run's cache
+        run = random.getrandbits(32)
+        return [('hour', 'thing', 't3_%x_%d' % (run, i)) for i in xrange(num)]
+
+    def test_batch(self):
+        server = self.serve()
+        series = self.make_series()
+        res = traffic.load_traffic_multi(series)
+        self.assertEqual(server.requests, 1)
+        self.assertEqual([len(r) for r in res], [100] * len(series))
+
+    def test_refresh(self):
+        """a refresh gets the same series, fetching only the last day of
+        each again"""
+        server = self.serve()
+        series = self.make_series()
+        first = traffic.load_traffic_multi(series)
+
+        server.requests = server.points = 0
+        traffic.refresh_time = 0
+        second = traffic.load_traffic_multi(series)
+        self.assertEqual(first, second)
+        self.assertEqual(server.requests, 1)
+        self.assertEqual(server.points, 25 * len(series))
+
+    def test_no_batch(self):
+        """a server without /batch is asked for each series on its own,
+        and isn't asked to batch again"""
+        server = self.serve(batch_status = 404)
+        series = self.make_series()
+        res = traffic.load_traffic_multi(series)
+        self.assertEqual([len(r) for r in res], [100] * len(series))
+        self.assertEqual(traffic.batch_supported, False)
+
+    def test_batch_error(self):
+        "a failed batch doesn't stop the next from being tried"
+        server = self.serve(batch_status = 500)
+        res = traffic.load_traffic_multi(self.make_series())
+        self.assertEqual([len(r) for r in res], [100] * 20)
+        self.assertEqual(traffic.batch_supported, True)